@@ -1 +1,12 @@
 from pypatstat.etl.data_loader import download_patstat_to_db
+from pypatstat.etl.data_loader import PatstatLoader
+from pypatstat.etl.retrieval import iter_table
+from pypatstat.etl.delta import delta_patstat_to_db
+
+
+def __getattr__(name):
+    # Parquet exports need pyarrow, which is only imported on first use
+    if name == "download_patstat_to_parquet":
+        from pypatstat.etl.parquet_export import download_patstat_to_parquet
+        return download_patstat_to_parquet
+    raise AttributeError(f"module 'pypatstat' has no attribute '{name}'")
@@ -0,0 +1,186 @@
+'''Bulk-load backends, chosen by the dialect of the database URL. Each writes
+a :obj:`Batch` through the database's native bulk path, falling back on a
+generic executemany for unrecognised dialects and drivers.'''
+
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.types import NVARCHAR
+from io import StringIO
+import logging
+import os
+import pandas as pd
+import tempfile
+
+# Escapes for the MySQL / PostgreSQL tab-delimited text format
+TEXT_ESCAPES = [("\\", "\\\\"), ("\t", "\\t"), ("\n", "\\n"), ("\r", "\\r")]
+TEXT_NULL = "\\N"
+
+
+def to_copy_text(batch):
+    """Encode a batch in the tab-delimited text format understood by both
+    MySQL's LOAD DATA and PostgreSQL's COPY, one column at a time.
+
+    Args:
+        batch (:obj:`Batch`): Rows of data to encode.
+    Returns:
+        text (str): One line per row, with tab-separated fields.
+    """
+    if batch.n_rows == 0:
+        return ""
+    fields = None
+    for values in batch.values:
+        col = pd.Series(values, dtype=object)
+        is_null = col.isnull()
+        col = col.astype(str)
+        for old, new in TEXT_ESCAPES:
+            col = col.str.replace(old, new, regex=False)
+        col = col.where(~is_null, TEXT_NULL)
+        fields = col if fields is None else fields + "\t" + col
+    return "\n".join(fields) + "\n"
+
+
+@compiles(NVARCHAR, "postgresql")
+def compile_nvarchar_postgresql(type_, compiler, **kw):
+    """PostgreSQL has no NVARCHAR, since its VARCHAR is already unicode"""
+    return compiler.visit_VARCHAR(type_, **kw)
+
+
+def quoted_names(dialect, table, columns):
+    """Quote the table and column names for raw SQL"""
+    preparer = dialect.identifier_preparer
+    return (preparer.format_table(table),
+            ", ".join(preparer.quote(col) for col in columns))
+
+
+def insert_skipping_duplicates(dialect, table):
+    """An INSERT statement which lets the database skip rows whose PKs
+    are already in the table"""
+    if dialect.name == "mysql":
+        return table.insert().prefix_with("IGNORE")
+    if dialect.name == "sqlite":
+        return table.insert().prefix_with("OR IGNORE")
+    if dialect.name == "postgresql":
+        return postgresql_insert(table).on_conflict_do_nothing()
+    raise NotImplementedError(f"Can't skip duplicates in {dialect.name}")
+
+
+def _rowcount(rowcount, batch):
+    """The number of rows inserted, if the driver reported it"""
+    return batch.n_rows if rowcount is None or rowcount < 0 else rowcount
+
+
+class GenericBackend:
+    """Insert via SQLAlchemy's executemany, which works for any dialect"""
+    connect_args = {}
+
+    def can_skip_duplicates(self, dialect):
+        """Can the database itself skip rows whose PKs are already present?"""
+        return dialect.name in ("mysql", "sqlite", "postgresql")
+
+    def max_packet_bytes(self, engine):
+        """The server's limit on the size of a statement, if it has one"""
+        if engine.dialect.name == "mysql":
+            return int(engine.execute("SELECT @@max_allowed_packet").scalar())
+        return None
+
+    def insert(self, conn, table, batch, skip_duplicates=False):
+        """Insert a batch into the table, within the connection's transaction.
+
+        Args:
+            conn (:obj:`sqlalchemy.engine.Connection`): An open connection.
+            table (:obj:`sqlalchemy.Table`): The table to insert into.
+            batch (:obj:`Batch`): Rows of data to write.
+            skip_duplicates (bool): Let the database skip rows whose PKs are
+                                    already in the table.
+        Returns:
+            n_rows (int): The number of rows inserted, where the driver
+                          reports it, otherwise the number of rows sent.
+        """
+        stmt = table.insert()
+        if skip_duplicates:
+            stmt = insert_skipping_duplicates(conn.dialect, table)
+        result = conn.execute(stmt, [dict(zip(batch.columns, row))
+                                     for row in batch.rows])
+        return _rowcount(result.rowcount, batch)
+
+
+class SQLiteBackend(GenericBackend):
+    """Insert row tuples straight through the sqlite3 cursor's executemany,
+    skipping SQLAlchemy's per-row parameter processing"""
+    def insert(self, conn, table, batch, skip_duplicates=False):
+        name, columns = quoted_names(conn.dialect, table, batch.columns)
+        params = ", ".join("?" for _ in batch.columns)
+        insert = "INSERT OR IGNORE" if skip_duplicates else "INSERT"
+        cursor = conn.connection.cursor()
+        cursor.executemany(f"{insert} INTO {name} ({columns}) "
+                           f"VALUES ({params})", batch.rows)
+        n_rows = _rowcount(cursor.rowcount, batch)
+        cursor.close()
+        return n_rows
+
+
+class PostgresBackend(GenericBackend):
+    """Stream each batch through COPY ... FROM STDIN. When skipping duplicates
+    the batch is copied into a temporary staging table, and then merged
+    into the table with ON CONFLICT DO NOTHING."""
+    def insert(self, conn, table, batch, skip_duplicates=False):
+        name, columns = quoted_names(conn.dialect, table, batch.columns)
+        cursor = conn.connection.cursor()
+        target = name
+        if skip_duplicates:
+            target = conn.dialect.identifier_preparer.quote(f"staging_{table.name}")
+            cursor.execute(f"CREATE TEMPORARY TABLE {target} "
+                           f"(LIKE {name} INCLUDING DEFAULTS) ON COMMIT DROP")
+        cursor.copy_expert(f"COPY {target} ({columns}) FROM STDIN",
+                           StringIO(to_copy_text(batch)))
+        if skip_duplicates:
+            cursor.execute(f"INSERT INTO {name} ({columns}) "
+                           f"SELECT {columns} FROM {target} "
+                           "ON CONFLICT DO NOTHING")
+        n_rows = _rowcount(cursor.rowcount, batch)
+        cursor.close()
+        return n_rows
+
+
+class MySQLBackend(GenericBackend):
+    """Load each batch through LOAD DATA LOCAL INFILE"""
+    connect_args = {"local_infile": True}
+
+    def insert(self, conn, table, batch, skip_duplicates=False):
+        name, columns = quoted_names(conn.dialect, table, batch.columns)
+        ignore = "IGNORE " if skip_duplicates else ""
+        fd, path = tempfile.mkstemp(suffix=".tsv")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+                f.write(to_copy_text(batch))
+            result = conn.execute(f"LOAD DATA LOCAL INFILE '{path}' {ignore}INTO "
+                                  f"TABLE {name} CHARACTER SET utf8mb4 ({columns})")
+            return _rowcount(result.rowcount, batch)
+        finally:
+            os.remove(path)
+
+
+# Native bulk-load backends by dialect, and the drivers which support them
+BACKENDS = {"sqlite": (SQLiteBackend, ("pysqlite",)),
+            "postgresql": (PostgresBackend, ("psycopg2",)),
+            "mysql": (MySQLBackend, ("pymysql", "mysqldb"))}
+
+
+def get_backend(db_url, bulk=True):
+    """Choose the bulk-load backend for this database URL.
+
+    Args:
+        db_url (str): Database connection string.
+        bulk (bool): If False, always use the generic backend.
+    Returns:
+        backend (:obj:`GenericBackend`): The bulk-load backend.
+    """
+    url = make_url(db_url)
+    if bulk and url.get_backend_name() in BACKENDS:
+        backend, drivers = BACKENDS[url.get_backend_name()]
+        if url.get_driver_name() in drivers:
+            return backend()
+        logging.warning(f"No native bulk load for driver "
+                        f"{url.get_driver_name()}, using executemany")
+    return GenericBackend()
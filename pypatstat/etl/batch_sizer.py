@@ -0,0 +1,138 @@
+'''Size each table's batches by bytes rather than rows, within the server's
+packet limit, tuning the size at runtime from the measured throughput and
+latency of recent inserts.'''
+
+from collections import defaultdict
+import logging
+import queue
+
+TARGET_BYTES = 2**22  # Starting size of each batch, in (in-memory) bytes
+MIN_BYTES = 2**16
+MAX_BYTES = 2**28
+MAX_LATENCY = 10  # Seconds, beyond which batches are shrunk regardless
+PACKET_FRACTION = 0.5  # Of max_allowed_packet, as in-memory size underestimates SQL
+STEP = 1.5  # Factor by which the size is grown or shrunk
+WINDOW = 3  # Number of inserts over which to measure each size's throughput
+TOLERANCE = 0.05  # Changes in throughput smaller than this are noise
+SMOOTHING = 0.2  # Weight of each chunk in the moving average of bytes per row
+
+
+class _Controller:
+    """Hill climb towards the batch size with the highest throughput: keep
+    moving the size in the same direction while throughput improves, turn
+    back when it drops, and hold once it's flat."""
+    def __init__(self, size, min_bytes, max_bytes):
+        self.size = size
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+        self.direction = 1
+        self.last_rate = None
+        self.n_bytes = 0
+        self.seconds = 0
+        self.n_inserts = 0
+        self.max_seconds = 0
+
+    def observe(self, n_bytes, seconds, max_latency):
+        """Record an insert, and retune once there are enough of them.
+        Returns True if the size changed."""
+        self.n_bytes += n_bytes
+        self.seconds += seconds
+        self.n_inserts += 1
+        self.max_seconds = max(self.max_seconds, seconds)
+        if self.n_inserts < WINDOW:
+            return False
+        rate = self.n_bytes / max(self.seconds, 1e-9)
+        size = self.size
+        if self.max_seconds > max_latency:
+            self.direction = -1
+            size /= STEP
+        elif self.last_rate is None or rate > self.last_rate * (1 + TOLERANCE):
+            size *= STEP ** self.direction
+        elif rate < self.last_rate * (1 - TOLERANCE):
+            self.direction = -self.direction
+            size *= STEP ** self.direction
+        self.last_rate = rate
+        self.n_bytes, self.seconds, self.n_inserts, self.max_seconds = 0, 0, 0, 0
+        size = int(min(max(size, self.min_bytes), self.max_bytes))
+        changed, self.size = size != self.size, size
+        return changed
+
+
+class BatchSizer:
+    """Choose the number of rows to read into each table's next chunk, from
+    its target size in bytes and a moving average of its bytes per row.
+    Each table's target is tuned separately by its own insert times.
+
+    Args:
+        target_bytes (int): Starting target for each table.
+        max_bytes (int): Upper bound on the target, e.g. from the server's
+                         packet limit, see :obj:`packet_limit`.
+        max_latency (float): Shrink batches whose inserts take longer than
+                             this many seconds.
+    """
+    def __init__(self, target_bytes=TARGET_BYTES, max_bytes=MAX_BYTES,
+                 max_latency=MAX_LATENCY):
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self.controllers = defaultdict(lambda: _Controller(
+            min(target_bytes, max_bytes), min(MIN_BYTES, max_bytes), max_bytes))
+        self.bytes_per_row = {}
+        self.n_rows = {}
+        self.feedback = None
+
+    def share(self, feedback):
+        """Send the number of rows per chunk, as tuned in this process, to
+        the reader in a (forked) child process over a
+        :obj:`multiprocessing.Queue`"""
+        self.feedback = feedback
+
+    def rows(self, table, default):
+        """The number of rows to read into the next chunk of the table, or
+        `default` until its size per row is known"""
+        if self.feedback is not None:
+            while True:
+                try:
+                    _table, n_rows = self.feedback.get_nowait()
+                except queue.Empty:
+                    break
+                self.n_rows[_table] = n_rows
+        return self.n_rows.get(table, default)
+
+    def _update(self, table):
+        n_rows = max(int(self.controllers[table].size / self.bytes_per_row[table]), 1)
+        previous = self.n_rows.get(table)
+        if previous is not None and abs(n_rows / previous - 1) < TOLERANCE:
+            return
+        self.n_rows[table] = n_rows
+        if self.feedback is not None:
+            self.feedback.put((table, n_rows))
+
+    def observe_chunk(self, table, chunk):
+        """Update the table's average bytes per row from a chunk"""
+        if len(chunk) == 0:
+            return
+        n_bytes = chunk.memory_usage(index=False, deep=True).sum() / len(chunk)
+        previous = self.bytes_per_row.get(table, n_bytes)
+        self.bytes_per_row[table] = (1 - SMOOTHING) * previous + SMOOTHING * n_bytes
+        self._update(table)
+
+    def observe_insert(self, table, n_rows, seconds):
+        """Retune the table's target from the time taken to insert rows"""
+        if n_rows == 0 or table not in self.bytes_per_row:
+            return
+        controller = self.controllers[table]
+        if controller.observe(n_rows * self.bytes_per_row[table], seconds,
+                              self.max_latency):
+            self._update(table)
+            logging.info(f"\t\tBatches of {table} are now "
+                         f"{controller.size/2**20:.1f} MB "
+                         f"({self.n_rows[table]:,} rows)")
+
+
+def packet_limit(backend, engine):
+    """Upper bound on batch sizes (in memory) from the server's packet limit,
+    if it has one"""
+    max_packet = backend.max_packet_bytes(engine)
+    if max_packet is None:
+        return MAX_BYTES
+    return min(int(max_packet * PACKET_FRACTION), MAX_BYTES)
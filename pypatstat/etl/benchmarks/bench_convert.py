@@ -0,0 +1,83 @@
+'''Benchmark the conversion of CSV chunks into rows to write: the legacy
+`iterrows` / per-row dict path against the vectorized :obj:`Batch` path.
+
+Usage:
+    python -m pypatstat.etl.benchmarks.bench_convert --n_rows 100000
+'''
+
+from pypatstat.etl.data_loader import chunk_to_batch
+from pypatstat.etl.data_loader import make_pks
+from pypatstat.etl.orms.patstat_2019_05_13 import Tls201Appln
+import argparse
+import numpy as np
+import pandas as pd
+import time
+
+
+def legacy_convert(chunk, _class):
+    """The conversion as it was before :obj:`Batch`, for comparison: rows as
+    dicts via `iterrows`, then the PK of each row checked for nulls. As in
+    the original, that check passes the whole PK tuple to
+    :obj:`legacy_is_null_pk`, so no rows are actually dropped."""
+    rows = []
+    for idx, row in chunk.iterrows():
+        row = {k:(v if not pd.isnull(v) else None)
+               for k, v in row.items()}
+        rows.append(row)
+    return [r for r in rows
+            if not legacy_is_null_pk(legacy_make_pk(r, _class))]
+
+
+def legacy_is_null_pk(x):
+    """PK deemed to be null if it is either whitespace, None or zero"""
+    if type(x) is str:
+        return x.strip() == ''
+    return x in (None, 0)
+
+
+def legacy_make_pk(row, _class):
+    """Generate the primary key for this row based on ORM PK info"""
+    pkey_cols = _class.__table__.primary_key.columns
+    pk = tuple([row[pkey.name]                       # Cast to str since
+                if pkey.type.python_type is not str  # pd can wrongly guess
+                else str(row[pkey.name])             # the type as int
+                for pkey in pkey_cols])
+    return pk
+
+
+def vectorized_convert(chunk, _class):
+    batch = chunk_to_batch(chunk, _class)
+    make_pks(batch, _class)
+    return batch
+
+
+def fake_tls201(n_rows, seed=0):
+    rng = np.random.RandomState(seed)
+    chunk = pd.DataFrame({"appln_id": rng.randint(0, 10**9, n_rows),
+                          "appln_auth": rng.choice(["EP", "GB", "US"], n_rows),
+                          "appln_nr": rng.randint(0, 10**9, n_rows).astype(str),
+                          "appln_filing_date": "2001-01-01",
+                          "appln_filing_year": rng.randint(1900, 2020, n_rows),
+                          "int_phase": rng.choice(["Y", "N", None], n_rows),
+                          "docdb_family_id": rng.randint(0, 10**9, n_rows)})
+    chunk.loc[::100, "appln_id"] = 0
+    return chunk
+
+
+def main(n_rows, chunksize):
+    chunk = fake_tls201(n_rows)
+    for label, convert in [("legacy", legacy_convert),
+                           ("vectorized", vectorized_convert)]:
+        start = time.time()
+        for i in range(0, n_rows, chunksize):
+            convert(chunk.iloc[i:i+chunksize], Tls201Appln)
+        t = time.time() - start
+        print(f"{label:<12}{t:.2f}s ({n_rows/t:,.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_rows", type=int, default=100000)
+    parser.add_argument("--chunksize", type=int, default=10000)
+    args = parser.parse_args()
+    main(args.n_rows, args.chunksize)
@@ -0,0 +1,63 @@
+'''Benchmark sequential vs concurrent archive downloads against a local,
+bandwidth-limited stand-in for the EPO raw data website.
+
+Usage:
+    python -m pypatstat.etl.benchmarks.bench_download --n_zips 8 --workers 4
+'''
+
+from pypatstat.etl import utils
+from pypatstat.etl.benchmarks.fake_epo import FakeEpoServer
+from pypatstat.etl.benchmarks.fake_epo import USERNAME
+from pypatstat.etl.benchmarks.fake_epo import PWD
+from unittest import mock
+from io import BytesIO
+from zipfile import ZipFile
+import argparse
+import os
+import tempfile
+import time
+
+
+def time_download(server, n_download_workers, cache_dir=None):
+    with mock.patch.multiple(utils, **server.urls()):
+        start = time.time()
+        for url, f in utils._zipfiles_on_pages(n_download_workers=n_download_workers,
+                                               cache_dir=cache_dir,
+                                               username=USERNAME, pwd=PWD):
+            f.close()
+        return time.time() - start
+
+
+def random_zipfile(size):
+    bio = BytesIO()
+    with ZipFile(bio, "w") as zf:
+        zf.writestr("random.bin", os.urandom(size))
+    return bio.getvalue()
+
+
+def main(n_zips, zip_size, bandwidth, workers):
+    zipfiles = {f"patstat_part_{i:02d}.zip": random_zipfile(zip_size)
+                for i in range(n_zips)}
+    total = n_zips * zip_size / 2**20
+    with FakeEpoServer(zipfiles, bandwidth=bandwidth) as server:
+        timings = [("sequential", time_download(server, 1)),
+                   (f"{workers} workers", time_download(server, workers))]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            timings.append((f"{workers} workers, cached",
+                            time_download(server, workers, cache_dir)))
+            timings.append(("rerun from cache",
+                            time_download(server, workers, cache_dir)))
+        print(f"{server.n_logins} logins in total")
+    for label, t in timings:
+        print(f"{label:<24}{t:.2f}s ({total/t:.1f} MB/s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_zips", type=int, default=8)
+    parser.add_argument("--zip_size", type=int, default=2**22)
+    parser.add_argument("--bandwidth", type=int, default=2**22,
+                        help="Bytes per second per connection")
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+    main(args.n_zips, args.zip_size, args.bandwidth, args.workers)
@@ -0,0 +1,216 @@
+'''Benchmark each stage of the loader (download, decompress, parse, convert
+and insert), and the whole pipeline end to end, on synthetic PATSTAT archives
+served by a local stand-in for the EPO website. Rows/s and peak RSS are
+reported per stage, and appended to a results file, against which each run
+is compared so that regressions are visible.
+
+Usage:
+    python -m pypatstat.etl.benchmarks.bench_pipeline --n_rows 100000 \\
+        --postgres_url postgresql+psycopg2://postgres@localhost/bench
+'''
+
+from pypatstat.etl import utils
+from pypatstat.etl.utils import stream_zip_members
+from pypatstat.etl.data_loader import PatstatLoader
+from pypatstat.etl.data_loader import read_chunks
+from pypatstat.etl.data_loader import chunk_to_batch
+from pypatstat.etl.data_loader import get_class_by_tablename
+from pypatstat.etl.data_loader import _download_patstat_to_db
+from pypatstat.etl.orms.patstat_2019_05_13 import Base
+from pypatstat.etl.benchmarks.fake_epo import FakeEpoServer
+from pypatstat.etl.benchmarks.fake_epo import USERNAME
+from pypatstat.etl.benchmarks.fake_epo import PWD
+from pypatstat.etl.benchmarks.synthetic import fake_archives
+from datetime import datetime
+from io import BytesIO
+from unittest import mock
+from zipfile import ZipFile
+import argparse
+import json
+import os
+import resource
+import subprocess
+import tempfile
+import threading
+import time
+
+RESULTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "results.jsonl")
+REGRESSION_THRESHOLD = 0.1  # Flag stages which are 10% slower than last time
+RSS_INTERVAL = 0.01  # Seconds between RSS samples
+
+
+def current_rss():
+    """Resident set size of this process in bytes, or None if unknown"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+class PeakRss:
+    """Sample the RSS of this process in the background, to find its peak
+    within the block. Where RSS can't be sampled, the peak over the lifetime
+    of the process is reported instead."""
+    def __enter__(self):
+        self.peak = current_rss()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._done.wait(RSS_INTERVAL):
+            rss = current_rss()
+            if rss is not None:
+                self.peak = max(self.peak, rss)
+
+    def __exit__(self, *args):
+        self._done.set()
+        self._thread.join()
+        if self.peak is None:
+            self.peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_stage(results, name, n_rows, f, *args, **kwargs):
+    """Time a stage, record its rows/s and peak RSS, and return its output"""
+    with PeakRss() as rss:
+        start = time.time()
+        output = f(*args, **kwargs)
+        t = time.time() - start
+    results[name] = {"seconds": round(t, 3), "rows_per_s": round(n_rows / t),
+                     "peak_rss_mb": round(rss.peak / 2**20, 1)}
+    print(f"{name:<24}{t:8.2f}s {n_rows/t:>12,.0f} rows/s "
+          f"{rss.peak/2**20:>8.0f} MB peak RSS")
+    return output
+
+
+def download(server):
+    with mock.patch.multiple(utils, **server.urls()):
+        return [f.getvalue() for _, f in
+                utils._zipfiles_on_pages(username=USERNAME, pwd=PWD)]
+
+
+def decompress(archives):
+    csvs = []
+    for archive in archives:
+        with ZipFile(BytesIO(archive)) as zf:
+            for fname in zf.namelist():
+                with zf.open(fname) as z:
+                    for _, f in stream_zip_members(z):
+                        csvs.append((fname.split("_")[0], f.read()))
+    return csvs
+
+
+def parse(csvs, chunksize):
+    chunks = []
+    for tablename, csv in csvs:
+        _class = get_class_by_tablename(Base, tablename)
+        chunks += [(_class, chunk) for chunk in
+                   read_chunks(BytesIO(csv), chunksize=chunksize, _class=_class)]
+    return chunks
+
+
+def convert(chunks):
+    return [(_class, chunk_to_batch(chunk, _class)) for _class, chunk in chunks]
+
+
+def insert(db_url, batches):
+    with PatstatLoader(db_url, Base, resume=False) as loader:
+        try:
+            for _class, batch in batches:
+                loader.write(_class, batch)
+        finally:
+            Base.metadata.drop_all(loader.engine)
+
+
+def end_to_end(server, db_url, chunksize, pipeline=False):
+    with mock.patch.multiple(utils, **server.urls()):
+        try:
+            _download_patstat_to_db(db_url, Base, chunksize=chunksize,
+                                    resume=False, pipeline=pipeline,
+                                    username=USERNAME, pwd=PWD)
+        finally:
+            with PatstatLoader(db_url, Base, create_db=False, resume=False) as loader:
+                Base.metadata.drop_all(loader.engine)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(RESULTS_PATH),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(record, results_path):
+    """Compare a run against the previous run with the same parameters"""
+    previous = None
+    if os.path.isfile(results_path):
+        with open(results_path) as f:
+            for line in f:
+                _record = json.loads(line)
+                if _record["params"] == record["params"]:
+                    previous = _record
+    if previous is None:
+        print("No previous run with these parameters to compare against")
+        return
+    print(f"Compared with {previous['commit']} ({previous['time']}):")
+    for name, stage in record["stages"].items():
+        if name not in previous["stages"]:
+            continue
+        before = previous["stages"][name]["rows_per_s"]
+        change = stage["rows_per_s"] / before - 1
+        flag = "  <-- REGRESSION" if change < -REGRESSION_THRESHOLD else ""
+        print(f"{name:<24}{change:+8.1%}{flag}")
+
+
+def main(n_rows, chunksize, db_urls, results_path):
+    archives, table_rows = fake_archives(n_rows)
+    total = sum(table_rows.values())
+    print(f"{total:,} rows in {len(archives)} archives of "
+          f"{sum(map(len, archives.values()))/2**20:.1f} MB")
+    stages = {}
+    with FakeEpoServer(archives) as server:
+        downloaded = run_stage(stages, "download", total, download, server)
+        csvs = run_stage(stages, "decompress", total, decompress, downloaded)
+        chunks = run_stage(stages, "parse", total, parse, csvs, chunksize)
+        batches = run_stage(stages, "convert", total, convert, chunks)
+        del downloaded, csvs, chunks
+        for dialect, db_url in db_urls.items():
+            run_stage(stages, f"insert ({dialect})", total, insert, db_url, batches)
+        del batches
+        for dialect, db_url in db_urls.items():
+            run_stage(stages, f"end to end ({dialect})", total, end_to_end,
+                      server, db_url, chunksize)
+            run_stage(stages, f"pipelined ({dialect})", total, end_to_end,
+                      server, db_url, chunksize, pipeline=True)
+    record = {"time": datetime.now().isoformat(timespec="seconds"),
+              "commit": git_commit(),
+              "params": {"n_rows": n_rows, "chunksize": chunksize},
+              "stages": stages}
+    compare(record, results_path)
+    with open(results_path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_rows", type=int, default=100000,
+                        help="Number of tls201 rows, other tables are scaled")
+    parser.add_argument("--chunksize", type=int, default=10000)
+    parser.add_argument("--postgres_url",
+                        default=os.environ.get("PYPATSTAT_TEST_POSTGRES_URL"))
+    parser.add_argument("--mysql_url",
+                        default=os.environ.get("PYPATSTAT_TEST_MYSQL_URL"))
+    parser.add_argument("--results", default=RESULTS_PATH)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_urls = {"sqlite": f"sqlite:///{tmp_dir}/bench.db"}
+        if args.postgres_url is not None:
+            db_urls["postgresql"] = args.postgres_url
+        if args.mysql_url is not None:
+            db_urls["mysql"] = args.mysql_url
+        main(args.n_rows, args.chunksize, db_urls, args.results)
@@ -0,0 +1,124 @@
+'''A local stand-in for the EPO raw data website, for testing and
+benchmarking the downloaders without a PATSTAT subscription.'''
+
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+import threading
+import time
+import uuid
+
+USERNAME = "username@something.com"
+PWD = "mypassword"
+
+
+class FakeEpoServer:
+    """Serve zipfiles behind a fake PATSTAT login, with Range support.
+
+    Args:
+        zipfiles (dict): Zipfile contents (bytes) by file name.
+        bandwidth (int): Bytes per second per connection (None for unlimited).
+        session_lifetime (float): Seconds before a login cookie expires.
+    """
+    def __init__(self, zipfiles, bandwidth=None, session_lifetime=None):
+        self.zipfiles = zipfiles
+        self.bandwidth = bandwidth
+        self.session_lifetime = session_lifetime
+        self.sessions = {}
+        self.n_logins = 0
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), _make_handler(self))
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever,
+                                        daemon=True)
+
+    @property
+    def top_url(self):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}/raw-data"
+
+    def urls(self):
+        """Values with which to patch the URL constants in `utils`"""
+        return dict(TOP_URL=self.top_url,
+                    AUTH_URL=f"{self.top_url}/authentication",
+                    RAW_DATA_URL=f"{self.top_url}/product?productId=86")
+
+    def is_logged_in(self, cookie):
+        if cookie is None or cookie not in self.sessions:
+            return False
+        if self.session_lifetime is None:
+            return True
+        return time.time() - self.sessions[cookie] < self.session_lifetime
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def _make_handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _cookie(self):
+            cookie = self.headers.get("Cookie", "")
+            for item in cookie.split(";"):
+                key, _, value = item.strip().partition("=")
+                if key == "session":
+                    return value
+            return None
+
+        def _send(self, body, status=200, headers={}):
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.end_headers()
+            self._write(body)
+
+        def _write(self, body, block=2**16):
+            for i in range(0, len(body), block):
+                self.wfile.write(body[i:i+block])
+                if server.bandwidth is not None:
+                    time.sleep(block/server.bandwidth)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            form = parse_qs(self.rfile.read(length).decode())
+            if form.get("login") != [USERNAME] or form.get("pwd") != [PWD]:
+                return self._send(b"Invalid login")
+            cookie = uuid.uuid4().hex
+            server.sessions[cookie] = time.time()
+            server.n_logins += 1
+            self._send(f"Logged in as {USERNAME}".encode(),
+                       headers={"Set-Cookie": f"session={cookie}; Path=/"})
+
+        def do_GET(self):
+            path = self.path.split("/raw-data/", 1)[-1]
+            if path.startswith("authentication"):
+                return self._send(b"Please log in")
+            if not server.is_logged_in(self._cookie()):
+                self.send_response(302)
+                self.send_header("Location", "/raw-data/authentication")
+                self.send_header("Content-Length", "0")
+                return self.end_headers()
+            if path.startswith("product"):
+                anchors = "".join(f"<a href='download/{name}'>{name}</a>"
+                                  for name in server.zipfiles)
+                return self._send(f"<html>{anchors}</html>".encode())
+            name = path[len("download/"):]
+            if name not in server.zipfiles:
+                return self._send(b"Not found", status=404)
+            body = server.zipfiles[name]
+            byte_range = self.headers.get("Range")
+            if byte_range is None:
+                return self._send(body)
+            start = int(byte_range.split("=")[1].split("-")[0])
+            if start >= len(body):
+                return self._send(b"", status=416)
+            self._send(body[start:], status=206, headers={
+                "Content-Range": f"bytes {start}-{len(body)-1}/{len(body)}"})
+    return Handler
@@ -0,0 +1,169 @@
+'''Generate synthetic PATSTAT archives: zipfiles of nested, zipped CSV files
+laid out as the EPO ships them, with columns typed and valued as in the ORM.
+
+Usage:
+    python -m pypatstat.etl.benchmarks.synthetic --n_rows 100000 --out_dir /tmp/patstat
+'''
+
+from pypatstat.etl.dtypes import sql_type_name
+from pypatstat.etl.orms.patstat_2019_05_13 import Base
+from io import BytesIO
+from zipfile import ZipFile
+from zipfile import ZIP_DEFLATED
+from zipfile import ZIP_STORED
+import argparse
+import numpy as np
+import os
+import pandas as pd
+
+EDITION = "2019_05_13"
+# Relative size of each table in a real edition, against tls201
+TABLE_SCALES = {"tls201_appln": 1.0, "tls202_appln_title": 0.8,
+                "tls203_appln_abstr": 0.5, "tls204_appln_prior": 0.4,
+                "tls206_person": 0.6, "tls207_pers_appln": 2.5,
+                "tls209_appln_ipc": 2.3, "tls211_pat_publn": 1.2,
+                "tls212_citation": 2.4}
+AUTHORITIES = ["EP", "US", "CN", "JP", "KR", "DE", "WO", "GB", "FR", "CA"]
+FLAGS = ["Y", "N"]
+NULL_FRACTION = 0.05
+SENTINEL_DATE_FRACTION = 0.02
+MAX_TEXT_LENGTH = 1000  # Abstracts are NVARCHAR(max), but rarely longer
+MAX_STRING_LENGTH = 20
+NA_STRINGS = {"NA", "NAN", "NULL", "NONE"}  # Which pandas would read as null
+
+
+def _strings(rng, n_rows, length):
+    """Random alphanumeric strings, of up to `length` characters"""
+    alphabet = np.array(list("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 "))
+    lengths = rng.randint(1, length + 1, n_rows)
+    chars = alphabet[rng.randint(0, len(alphabet), lengths.sum())]
+    ends = np.cumsum(lengths)
+    text = "".join(chars)
+    strings = [text[end - n:end].strip() for n, end in zip(lengths, ends)]
+    return [s if s and s not in NA_STRINGS else "X" for s in strings]
+
+
+def fake_column(column, n_rows, rng, start_id=1):
+    """Values for an ORM column, distributed roughly as in PATSTAT: sequential
+    IDs for the leading PK, years, two letter authority codes, Y/N flags,
+    dates (with PATSTAT's '9999-12-31' sentinel) and strings within the
+    column's length.
+
+    Args:
+        column (:obj:`sqlalchemy.Column`): An ORM column.
+        n_rows (int): Number of values.
+        rng (:obj:`np.random.RandomState`): Random number generator.
+        start_id (int): The first value of a leading PK column.
+    Returns:
+        values (list or :obj:`np.array`)
+    """
+    type_name = sql_type_name(column)
+    length = getattr(column.type, "length", None)
+    if type_name in ("INT", "INTEGER", "BIGINT"):
+        if column.primary_key and list(column.table.primary_key.columns)[0] is column:
+            return np.arange(start_id, start_id + n_rows)
+        return rng.randint(1, 10**8, n_rows)
+    if type_name in ("SMALLINT", "TINYINT"):
+        if column.name.endswith("_year"):
+            return rng.randint(1900, 2020, n_rows)
+        return rng.randint(0, 100, n_rows)
+    if type_name in ("REAL", "FLOAT"):
+        return rng.random_sample(n_rows).round(4)
+    if type_name == "DATE":
+        days = rng.randint(0, 365 * 120, n_rows).astype("timedelta64[D]")
+        dates = (np.datetime64("1900-01-01") + days).astype(str).astype(object)
+        dates[rng.random_sample(n_rows) < SENTINEL_DATE_FRACTION] = "9999-12-31"
+        return dates
+    if length == 1:
+        return rng.choice(FLAGS, n_rows)
+    if length == 2:
+        return rng.choice(AUTHORITIES, n_rows)
+    if length is None or length > MAX_TEXT_LENGTH:
+        return _strings(rng, n_rows, MAX_TEXT_LENGTH)
+    return _strings(rng, n_rows, min(length, MAX_STRING_LENGTH))
+
+
+def fake_table(_class, n_rows, seed=0, start_id=1):
+    """A DataFrame of synthetic rows for a table, with unique PKs and about
+    5% nulls in the non-PK columns"""
+    rng = np.random.RandomState(seed)
+    df = pd.DataFrame({col.name: fake_column(col, n_rows, rng, start_id=start_id)
+                       for col in _class.__table__.columns})
+    for col in _class.__table__.columns:
+        if not col.primary_key:
+            values = df[col.name].astype(object)
+            values[rng.random_sample(n_rows) < NULL_FRACTION] = None
+            df[col.name] = values
+    return df
+
+
+def nested_zipfile(csv_name, df):
+    """A zipped CSV, as nested in the PATSTAT archives"""
+    bio = BytesIO()
+    with ZipFile(bio, "w", compression=ZIP_DEFLATED) as zf:
+        zf.writestr(csv_name, df.to_csv(index=False))
+    return bio.getvalue()
+
+
+def fake_archives(n_rows=10000, tables=None, n_parts=2, n_archives=2,
+                  edition=EDITION, seed=0):
+    """Synthetic PATSTAT archives, with the nested files of each table split
+    across parts, and the parts spread across archives.
+
+    Args:
+        n_rows (int): Number of tls201 rows. Other tables are scaled by
+                      `TABLE_SCALES`.
+        tables (list): Names of the tables to generate. Defaults to all of
+                       `TABLE_SCALES`.
+        n_parts (int): Number of nested files per table.
+        n_archives (int): Number of archives.
+        edition (str): Datestamp by which to name the archives.
+        seed (int): Random seed.
+    Returns:
+        archives, n_rows (dict, dict): Archive contents (bytes) by file name,
+                                       and number of rows by table name.
+    """
+    classes = {c.__tablename__: c for c in Base._decl_class_registry.values()
+               if hasattr(c, "__tablename__")}
+    tables = list(TABLE_SCALES) if tables is None else tables
+    nested = [[] for _ in range(n_archives)]
+    table_rows = {}
+    for i, tablename in enumerate(tables):
+        table_rows[tablename] = int(n_rows * TABLE_SCALES.get(tablename, 1))
+        prefix = tablename.split("_")[0]
+        bounds = np.linspace(0, table_rows[tablename], n_parts + 1).astype(int)
+        for part, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+            df = fake_table(classes[tablename], end - start, seed=seed + i + part,
+                            start_id=start + 1)
+            name = f"{prefix}_part{part + 1:02d}"
+            nested[part % n_archives].append((f"{name}.zip",
+                                              nested_zipfile(f"{name}.csv", df)))
+    archives = {}
+    for i, files in enumerate(nested):
+        bio = BytesIO()
+        with ZipFile(bio, "w", compression=ZIP_STORED) as zf:
+            for fname, data in files:
+                zf.writestr(fname, data)
+        archives[f"data_PATSTAT_Global_{edition}_{i + 1:02d}.zip"] = bio.getvalue()
+    return archives, table_rows
+
+
+def main(out_dir, n_rows, n_parts, n_archives):
+    os.makedirs(out_dir, exist_ok=True)
+    archives, table_rows = fake_archives(n_rows, n_parts=n_parts,
+                                         n_archives=n_archives)
+    for name, data in archives.items():
+        with open(os.path.join(out_dir, name), "wb") as f:
+            f.write(data)
+        print(f"{name:<40}{len(data)/2**20:.1f} MB")
+    print(f"{sum(table_rows.values()):,} rows in total")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out_dir", default=".")
+    parser.add_argument("--n_rows", type=int, default=100000)
+    parser.add_argument("--n_parts", type=int, default=2)
+    parser.add_argument("--n_archives", type=int, default=2)
+    args = parser.parse_args()
+    main(args.out_dir, args.n_rows, args.n_parts, args.n_archives)
@@ -0,0 +1,63 @@
+'''A journal of load progress, kept in the database itself and committed in
+the same transaction as each batch, so that a restarted load can resume
+from exactly the first uncommitted row.'''
+
+from sqlalchemy import MetaData
+from sqlalchemy import Table
+from sqlalchemy import Column
+from sqlalchemy import and_
+from sqlalchemy.types import BigInteger
+from sqlalchemy.types import Boolean
+from sqlalchemy.types import String
+
+ARCHIVE_DONE = ""  # Member name recording that a whole archive is complete
+
+metadata = MetaData()
+checkpoint_table = Table("pypatstat_checkpoint", metadata,
+                         Column("archive", String(255), primary_key=True),
+                         Column("member", String(255), primary_key=True),
+                         Column("rows_committed", BigInteger, nullable=False),
+                         Column("complete", Boolean, nullable=False))
+
+
+class Checkpoints:
+    """Progress of the load through each (archive, nested file) pair.
+
+    Args:
+        engine: An SQLalchemy engine for the PATSTAT database.
+    """
+    def __init__(self, engine):
+        metadata.create_all(engine)
+        rows = engine.execute(checkpoint_table.select()).fetchall()
+        self.progress = {(row.archive, row.member): (row.rows_committed,
+                                                     row.complete)
+                         for row in rows}
+
+    def rows_committed(self, archive, member):
+        """Number of CSV rows of the nested file already committed"""
+        return self.progress.get((archive, member), (0, False))[0]
+
+    def is_complete(self, archive, member=ARCHIVE_DONE):
+        """Has the nested file (or by default the whole archive) been loaded?"""
+        return self.progress.get((archive, member), (0, False))[1]
+
+    def update(self, conn, archive, member=ARCHIVE_DONE, rows_committed=0,
+               complete=False):
+        """Record progress, within the transaction of the connection.
+
+        Args:
+            conn (:obj:`sqlalchemy.engine.Connection`): An open connection.
+            archive (str): URL of the archive.
+            member (str): Name of the nested file.
+            rows_committed (int): Number of CSV rows of the member loaded.
+            complete (bool): Has the nested file been completely loaded?
+        """
+        values = dict(rows_committed=rows_committed, complete=complete)
+        where = and_(checkpoint_table.c.archive == archive,
+                     checkpoint_table.c.member == member)
+        result = conn.execute(checkpoint_table.update().where(where)
+                              .values(**values))
+        if result.rowcount == 0:
+            conn.execute(checkpoint_table.insert()
+                         .values(archive=archive, member=member, **values))
+        self.progress[(archive, member)] = (rows_committed, complete)
@@ -1,44 +1,169 @@
 from pypatstat.etl.utils import login
 from pypatstat.etl.utils import _zipfiles_on_pages
-from pypatstat.etl.utils import files_in_zipfile
-from pypatstat.etl.schema_maker import generate_schema
+from pypatstat.etl.utils import stream_zip_members
+from pypatstat.etl.utils import fork_context
+from pypatstat.etl.schema_maker import patstat_base
 from pypatstat.etl.schema_maker import INDEX_DOC_STR
-from pydoc import locate
+from pypatstat.etl.schema_maker import project_base
+from pypatstat.etl.dtypes import csv_dtypes
+from pypatstat.etl.dtypes import parse_dates
+from pypatstat.etl.dtypes import to_python_values
+from pypatstat.etl.backends import get_backend
+from pypatstat.etl.pk_index import PkIndex
+from pypatstat.etl.checkpoint import Checkpoints
+from pypatstat.etl.fast_load import keyless_metadata
+from pypatstat.etl.fast_load import relax_session_checks
+from pypatstat.etl.fast_load import build_keys
+from pypatstat.etl.metrics import Metrics
+from pypatstat.etl.metrics import MetricsReporter
+from pypatstat.etl.metrics import timed
+from pypatstat.etl.profiling import Profiler
+from pypatstat.etl.pipeline import queue_depths
+from pypatstat.etl.pipeline import prefetch
+from pypatstat.etl.pipeline import prefetch_process
+from pypatstat.etl.pipeline import prefetch_reader
+from pypatstat.etl.batch_sizer import BatchSizer
+from pypatstat.etl.batch_sizer import packet_limit
+from pypatstat.etl.memory import MemoryBudget
+from pypatstat.etl.memory import BATCH_OVERHEAD
+from pypatstat.etl.memory import chunk_nbytes
+from pypatstat.etl.memory import in_memory_bytes
+from pypatstat.etl.filters import APPLN_TABLE
+from pypatstat.etl.filters import APPLN_IDS
+from pypatstat.etl.filters import PROPAGATED_IDS
+from pypatstat.etl.filters import RowFilter
+from pypatstat.etl.filters import collect_ids
+from pypatstat.etl.filters import filter_key
+from pypatstat.etl.filters import row_mask
 from sqlalchemy import create_engine
 from sqlalchemy.exc import OperationalError
-from sqlalchemy.orm import sessionmaker
 from sqlalchemy_utils import database_exists
 from sqlalchemy_utils import create_database
+from collections import defaultdict
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+from contextlib import closing
+from contextlib import contextmanager
+from functools import partial
+from zipfile import BadZipFile
+from zipfile import ZipFile
+import csv
 import logging
-from io import BytesIO
+import numpy as np
+import os
 import pandas as pd
+import shutil
+import tempfile
 import time
 
-def is_null_pk(x):
-    """PK deemed to be null if it is either whitespace, None or zero"""
-    if type(x) is str:
-        return x.strip() == ''
-    return x in (None, 0)
-    
+class Batch(namedtuple("Batch", ["columns", "values"])):
+    """A batch of rows to write, held as one (object) array per column"""
+    __slots__ = ()
 
-def iterchunks(zipped_csv, chunksize=1000):
-    """Iterate through a zipped CSV file in chunks
+    @property
+    def n_rows(self):
+        return len(self.values[0]) if len(self.values) > 0 else 0
+
+    @property
+    def rows(self):
+        """Rows of the batch, as tuples ordered by `columns`"""
+        return list(zip(*self.values))
+
+    def filter(self, mask):
+        """Select the rows of the batch by a boolean mask"""
+        return Batch(self.columns, [v[mask] for v in self.values])
+
+
+def null_pk_mask(chunk, _class):
+    """Flag rows whose PK is null: i.e. every PK field is either whitespace,
+    None or zero.
+
+    Args:
+        chunk (:obj:`pd.DataFrame`): A chunk of the CSV.
+        _class: SQLalchemy ORM object.
+    Returns:
+        mask (:obj:`np.array`): True for rows with a null PK.
+    """
+    mask = np.ones(len(chunk), dtype=bool)
+    for pkey in _class.__table__.primary_key.columns:
+        col = chunk[pkey.name]
+        if pd.api.types.is_numeric_dtype(col):
+            is_null = col.isnull() | (col == 0)
+        else:
+            is_null = col.isnull() | (col.astype(str).str.strip() == '')
+        mask &= is_null.to_numpy(dtype=bool)
+    return mask
+
+
+def chunk_to_batch(chunk, _class):
+    """Convert a chunk of the CSV into a :obj:`Batch` to write, dropping rows
+    with null PKs and mapping null values to None.
+
+    Args:
+        chunk (:obj:`pd.DataFrame`): A chunk of the CSV.
+        _class: SQLalchemy ORM object.
+    Returns:
+        batch (:obj:`Batch`): Rows of the chunk.
+    """
+    chunk = chunk.loc[~null_pk_mask(chunk, _class)]
+    columns = list(chunk.columns)
+    values = [to_python_values(chunk[col]) for col in columns]
+    return Batch(columns, values)
+
+
+def read_chunks(f, chunksize=1000, _class=None, skiprows=0):
+    """Iterate through a CSV file in chunks.
 
     Args:
-        zipped_csv (ZipFile): A zipped CSV file object.
+        f (file): A readable binary CSV file object.
+        chunksize (int or function): Size parameter to pass to
+                                     :obj:`pd.read_csv`, or a function
+                                     returning the size of the next chunk.
+        _class: SQLalchemy ORM object, from which to take the columns to
+                read and their types. If not specified, every column is
+                read, with its type guessed by pandas.
+        skiprows (int): Number of rows (after the header) to skip.
+    Yields:
+        chunk (:obj:`pd.DataFrame`): A chunk of the CSV.
+    """
+    dtypes, date_columns = (None, []) if _class is None else csv_dtypes(_class)
+    kwargs = {}
+    if skiprows > 0:
+        # Read the header ourselves, so that pandas can skip rows by count
+        header = f.readline().decode("utf-8-sig")
+        kwargs = dict(header=None, names=next(csv.reader([header])),
+                      skiprows=skiprows)
+    if dtypes is not None:
+        # Columns not in the ORM, e.g. left out by project_base, aren't decoded
+        kwargs["usecols"] = dtypes.__contains__
+    if not callable(chunksize):
+        for chunk in pd.read_csv(f, chunksize=chunksize, dtype=dtypes, **kwargs):
+            yield parse_dates(chunk, date_columns)
+        return
+    with pd.read_csv(f, iterator=True, dtype=dtypes, **kwargs) as reader:
+        while True:
+            try:
+                chunk = reader.get_chunk(chunksize())
+            except StopIteration:
+                return
+            yield parse_dates(chunk, date_columns)
+
+
+def iterchunks(zipped_csv, chunksize=1000, _class=None):
+    """Iterate through a zipped CSV file in chunks, streaming the CSV
+    straight out of the decompressor.
+
+    Args:
+        zipped_csv (file): A readable (zipped CSV) file object.
         chunksize (int): Size parameter to pass to :obj:`pd.read_csv`.
+        _class: SQLalchemy ORM object, from which to take the column types.
+                If not specified, the types are guessed by pandas.
     Yields:
-        rows (list): Rows of the CSV.
+        chunk (:obj:`pd.DataFrame`): A chunk of the CSV.
     """
-    with BytesIO(zipped_csv.read()) as zio:
-        for _, f in files_in_zipfile(zio):
-            for chunk in pd.read_csv(f, chunksize=chunksize):
-                rows = []
-                for idx, row in chunk.iterrows():
-                    row = {k:(v if not pd.isnull(v) else None)
-                           for k, v in row.items()}
-                    rows.append(row)
-                yield rows
+    for _, f in stream_zip_members(zipped_csv):
+        yield from read_chunks(f, chunksize=chunksize, _class=_class)
 
 
 def get_class_by_tablename(Base, tablename):
@@ -58,7 +183,7 @@ def get_class_by_tablename(Base, tablename):
     raise NameError(tablename)
 
 
-def try_until_allowed(f, max_tries=1000, *args, **kwargs):
+def try_until_allowed(f, *args, max_tries=1000, **kwargs):
     '''Keep trying a function if a OperationalError is raised.
     Specifically meant for handling too many
     connections to a database.
@@ -77,30 +202,691 @@ def try_until_allowed(f, max_tries=1000, *args, **kwargs):
     raise OperationalError
 
 
-def make_pk(row, _class):
-    """Generate the primary key for this row based on ORM PK info"""
+def make_pks(batch, _class):
+    """Generate the primary keys for this batch based on ORM PK info"""
     pkey_cols = _class.__table__.primary_key.columns
-    pk = tuple([row[pkey.name]                       # Cast to str since
-                if pkey.type.python_type is not str  # pd can wrongly guess
-                else str(row[pkey.name])             # the type as int
-                for pkey in pkey_cols])
-    return pk
+    return list(zip(*(batch.values[batch.columns.index(pkey.name)]
+                      for pkey in pkey_cols)))
 
 
-def pk_chunks(session, _class, chunksize=100000):
-    """Yield chunks of primary keys from the database via the table-ORM"""
-    pkey_cols = _class.__table__.primary_key.columns
-    fields = [getattr(_class, pkey.name)
-              for pkey in pkey_cols]
-    q = session.query(*fields)
-    offset = 0
-    while offset == 0 or len(pks) == chunksize:
-        pks = q.limit(chunksize).offset(offset).all()
-        yield set(pks)
-        offset += chunksize
+class PatstatLoader:
+    """Write PATSTAT data to a database over a single engine, whose connection
+    pool is reused for the whole run. The database and its tables are
+    created once, up front.
+
+    Args:
+        db_url (str): Database connection string.
+        Base: SQLalchemy ORM Base object.
+        create_db (bool): Create the database if it doesn't exist?
+        bulk (bool): Use the database's native bulk load, if there is one?
+        resume (bool): Journal progress in the database, and skip whatever
+                       a previous run has already committed?
+        fast_load (bool): Create the tables without keys or indexes, and relax
+                          per-session checks, until :obj:`build_keys` is called.
+        defer_indexes (bool): Create the tables with their primary keys but
+                              without secondary indexes, until
+                              :obj:`build_keys` is called.
+        profile_dir (str): Profile a sample of each table's chunks, writing
+                           the profiles and their summaries to this directory.
+        profile_chunks (int): Number of chunks to profile per table.
+        profile_fraction (float): Fraction of chunks to profile, at random,
+                                  instead of the first `profile_chunks`.
+        profile_mode (str): "cprofile" or "sample", see :obj:`Profiler`.
+        auto_chunksize (bool): Size each table's chunks by bytes, within the
+                               server's packet limit, tuned by the time taken
+                               to insert them. See :obj:`BatchSizer`.
+        max_memory (int or str): Budget for the memory held in buffers and
+                                 caches, in bytes or e.g. "4GB". Chunks are
+                                 capped in size, and PK indexes beyond their
+                                 share are spilled to disk. See
+                                 :obj:`MemoryBudget`.
+        spill_dir (str): Directory for spilled temporary files.
+        row_filter (:obj:`RowFilter`): Load only the rows which it keeps, see
+                                       :obj:`build_row_filter`.
+    """
+    def __init__(self, db_url, Base, create_db=True, bulk=True, resume=True,
+                 fast_load=False, defer_indexes=False, profile_dir=None,
+                 profile_chunks=3, profile_fraction=None,
+                 profile_mode="cprofile", auto_chunksize=False,
+                 max_memory=None, spill_dir=None, row_filter=None):
+        self.db_url = db_url
+        self.Base = Base
+        self.fast_load = fast_load
+        self.options = dict(bulk=bulk, resume=resume, fast_load=fast_load,
+                            defer_indexes=defer_indexes,
+                            profile_dir=profile_dir,
+                            profile_chunks=profile_chunks,
+                            profile_fraction=profile_fraction,
+                            profile_mode=profile_mode,
+                            auto_chunksize=auto_chunksize,
+                            max_memory=max_memory, spill_dir=spill_dir)
+        self.backend = get_backend(db_url, bulk=bulk)
+        self.engine = create_engine(db_url, pool_pre_ping=True,
+                                    connect_args=self.backend.connect_args)
+        if create_db and not database_exists(self.engine.url):
+            create_database(self.engine.url)
+        if fast_load:
+            relax_session_checks(self.engine)
+            try_until_allowed(keyless_metadata(Base).create_all, self.engine)
+        elif defer_indexes:
+            try_until_allowed(keyless_metadata(Base, primary_keys=True).create_all,
+                              self.engine)
+        else:
+            try_until_allowed(Base.metadata.create_all, self.engine)
+        self.pk_indexes = {}
+        self.checkpoints = Checkpoints(self.engine) if resume else None
+        self.metrics = Metrics()
+        self.profiler = Profiler(profile_dir, n_chunks=profile_chunks,
+                                 fraction=profile_fraction, mode=profile_mode)
+        self.row_filter = row_filter
+        self.memory = None
+        if max_memory is not None:
+            self.memory = MemoryBudget(max_memory, spill_dir=spill_dir)
+        self.batch_sizer = None
+        if auto_chunksize:
+            max_bytes = try_until_allowed(packet_limit, self.backend, self.engine)
+            if self.memory is not None:
+                max_bytes = min(max_bytes, self.memory.chunk_bytes)
+            self.batch_sizer = BatchSizer(max_bytes=max_bytes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close all pooled connections"""
+        self.engine.dispose()
+
+    def build_keys(self, n_workers=4):
+        """Build the primary keys and indexes deferred by `fast_load` or
+        `defer_indexes`, in parallel across tables"""
+        build_keys(self.engine, self.Base, n_workers=n_workers)
+
+    def filter_existing(self, _class, batch):
+        """Remove rows from the batch whose PKs are already in the database,
+        as found in an index of the table's PKs which is loaded once"""
+        tablename = _class.__tablename__
+        index = self.pk_indexes.get(tablename)
+        if index is None:
+            logging.info(f'Loading existing PKs for {tablename}')
+            options = {}
+            if self.memory is not None:  # Spill as it loads, if need be
+                options = dict(max_bytes=self.memory.room("pk_index"),
+                               spill_dir=self.memory.spill_dir)
+            index = try_until_allowed(PkIndex.from_db, self.engine, _class,
+                                      **options)
+            self.pk_indexes[tablename] = index
+            if self.memory is not None:
+                self.memory.acquire("pk_index", index.nbytes, wait=False)
+                self.spill_pk_indexes(in_use=tablename)
+        n_rows = batch.n_rows
+        batch = batch.filter(~index.contains(batch))
+        logging.info(f'Removing {n_rows - batch.n_rows} '
+                     'rows before insert.')
+        return batch
+
+    def spill_pk_indexes(self, in_use=None):
+        """Spill PK indexes to disk, largest first, until they fit within
+        their share of the memory budget. Indexes which can't be spilled are
+        dropped instead, to be reloaded if needed again, apart from the one
+        `in_use`, which stays over budget until another is loaded."""
+        by_size = sorted(self.pk_indexes.items(), key=lambda item: item[1].nbytes,
+                         reverse=True)
+        for tablename, index in by_size:
+            if not self.memory.over("pk_index"):
+                return
+            n_bytes = index.nbytes
+            if n_bytes == 0:  # Already spilled
+                continue
+            if index.spill(self.memory.spill_dir):
+                logging.info(f"\t\tSpilled {n_bytes} bytes of PKs for {tablename}")
+            elif tablename == in_use:
+                continue
+            else:
+                logging.info(f"\t\tDropped {n_bytes} bytes of PKs for {tablename}")
+                del self.pk_indexes[tablename]
+            self.memory.release("pk_index", n_bytes)
+
+    def filter_rows(self, _class, chunk):
+        """Drop the rows of a chunk which the row filter doesn't keep"""
+        mask = self.row_filter.mask(_class, chunk)
+        if mask is None:
+            return chunk
+        self.metrics.inc("rows_dropped_filter", len(chunk) - mask.sum(),
+                         table=_class.__tablename__)
+        return chunk.loc[mask]
+
+    def write(self, _class, batch, filter_pks=False, checkpoint=None):
+        """Bulk write a batch of rows to the table, in a single transaction.
+
+        Args:
+            _class: SQLalchemy ORM object.
+            batch (:obj:`Batch`): Rows of data to write, with null PKs removed.
+            filter_pks (bool): Skip rows whose PKs are already in the table?
+                               Where possible the database skips them itself,
+                               otherwise (and always for keyless `fast_load`
+                               tables) existing PKs are filtered out first.
+            checkpoint (dict): Arguments for :obj:`Checkpoints.update`, to
+                               record in the same transaction as the batch.
+        Returns:
+            n_rows (int): The number of rows sent to the database.
+        """
+        tablename = _class.__tablename__
+        skip_duplicates = filter_pks and not self.fast_load and \
+            self.backend.can_skip_duplicates(self.engine.dialect)
+        n_rows = batch.n_rows
+        if filter_pks and not skip_duplicates:
+            batch = self.filter_existing(_class, batch)
+        if batch.n_rows == 0 and checkpoint is None:
+            self.metrics.inc("rows_dropped_duplicate", n_rows, table=tablename)
+            return 0
+        n_inserted = 0
+        start = time.time()
+        with self.metrics.latency("insert", table=tablename):
+            with try_until_allowed(self.engine.connect) as conn, conn.begin():
+                if batch.n_rows > 0:
+                    n_inserted = self.backend.insert(conn, _class.__table__, batch,
+                                                     skip_duplicates=skip_duplicates)
+                if checkpoint is not None:
+                    self.checkpoints.update(conn, **checkpoint)
+        if self.batch_sizer is not None:
+            self.batch_sizer.observe_insert(tablename, batch.n_rows,
+                                            time.time() - start)
+        self.metrics.inc("rows_inserted", n_inserted, table=tablename)
+        self.metrics.inc("rows_dropped_duplicate", n_rows - n_inserted,
+                         table=tablename)
+        return batch.n_rows
+
+    def checkpoint(self, **checkpoint):
+        """Record progress outside of any batch"""
+        with self.engine.begin() as conn:
+            self.checkpoints.update(conn, **checkpoint)
+
+    def iter_nested_file(self, zf, fname, chunksize=1000, filter_pks=False,
+                         archive=None, prefetch_depth=0):
+        """Read one nested (zipped CSV) file of a zipfile in chunks, ready
+        to be written in order with :obj:`write_item`. Checkpoints are
+        written with each chunk, and once the whole of each CSV is written.
+
+        Args:
+            zf (ZipFile): The open zipfile.
+            fname (str): Name of the nested file in the zipfile.
+            chunksize (int): Size parameter to pass to :obj:`pd.read_csv`,
+                             or with `auto_chunksize`, the size of each
+                             table's first chunk.
+            filter_pks (bool): Skip rows whose PKs are already in the table?
+            archive (str): Name (URL) of the zipfile, by which to journal
+                           progress. If not specified, progress isn't journaled.
+            prefetch_depth (int): Decompress up to this many blocks ahead of
+                                  the parser, in a background thread.
+        Yields:
+            tablename, chunk, filter_pks, checkpoint, n_bytes: The arguments
+                of :obj:`write_item`, with the bytes of the memory budget
+                reserved for the chunk.
+        """
+        journal = archive is not None and self.checkpoints is not None
+        logging.info(f"\tProcessing nested file {fname}...")
+        tablename = fname.split("_")[0]
+        _class = get_class_by_tablename(self.Base, tablename)
+        logging.info(f"\t\tRetrieved class from table name {tablename}.")
+        table = _class.__tablename__
+        if self.batch_sizer is not None:
+            chunksize = partial(self.batch_sizer.rows, table, chunksize)
+        if self.memory is not None:
+            chunksize = partial(self.memory.max_rows, table, chunksize)
+        with zf.open(fname) as z:
+            for csv_name, f in stream_zip_members(z):
+                member = f"{fname}/{csv_name}"
+                if journal and self.checkpoints.is_complete(archive, member):
+                    logging.info(f"\t\tAlready loaded {member}")
+                    continue
+                n_done = self.checkpoints.rows_committed(archive, member) \
+                    if journal else 0
+                if n_done > 0:
+                    logging.info(f"\t\tResuming {member} from row {n_done}")
+                with prefetch_reader(f, prefetch_depth, name="decompress",
+                                     metrics=self.metrics, table=table) as reader:
+                    chunks = read_chunks(reader, chunksize=chunksize,
+                                         _class=_class, skiprows=n_done)
+                    chunks = timed(chunks, self.metrics, "parse", table=table)
+                    for chunk in self.profiler.chunks(chunks, table):
+                        n_done += len(chunk)
+                        checkpoint = dict(archive=archive, member=member,
+                                          rows_committed=n_done) if journal else None
+                        self.metrics.inc("rows_parsed", len(chunk), table=table)
+                        if self.row_filter is not None:
+                            chunk = self.filter_rows(_class, chunk)
+                        n_bytes = None
+                        if self.memory is not None:
+                            n_bytes = chunk_nbytes(chunk)
+                            self.memory.observe_chunk(table, chunk, n_bytes)
+                            # Wait for the writer to catch up
+                            with self.metrics.timer("memory_wait", table=table):
+                                self.memory.acquire("chunks", n_bytes)
+                        yield (tablename, chunk, filter_pks, checkpoint, n_bytes)
+                self.metrics.inc("bytes_decompressed", f.raw.n_decompressed,
+                                 table=table)
+                with self.metrics.lock:
+                    self.metrics.timers["decompress", table] += f.raw.decompress_seconds
+                    if prefetch_depth == 0:
+                        # Decompression happened within parsing, as CSVs are streamed
+                        self.metrics.timers["parse", table] -= f.raw.decompress_seconds
+                if journal:
+                    yield (tablename, None, False,
+                           dict(archive=archive, member=member,
+                                rows_committed=n_done, complete=True), None)
+        self.metrics.inc("bytes_loaded", zf.getinfo(fname).compress_size)
+        self.profiler.dump(table)
+
+    def write_item(self, tablename, chunk, filter_pks=False, checkpoint=None,
+                   n_bytes=None):
+        """Convert and write a chunk from :obj:`iter_nested_file`, or just
+        write its checkpoint if there is no chunk. The `n_bytes` reserved
+        for the chunk are released once it's written: they're not measured
+        again, as a chunk sent from another process may differ in size."""
+        if chunk is None:
+            self.checkpoint(**checkpoint)
+            return 0
+        _class = get_class_by_tablename(self.Base, tablename)
+        table = _class.__tablename__
+        if self.batch_sizer is not None:
+            self.batch_sizer.observe_chunk(table, chunk)
+        if self.memory is None:
+            return self._convert_and_write(_class, chunk, filter_pks, checkpoint)
+        n_reserved = n_bytes or 0
+        if n_bytes is None:  # Not read with the budget
+            n_bytes = chunk_nbytes(chunk)
+        n_converted = n_bytes * BATCH_OVERHEAD
+        self.memory.acquire("chunks", n_converted, wait=False)
+        try:
+            return self._convert_and_write(_class, chunk, filter_pks, checkpoint)
+        finally:
+            self.memory.release("chunks", n_reserved + n_converted)
+            self.memory.record(self.metrics)
+
+    def _convert_and_write(self, _class, chunk, filter_pks, checkpoint):
+        table = _class.__tablename__
+        with self.metrics.timer("convert", table=table):
+            batch = chunk_to_batch(chunk, _class)
+        self.metrics.inc("rows_dropped_null_pk", len(chunk) - batch.n_rows,
+                         table=table)
+        return self.write(_class, batch, filter_pks=filter_pks,
+                          checkpoint=checkpoint)
+
+    def load_nested_file(self, zf, fname, chunksize=1000, filter_pks=False,
+                         archive=None):
+        """Write one nested (zipped CSV) file of a zipfile to the database.
+
+        Args:
+            zf (ZipFile): The open zipfile.
+            fname (str): Name of the nested file in the zipfile.
+            chunksize (int): Size parameter to pass to :obj:`pd.read_csv`.
+            filter_pks (bool): Skip rows whose PKs are already in the table?
+            archive (str): Name (URL) of the zipfile, by which to journal
+                           progress. If not specified, progress isn't journaled.
+        Returns:
+            n_rows (int): The number of rows written.
+        """
+        i = 0
+        for item in self.iter_nested_file(zf, fname, chunksize=chunksize,
+                                          filter_pks=filter_pks,
+                                          archive=archive):
+            i += self.write_item(*item)
+        logging.info(f"\t\tWritten {i} entries for {fname.split('_')[0]}.")
+        return i
+
+    def load_zipfile(self, zipfile, chunksize=1000, skip_table_prefixes=[],
+                     restart_filename=None, archive=None, n_workers=1,
+                     ordered=False):
+        """Write a zipfile contents (assumed zipped CSV) to the database.
+
+        Args:
+            zipfile (ZipFile): A zipfile, assumed to contained zipped CSVs.
+            chunksize (int): Size parameter to pass to :obj:`pd.read_csv`.
+            skip_table_prefixes (list): Skip table names with these prefixes.
+            restart_filename (str): Skip nested files until this one.
+            archive (str): Name (URL) of the zipfile, by which to journal
+                           progress. If not specified, progress isn't journaled.
+            n_workers (int): Number of processes with which to load nested
+                             files in parallel.
+            ordered (bool): When loading in parallel, load each table's nested
+                            files in order, one at a time?
+        """
+        tasks, complete = archive_tasks(zipfile, skip_table_prefixes,
+                                        restart_filename)
+        if n_workers > 1 and len(tasks) > 1:
+            self._load_in_parallel(zipfile, tasks, chunksize=chunksize,
+                                   archive=archive, n_workers=n_workers,
+                                   ordered=ordered)
+        elif len(tasks) > 0:
+            with ZipFile(zipfile) as zf:
+                for fname, restarting in tasks:
+                    self.load_nested_file(zf, fname, chunksize=chunksize,
+                                          filter_pks=restarting, archive=archive)
+        zipfile.close()
+        if complete and archive is not None and self.checkpoints is not None:
+            self.checkpoint(archive=archive, complete=True)
+
+    def _iter_zipfiles(self, zipfiles, chunksize, skip_table_prefixes,
+                       restart_filename, prefetch_depth):
+        """The items of each nested file of each zipfile, as
+        :obj:`iter_nested_file`, followed by each zipfile's checkpoint"""
+        for archive, zipfile in zipfiles:
+            logging.info(f"Processing file {archive}...")
+            tasks, complete = archive_tasks(zipfile, skip_table_prefixes,
+                                            restart_filename)
+            if len(tasks) > 0:
+                with ZipFile(zipfile) as zf:
+                    for fname, restarting in tasks:
+                        yield from self.iter_nested_file(
+                            zf, fname, chunksize=chunksize,
+                            filter_pks=restarting, archive=archive,
+                            prefetch_depth=prefetch_depth)
+            zipfile.close()
+            if complete and self.checkpoints is not None:
+                yield (None, None, False, dict(archive=archive, complete=True),
+                       None)
+
+    def _read_zipfiles(self, metrics, make_zipfiles, chunksize,
+                       skip_table_prefixes, restart_filename, depths):
+        """The read side of a pipelined load, run in a child process with its
+        own loader (for its own engine), see :obj:`load_zipfiles_pipelined`"""
+        loader = PatstatLoader(self.db_url, self.Base, create_db=False,
+                               **self.options)
+        loader.metrics = metrics
+        loader.batch_sizer = self.batch_sizer  # Tuned by the writer
+        loader.memory = self.memory  # Shared with the writer
+        loader.row_filter = self.row_filter
+        zipfiles = prefetch(make_zipfiles(metrics), depths["download"],
+                            name="download", metrics=metrics)
+        with closing(zipfiles):
+            yield from loader._iter_zipfiles(zipfiles, chunksize=chunksize,
+                                             skip_table_prefixes=skip_table_prefixes,
+                                             restart_filename=restart_filename,
+                                             prefetch_depth=depths["decompress"])
+        loader.close()
+
+    def load_zipfiles_pipelined(self, make_zipfiles, chunksize=1000,
+                                skip_table_prefixes=[], restart_filename=None,
+                                depths=None):
+        """Write zipfiles to the database, with downloading, decompressing,
+        parsing and writing (and converting) running concurrently in a
+        pipeline. The first three stages run in threads of a child process,
+        see :obj:`prefetch` and :obj:`prefetch_process`, so that they don't
+        compete with the writer for the GIL. Parsed chunks are sent back to
+        be written in this process.
+
+        Args:
+            make_zipfiles: Function of a :obj:`Metrics`, called in the child
+                           process, returning an iterable of (URL, zipfile),
+                           e.g. a generator of downloads.
+            chunksize (int): Size parameter to pass to :obj:`pd.read_csv`.
+            skip_table_prefixes (list): Skip table names with these prefixes.
+            restart_filename (str): Skip nested files until this one.
+            depths (dict): Queue depth of each stage, by stage name, updating
+                           `PIPELINE_DEPTHS`.
+        Returns:
+            n_rows (int): The number of rows written.
+        """
+        depths = queue_depths(depths)
+        self.engine.dispose()  # Don't share pooled connections with the child
+        if self.batch_sizer is not None:
+            self.batch_sizer.share(fork_context().Queue())
+        items = prefetch_process(self._read_zipfiles,
+                                 args=(make_zipfiles, chunksize,
+                                       skip_table_prefixes, restart_filename,
+                                       depths),
+                                 depth=depths["parse"], name="parse",
+                                 metrics=self.metrics)
+        n_rows = 0
+        try:
+            with closing(items):
+                for item in items:
+                    n_rows += self.write_item(*item)
+        finally:
+            if self.batch_sizer is not None:
+                self.batch_sizer.share(None)
+            if self.memory is not None:
+                self.memory.release_all("chunks")  # In case the reader is waiting
+        return n_rows
+
+    def _load_in_parallel(self, zipfile, tasks, chunksize, archive, n_workers,
+                          ordered):
+        """Load nested files in a pool of processes, each with its own loader.
+        Progress and failures are reported back as each task finishes."""
+        groups = [[task] for task in tasks]
+        if ordered:
+            by_table = defaultdict(list)
+            for fname, restarting in tasks:
+                by_table[fname.split("_")[0]].append((fname, restarting))
+            groups = list(by_table.values())
+        self.engine.dispose()  # Don't share pooled connections with the workers
+        options = dict(self.options)
+        if self.memory is not None:  # Split the budget between the workers
+            options["max_memory"] = self.memory.max_memory // n_workers
+        failures = []
+        with local_zipfile_path(zipfile) as zip_path, \
+             ProcessPoolExecutor(n_workers, mp_context=fork_context(),
+                                 initializer=_init_worker,
+                                 initargs=(self.db_url, self.Base, options,
+                                           self.row_filter)) as executor:
+            futures = {executor.submit(_load_nested_files, zip_path, group,
+                                       chunksize, archive): group
+                       for group in groups}
+            for k, future in enumerate(as_completed(futures), 1):
+                fnames = [fname for fname, _ in futures[future]]
+                try:
+                    results, metrics = future.result()
+                    self.metrics.merge(metrics)
+                    for fname, n_rows in results:
+                        logging.info(f"\t\tWritten {n_rows} entries from "
+                                     f"{fname} [{k}/{len(futures)}]")
+                except Exception as err:
+                    logging.error(f"\t\tFailed to load {fnames}: {err!r}")
+                    failures.append((fnames, err))
+        if failures:
+            fnames, err = failures[0]
+            raise RuntimeError(f"Failed to load {len(failures)} of "
+                               f"{len(futures)} nested file groups, "
+                               f"including {fnames}") from err
+
+
+def nested_files_to_load(zipfile, skip_table_prefixes=[], restart_filename=None):
+    """Yield the nested files of a zipfile which are to be loaded.
+
+    Args:
+        zipfile (ZipFile): A zipfile, assumed to contained zipped CSVs.
+        skip_table_prefixes (list): Skip table names with these prefixes.
+        restart_filename (str): Skip nested files until this one.
+    Yields:
+        fname, restarting (str, bool): Name of the nested file, and whether
+                                       loading restarts from it.
+    """
+    try:
+        with ZipFile(zipfile) as zf:
+            fnames = zf.namelist()
+    except BadZipFile:
+        logging.warning("\tSkipping bad zipfile")
+        return
+    start = bool(restart_filename is None)    
+    for fname in fnames:
+        if any(fname.startswith(fn) for fn in skip_table_prefixes):
+            logging.info(f"\t\tSkipping {fname}")
+            continue
+        restarting = (not start) and restart_filename in fname
+        if (not start) and restarting:
+            start = True
+        if not start:
+            logging.info(f"\tSkipping file {fname}...")
+            continue
+        yield (fname, restarting)
+
+
+def archive_tasks(zipfile, skip_table_prefixes=[], restart_filename=None):
+    """The nested files of a zipfile which are to be loaded, see
+    :obj:`nested_files_to_load`, and whether loading them completes the
+    archive. It doesn't if it's a bad zipfile (e.g. a truncated download),
+    or if any of its nested files are skipped.
+
+    Returns:
+        tasks, complete (list, bool): (fname, restarting) of each nested
+                                      file, and whether they're all of them.
+    """
+    try:
+        with ZipFile(zipfile) as zf:
+            n_files = len(zf.namelist())
+    except BadZipFile:
+        logging.warning("\tSkipping bad zipfile, which is left incomplete")
+        return [], False
+    tasks = list(nested_files_to_load(zipfile, skip_table_prefixes,
+                                      restart_filename))
+    return tasks, len(tasks) == n_files
+
+
+def iter_table_chunks(zipfile, prefix, _class, chunksize=100000):
+    """Iterate through all of a table's nested (zipped CSV) files in a
+    zipfile in chunks.
+
+    Args:
+        zipfile (ZipFile): A zipfile, assumed to contained zipped CSVs.
+        prefix (str): Prefix of the table name, e.g. "tls201".
+        _class: SQLalchemy ORM object, from which to take the columns to
+                read and their types.
+        chunksize (int): Size parameter to pass to :obj:`pd.read_csv`.
+    Yields:
+        chunk (:obj:`pd.DataFrame`): A chunk of the CSVs.
+    """
+    with ZipFile(zipfile) as zf:
+        for fname in zf.namelist():
+            if fname.split("_")[0] != prefix:
+                continue
+            with zf.open(fname) as z:
+                for _, f in stream_zip_members(z):
+                    yield from read_chunks(f, chunksize=chunksize, _class=_class)
+
+
+def _closing_each(zipfiles):
+    """Close each zipfile once the next is asked for"""
+    for name, zipfile in zipfiles:
+        with closing(zipfile):
+            yield (name, zipfile)
+
+
+def build_row_filter(make_zipfiles, Base, predicates, skip_table_prefixes=[],
+                     chunksize=100000):
+    """Find the IDs of the rows to load, given predicates on tls201_appln:
+    first the applications which satisfy them (and their DOCDB families),
+    then in a second pass the publications and persons of those
+    applications (from tls211 and tls207), and in a third the non-patent
+    literature cited by those publications (from tls212). IDs are only
+    collected, and passes made, if a table to be loaded is filtered by
+    them. Only the ID and predicate columns are read.
+
+    Args:
+        make_zipfiles: Function returning an iterable of (name, zipfile),
+                       called once per pass. Each zipfile is closed once read.
+        Base: SQLalchemy ORM Base object.
+        predicates (dict): Predicates on the columns of tls201_appln, e.g.
+                           `{"appln_auth": ["EP", "GB", "US"],
+                           "appln_filing_year": (2001, None)}`.
+                           See :obj:`row_mask`.
+        skip_table_prefixes (list): Table name prefixes which won't be loaded.
+        chunksize (int): Size parameter to pass to :obj:`pd.read_csv`.
+    Returns:
+        row_filter (:obj:`RowFilter`): The filter to load with.
+    """
+    appln_class = get_class_by_tablename(Base, APPLN_TABLE.split("_")[0])
+    unknown = set(predicates) - set(appln_class.__table__.columns.keys())
+    if unknown:
+        raise ValueError(f"{APPLN_TABLE} has no columns {sorted(unknown)}")
+    loaded = [_class for _class in Base._decl_class_registry.values()
+              if hasattr(_class, "__table__") and not
+              any(_class.__tablename__.startswith(prefix)
+                  for prefix in skip_table_prefixes)]
+    unfiltered = sorted(_class.__tablename__ for _class in loaded
+                        if filter_key(_class) is None)
+    if unfiltered:
+        logging.info(f"\tLoading {', '.join(unfiltered)} in full")
+    # The ID sets which tables are filtered by, and those needed to collect them
+    keys = {filter_key(_class) for _class in loaded} | {"appln_id"}
+    for prefix, (kept_by, _, key) in reversed(PROPAGATED_IDS.items()):
+        if key in keys:
+            keys.add(kept_by)
 
+    read_table = partial(iter_table_chunks, chunksize=chunksize)
+    columns = {column: key for column, key in APPLN_IDS.items() if key in keys}
+    projected = project_base(Base, {APPLN_TABLE: list(predicates) + list(columns)})
+    targets = {"tls201": (get_class_by_tablename(projected, "tls201"),
+                          partial(row_mask, predicates=predicates), columns)}
+    id_sets = collect_ids(_closing_each(make_zipfiles()), targets, read_table)
+    logging.info(f"\t{len(id_sets['appln_id']):,} applications qualify")
+    while True:  # One pass per step of propagation
+        targets = {}
+        for prefix, (kept_by, id_column, key) in PROPAGATED_IDS.items():
+            if key not in keys or key in id_sets or kept_by not in id_sets:
+                continue
+            tablename = get_class_by_tablename(Base, prefix).__tablename__
+            projected = project_base(Base, {tablename: [kept_by, id_column]})
+            targets[prefix] = (get_class_by_tablename(projected, prefix),
+                               partial(_ids_in, id_sets[kept_by], kept_by),
+                               {id_column: key})
+        if len(targets) == 0:
+            break
+        id_sets.update(collect_ids(_closing_each(make_zipfiles()), targets,
+                                   read_table))
+    return RowFilter(predicates, id_sets)
 
-def write_to_db(db_url, Base, _class, rows, create_db=True, 
+
+def _ids_in(ids, column, chunk):
+    """Flag the rows of the chunk whose ID column is in the ID set"""
+    return ids.contains(chunk[column])
+
+
+@contextmanager
+def local_zipfile_path(zipfile):
+    """Path to the zipfile on disk, spilling it to a temporary file if it is
+    only in memory, so that worker processes can open it themselves"""
+    path = getattr(zipfile, "name", None)
+    if type(path) is str and os.path.isfile(path):
+        yield path
+        return
+    fd, path = tempfile.mkstemp(suffix=".zip")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            zipfile.seek(0)
+            shutil.copyfileobj(zipfile, f)
+        yield path
+    finally:
+        os.remove(path)
+
+
+_worker_loader = None
+
+
+def _init_worker(db_url, Base, options, row_filter=None):
+    """Give each worker process its own loader, with its own engine"""
+    global _worker_loader
+    _worker_loader = PatstatLoader(db_url, Base, create_db=False,
+                                   row_filter=row_filter, **options)
+
+
+def _load_nested_files(zip_path, tasks, chunksize, archive):
+    """Load nested files of the zipfile, in order, in a worker process,
+    returning the worker's metrics along with the results"""
+    results = []
+    with ZipFile(zip_path) as zf:
+        for fname, restarting in tasks:
+            n_rows = _worker_loader.load_nested_file(zf, fname,
+                                                     chunksize=chunksize,
+                                                     filter_pks=restarting,
+                                                     archive=archive)
+            results.append((fname, n_rows))
+    return results, _worker_loader.metrics.pop()
+
+
+def write_to_db(db_url, Base, _class, batch, create_db=True, 
                 filter_pks=True):
     """Bulk write rows of data to the database.
 
@@ -108,53 +894,19 @@ def write_to_db(db_url, Base, _class, rows, create_db=True,
         db_url (str): Database connection string.
         Base: SQLalchemy ORM Base object.
         _class: SQLalchemy ORM object.
-        rows (list): Rows of data (:obj:`dict` format) to write.
+        batch (:obj:`Batch`): Rows of data to write, with null PKs removed.
         create_db (bool): Create the database if it doesn't exist?
     """
-    # Create the DB if required
-    engine = create_engine(db_url)
-    if not database_exists(engine.url):
-        create_database(engine.url)
-    engine.execution_options(stream_results=True)
-
-    # Create the tables
-    try_until_allowed(Base.metadata.create_all, engine)
-
-    # Remove bad pks
-    if True:
-        rows = [r for r in rows 
-                if not is_null_pk(make_pk(row, _class))]
-
-    # Filter results if already in the db 
-    if filter_pks:
-        logging.info('Will filter PKs before inserting data')
-        Session = try_until_allowed(sessionmaker, engine)
-        session = try_until_allowed(Session)
-        # Filter results if already in the db
-        # (this might look like a complicated setup,
-        # but its super fast and super memory efficient)
-        pks = [make_pk(row, _class) for row in rows]
-        logging.info('Generated new PKs')
-        new_pks = set(pks)
-        for old_pks in pk_chunks(session, _class):
-            new_pks = new_pks - old_pks # remove done pks
-        rows = [rows for pk, row in zip(pks, rows)
-                if pk in new_pks]
-        logging.info(f'Removing {len(rows) - len(pks)} '
-                     'rows before insert.')
-        session.close()
-        del session
-
-    # Insert the data
-    conn = engine.connect()
-    conn.execute(_class.__table__.insert(), rows)
-    conn.close()
-    del conn
-    del engine
+    with PatstatLoader(db_url, Base, create_db=create_db) as loader:
+        loader.write(_class, batch, filter_pks=filter_pks)
 
 
 def zipfile_to_db(zipfile, db_url, Base, chunksize=1000, 
-                  skip_table_prefixes=[], restart_filename=None):
+                  skip_table_prefixes=[], restart_filename=None,
+                  n_workers=1, ordered=False, profile_dir=None,
+                  profile_chunks=3, profile_fraction=None,
+                  profile_mode="cprofile", auto_chunksize=False,
+                  max_memory=None, spill_dir=None):
     """Write a zipfile contents (assumed zipped CSV) to a database.
 
     Args:
@@ -162,34 +914,65 @@ def zipfile_to_db(zipfile, db_url, Base, chunksize=1000,
         db_url (str): Database connection string.
         Base: SQLalchemy ORM Base object.
         chunksize (int): Size parameter to pass to :obj:`pd.read_csv`.
+        n_workers (int): Number of processes loading nested files in parallel.
+        ordered (bool): Load each table's nested files in order?
+        profile_{dir, chunks, fraction, mode}: See :obj:`PatstatLoader`.
+        auto_chunksize (bool): Tune the size of each table's chunks, starting
+                               from `chunksize`? See :obj:`PatstatLoader`.
+        max_memory (int or str): Budget for the memory held in buffers and
+                                 caches, e.g. "4GB", split between workers.
+                                 See :obj:`PatstatLoader`.
+        spill_dir (str): Directory for spilled temporary files.
     """
-    start = bool(restart_filename is None)    
-    for fname, f, zf in files_in_zipfile(zipfile, skip_table_prefixes=skip_table_prefixes,
-                                         yield_zipfile_too=True):
-        restarting = (not start) and restart_filename in fname
-        if (not start) and restarting:
-            start = True
-        if not start:
-            logging.info(f"\tSkipping file {fname}...")
-            continue
+    with PatstatLoader(db_url, Base, profile_dir=profile_dir,
+                       profile_chunks=profile_chunks,
+                       profile_fraction=profile_fraction,
+                       profile_mode=profile_mode,
+                       auto_chunksize=auto_chunksize,
+                       max_memory=max_memory, spill_dir=spill_dir) as loader:
+        loader.load_zipfile(zipfile, chunksize=chunksize,
+                            skip_table_prefixes=skip_table_prefixes,
+                            restart_filename=restart_filename,
+                            n_workers=n_workers, ordered=ordered)
 
-        logging.info(f"\tProcessing nested file {fname}...")
-        tablename = fname.split("_")[0]
-        _class = get_class_by_tablename(Base, tablename)
-        logging.info(f"\t\tRetrieved class from table name {tablename}.")
-        i = 0
-        with zf.open(fname) as z:
-            for rows in iterchunks(z, chunksize=chunksize):
-                i+=len(rows)
-                write_to_db(db_url, Base, _class, rows,
-                            filter_pks=restarting)
-        logging.info(f"\t\tWritten {i} entries for {tablename}.")
+
+def _downloads(metrics, memory=None, n_buffers=1, **kwargs):
+    """Retrieve zipfiles as :obj:`_zipfiles_on_pages`, counting them and
+    their bytes in the metrics. With a :obj:`MemoryBudget`, each zipfile is
+    held in memory up to an equal part of the downloads' share between
+    `n_buffers`, and spilled to disk beyond it, and those in memory count
+    against the budget until the next zipfile is retrieved."""
+    if memory is not None:
+        kwargs["make_buffer"] = partial(memory.spooled_file, n_buffers)
+    for url, zipfile in _zipfiles_on_pages(metrics=metrics, **kwargs):
+        metrics.inc("archives_downloaded")
+        metrics.inc("bytes_downloaded", zipfile.seek(0, 2))
+        zipfile.seek(0)
+        if memory is None:
+            yield (url, zipfile)
+            continue
+        n_bytes = in_memory_bytes(zipfile)
+        if n_bytes == 0 and kwargs.get("cache_dir") is None:
+            metrics.inc("archives_spilled")
+        memory.acquire("download", n_bytes, wait=False)
+        try:
+            yield (url, zipfile)
+        finally:
+            memory.release("download", n_bytes)
 
 
 def _download_patstat_to_db(db_url, Base, chunksize=10000,
                             skip_table_prefixes=[], restart_filename=None,
-                            download_suffix='',
-                            **session_credentials):
+                            download_suffix='', cache_dir=None,
+                            n_download_workers=1, bulk=True, resume=True,
+                            n_workers=1, ordered=False, fast_load=False,
+                            defer_indexes=False, metrics_path=None,
+                            metrics_interval=60, profile_dir=None,
+                            profile_chunks=3, profile_fraction=None,
+                            profile_mode="cprofile", pipeline=False,
+                            pipeline_depths=None, auto_chunksize=False,
+                            max_memory=None, spill_dir=None,
+                            appln_filters=None, **session_credentials):
     """Download all patstat global data and write to a database.
 
     Args:
@@ -197,20 +980,125 @@ def _download_patstat_to_db(db_url, Base, chunksize=10000,
         db_url (str): Database connection string.
         Base: SQLalchemy ORM Base object.
         chunksize (int): Size parameter to pass to :obj:`pd.read_csv`.
+        cache_dir (str): Directory in which to cache (and resume) downloads.
+        n_download_workers (int): Number of archives to download concurrently.
+        bulk (bool): Use the database's native bulk load, if there is one?
+        resume (bool): Skip archives, nested files and rows already committed?
+        n_workers (int): Number of processes loading nested files in parallel.
+        ordered (bool): Load each table's nested files in order?
+        fast_load (bool): Defer building keys and indexes until the end?
+        defer_indexes (bool): Defer building secondary indexes until the end?
+        metrics_path (str): File to which metrics are periodically exported,
+                            as Prometheus text if it ends in `.prom`, or
+                            otherwise as JSON.
+        metrics_interval (float): Seconds between logging (and exporting)
+                                  progress.
+        profile_dir (str): Profile a sample of each table's chunks, writing
+                           the profiles and their summaries to this directory.
+        profile_chunks (int): Number of chunks to profile per table.
+        profile_fraction (float): Fraction of chunks to profile, at random,
+                                  instead of the first `profile_chunks`.
+        profile_mode (str): "cprofile" or "sample", see :obj:`Profiler`.
+        pipeline (bool): Download, decompress, parse and write concurrently?
+                         With `n_workers`, only downloads run ahead of loading.
+        pipeline_depths (dict): Queue depth of each pipeline stage, by stage
+                                name, see `PIPELINE_DEPTHS`.
+        auto_chunksize (bool): Tune the size of each table's chunks, starting
+                               from `chunksize`? See :obj:`PatstatLoader`.
+        max_memory (int or str): Budget for the memory held in buffers and
+                                 caches, e.g. "4GB". In-memory downloads
+                                 spill to disk beyond their share of it. See
+                                 :obj:`PatstatLoader`.
+        spill_dir (str): Directory for spilled temporary files.
+        appln_filters (dict): Load only the applications which satisfy these
+                              predicates on the columns of tls201_appln, and
+                              the rows of other tables which refer to them,
+                              or to their publications or persons. See
+                              :obj:`build_row_filter`. Needs a `cache_dir`,
+                              as the archives are read more than once.
+    Returns:
+        metrics (:obj:`Metrics`): Counters, timers and latencies of the load.
     """
-    for url, zipfile in _zipfiles_on_pages(download_suffix=download_suffix, 
-                                           **session_credentials):
-        if INDEX_DOC_STR in url:
-            continue
-        logging.info(f"Processing file {url}...")
-        zipfile_to_db(zipfile, db_url, Base, chunksize=chunksize, 
-                      skip_table_prefixes=skip_table_prefixes, 
-                      restart_filename=restart_filename)
+    if appln_filters is not None and cache_dir is None:
+        raise ValueError("appln_filters needs a cache_dir, as the archives are "
+                         "read to find the IDs to load before loading them")
+    with PatstatLoader(db_url, Base, bulk=bulk, resume=resume,
+                       fast_load=fast_load,
+                       defer_indexes=defer_indexes, profile_dir=profile_dir,
+                       profile_chunks=profile_chunks,
+                       profile_fraction=profile_fraction,
+                       profile_mode=profile_mode,
+                       auto_chunksize=auto_chunksize,
+                       max_memory=max_memory, spill_dir=spill_dir) as loader, \
+            MetricsReporter(loader.metrics, path=metrics_path,
+                            interval=metrics_interval):
+        metrics = loader.metrics
+        skip_urls = [INDEX_DOC_STR]
+        if resume:
+            skip_urls += [archive for archive, _ in loader.checkpoints.progress
+                          if loader.checkpoints.is_complete(archive)]
+        if appln_filters is not None:
+            logging.info("Collecting the IDs to load...")
+            # Every archive is read, including those already loaded
+            zipfiles = partial(_zipfiles_on_pages, download_suffix=download_suffix,
+                               cache_dir=cache_dir,
+                               n_download_workers=n_download_workers,
+                               skip_urls=[INDEX_DOC_STR], **session_credentials)
+            with metrics.timer("collect_ids"):
+                loader.row_filter = build_row_filter(zipfiles, Base, appln_filters,
+                                                     skip_table_prefixes)
+            logging.info(f"Loading the rows of {loader.row_filter.summary()}")
+        # Archives in flight: downloading, queued (and waiting to be) and loading
+        n_buffers = n_download_workers
+        if pipeline:
+            n_buffers += queue_depths(pipeline_depths)["download"] + 1
+        downloads = partial(_downloads, download_suffix=download_suffix,
+                            cache_dir=cache_dir,
+                            n_download_workers=n_download_workers,
+                            skip_urls=skip_urls, memory=loader.memory,
+                            n_buffers=n_buffers, **session_credentials)
+        if pipeline and n_workers <= 1:
+            loader.load_zipfiles_pipelined(downloads, chunksize=chunksize,
+                                           skip_table_prefixes=skip_table_prefixes,
+                                           restart_filename=restart_filename,
+                                           depths=pipeline_depths)
+        else:
+            zipfiles = downloads(metrics)
+            if pipeline:
+                zipfiles = prefetch(zipfiles, queue_depths(pipeline_depths)["download"],
+                                    name="download", metrics=metrics)
+            else:
+                zipfiles = timed(zipfiles, metrics, "download_wait")
+            with closing(zipfiles):
+                for url, zipfile in zipfiles:
+                    logging.info(f"Processing file {url}...")
+                    loader.load_zipfile(zipfile, chunksize=chunksize,
+                                        skip_table_prefixes=skip_table_prefixes,
+                                        restart_filename=restart_filename,
+                                        archive=url, n_workers=n_workers,
+                                        ordered=ordered)
+        if fast_load or defer_indexes:
+            logging.info("Building keys and indexes...")
+            with metrics.timer("build_keys"):
+                loader.build_keys(n_workers=max(n_workers, 1))
+        if loader.memory is not None:
+            loader.memory.record(metrics)
+            logging.info(loader.memory.summary())
+    return metrics
 
 
 def download_patstat_to_db(patstat_usr, patstat_pwd, db_url, 
                            chunksize=10000, skip_table_prefixes=[],
-                           download_suffix='', restart_filename=None):
+                           download_suffix='', restart_filename=None,
+                           cache_dir=None, n_download_workers=1, bulk=True,
+                           resume=True, n_workers=1, ordered=False,
+                           fast_load=False, defer_indexes=False,
+                           metrics_path=None, metrics_interval=60,
+                           profile_dir=None, profile_chunks=3,
+                           profile_fraction=None, profile_mode="cprofile",
+                           pipeline=False, pipeline_depths=None,
+                           auto_chunksize=False, max_memory=None,
+                           spill_dir=None, columns=None, appln_filters=None):
     """Automatically generate PATSTAT database and tables and populate 
     all tables in memory.
 
@@ -218,20 +1106,81 @@ def download_patstat_to_db(patstat_usr, patstat_pwd, db_url,
         patstat_{usr, pwd} (str): PATSTAT username and password.
         db_url (str): Database connection string.
         chunksize (int): Size parameter to pass to :obj:`pd.read_csv`.
+        cache_dir (str): Directory in which to cache (and resume) downloads.
+        n_download_workers (int): Number of archives to download concurrently.
+        bulk (bool): Use the database's native bulk load, if there is one?
+        resume (bool): Skip archives, nested files and rows already committed?
+        n_workers (int): Number of processes loading nested files in parallel.
+        ordered (bool): Load each table's nested files in order?
+        fast_load (bool): Defer building keys and indexes until the end?
+        defer_indexes (bool): Defer building secondary indexes until the end?
+        metrics_path (str): File to which metrics are periodically exported,
+                            as Prometheus text if it ends in `.prom`, or
+                            otherwise as JSON.
+        metrics_interval (float): Seconds between logging (and exporting)
+                                  progress.
+        profile_dir (str): Profile a sample of each table's chunks, writing
+                           the profiles and their summaries to this directory.
+        profile_chunks (int): Number of chunks to profile per table.
+        profile_fraction (float): Fraction of chunks to profile, at random,
+                                  instead of the first `profile_chunks`.
+        profile_mode (str): "cprofile" or "sample", see :obj:`Profiler`.
+        pipeline (bool): Download, decompress, parse and write concurrently?
+                         With `n_workers`, only downloads run ahead of loading.
+        pipeline_depths (dict): Queue depth of each pipeline stage, by stage
+                                name, see `PIPELINE_DEPTHS`.
+        auto_chunksize (bool): Tune the size of each table's chunks, starting
+                               from `chunksize`? See :obj:`PatstatLoader`.
+        max_memory (int or str): Budget for the memory held in buffers and
+                                 caches, e.g. "4GB". In-memory downloads
+                                 spill to disk beyond their share of it. See
+                                 :obj:`PatstatLoader`.
+        spill_dir (str): Directory for spilled temporary files.
+        columns (dict): Load only these columns (and the primary key) of
+                        these tables, by table name, e.g.
+                        `{"tls206_person": ["person_name", "person_ctry_code"]}`.
+                        The other columns are neither parsed nor created.
+        appln_filters (dict): Load only the applications which satisfy these
+                              predicates on the columns of tls201_appln, e.g.
+                              `{"appln_auth": ["EP", "GB", "US"],
+                              "appln_filing_year": (2001, None)}`, and the
+                              rows of other tables which refer to them, or
+                              to their publications or persons. Needs a
+                              `cache_dir`. See :obj:`build_row_filter`.
+    Returns:
+        metrics (:obj:`Metrics`): Counters, timers and latencies of the load.
     """
     # Log into the PATSTAT website
     session = login(username=patstat_usr, pwd=patstat_pwd)
     logging.info("Downloading and generating the schema...")
     # Generate the PATSTAT Global schema
-    db_suffix = generate_schema(session)
+    db_suffix, Base = patstat_base(session, columns=columns)
     db_url=f"{db_url}/patstat_{db_suffix}"
     logging.info(f"Generated the schema for {db_suffix}. "
                  f"A database will be created at {db_url}")
     # Download the data and populate the database
-    _download_patstat_to_db(db_url=db_url, chunksize=chunksize,
-                            Base=locate(f'pypatstat.etl.orms.patstat_{db_suffix}.Base'),
-                            skip_table_prefixes=skip_table_prefixes, 
-                            restart_filename=restart_filename,
-                            download_suffix=download_suffix,
-                            username=patstat_usr, 
-                            pwd=patstat_pwd)
+    return _download_patstat_to_db(db_url=db_url, chunksize=chunksize,
+                                   Base=Base,
+                                   skip_table_prefixes=skip_table_prefixes,
+                                   restart_filename=restart_filename,
+                                   download_suffix=download_suffix,
+                                   cache_dir=cache_dir,
+                                   n_download_workers=n_download_workers,
+                                   bulk=bulk, resume=resume,
+                                   n_workers=n_workers, ordered=ordered,
+                                   fast_load=fast_load,
+                                   defer_indexes=defer_indexes,
+                                   metrics_path=metrics_path,
+                                   metrics_interval=metrics_interval,
+                                   profile_dir=profile_dir,
+                                   profile_chunks=profile_chunks,
+                                   profile_fraction=profile_fraction,
+                                   profile_mode=profile_mode,
+                                   pipeline=pipeline,
+                                   pipeline_depths=pipeline_depths,
+                                   auto_chunksize=auto_chunksize,
+                                   max_memory=max_memory,
+                                   spill_dir=spill_dir,
+                                   appln_filters=appln_filters,
+                                   username=patstat_usr,
+                                   pwd=patstat_pwd)
@@ -0,0 +1,391 @@
+'''Delta loading: refresh a database holding one PATSTAT edition to the next
+edition, by applying only the inserts, updates and deletes between them.
+Rows are matched by primary key, and compared by a hash of their contents.'''
+
+from pypatstat.etl.utils import login
+from pypatstat.etl.utils import _zipfiles_on_pages
+from pypatstat.etl.utils import stream_zip_members
+from pypatstat.etl.schema_maker import patstat_base
+from pypatstat.etl.schema_maker import INDEX_DOC_STR
+from pypatstat.etl.pk_index import PkIndex
+from pypatstat.etl.pk_index import pk_dtype
+from pypatstat.etl.pk_index import to_pk_array
+from pypatstat.etl.pk_index import from_pk_array
+from pypatstat.etl.retrieval import iter_table
+from pypatstat.etl.data_loader import PatstatLoader
+from pypatstat.etl.data_loader import read_chunks
+from pypatstat.etl.data_loader import chunk_to_batch
+from pypatstat.etl.data_loader import null_pk_mask
+from pypatstat.etl.data_loader import get_class_by_tablename
+from pypatstat.etl.data_loader import try_until_allowed
+from sqlalchemy import inspect
+from sqlalchemy import tuple_
+from sqlalchemy.schema import CreateColumn
+import logging
+import numpy as np
+import pandas as pd
+
+DELETE_CHUNKSIZE = 1000
+
+
+def content_hashes(chunk, _class):
+    """Hash the non-PK contents of each row, in one vectorized pass. Strings
+    are right-stripped, since some databases pad CHAR columns.
+
+    Args:
+        chunk (:obj:`pd.DataFrame`): Rows with the ORM's dtypes, as read by
+                                     :obj:`read_chunks` or :obj:`iter_table`.
+        _class: SQLalchemy ORM object.
+    Returns:
+        hashes (:obj:`np.array`): One uint64 hash per row.
+    """
+    pkeys = {col.name for col in _class.__table__.primary_key.columns}
+    columns = {}
+    for col in _class.__table__.columns:
+        if col.name in pkeys:
+            continue
+        values = chunk[col.name] if col.name in chunk \
+            else pd.Series(None, index=chunk.index, dtype=object)
+        if isinstance(values.dtype, pd.CategoricalDtype) or \
+           pd.api.types.is_string_dtype(values):
+            values = values.astype("string").str.rstrip()
+        columns[col.name] = values
+    if len(columns) == 0:
+        return np.zeros(len(chunk), dtype=np.uint64)
+    return pd.util.hash_pandas_object(pd.DataFrame(columns, index=chunk.index),
+                                      index=False).to_numpy()
+
+
+def _type_changed(live_type, new_type):
+    """Does a live column need a new type to hold the new edition's values,
+    i.e. a different kind of value or a longer string?"""
+    try:
+        if live_type.python_type is not new_type.python_type:
+            return True
+    except NotImplementedError:
+        return False
+    live_length = getattr(live_type, "length", None)
+    new_length = getattr(new_type, "length", None)
+    return live_length is not None and new_length is not None and \
+        live_length < new_length
+
+
+def schema_changes(conn, table):
+    """Compare a table in the database with the new edition's ORM.
+
+    Args:
+        conn: An SQLalchemy connection.
+        table (:obj:`sqlalchemy.Table`): The new edition's table.
+    Returns:
+        missing, rebuild (list, str): The new edition's columns which the
+                                      table lacks, and why the table must be
+                                      rebuilt (None if it needn't be): its
+                                      primary key or a column's type changed.
+    """
+    inspector = inspect(conn)
+    live = {column["name"]: column for column in inspector.get_columns(table.name)}
+    live_pkeys = inspector.get_pk_constraint(table.name)["constrained_columns"]
+    pkeys = [column.name for column in table.primary_key.columns]
+    if sorted(live_pkeys) != sorted(pkeys):
+        return [], f"its primary key changed from {live_pkeys} to {pkeys}"
+    for column in table.columns:
+        if column.name in live and _type_changed(live[column.name]["type"],
+                                                 column.type):
+            return [], (f"{column.name} changed type from "
+                        f"{live[column.name]['type']} to {column.type}")
+    return [column for column in table.columns if column.name not in live], None
+
+
+def chunk_keys(chunk, _class):
+    """The PKs of each row of the chunk, as a structured array"""
+    dtype = pk_dtype(_class)
+    return to_pk_array([chunk[name].to_numpy() for name in dtype.names], dtype)
+
+
+class ContentIndex(PkIndex):
+    """A sorted index of a table's primary keys, along with a hash of each
+    row's contents, and whether the row has been seen in the new edition.
+
+    Args:
+        _class: SQLalchemy ORM object.
+        keys (:obj:`np.array`): PKs with the dtype of :obj:`pk_dtype`.
+        hashes (:obj:`np.array`): Content hash of each row, aligned with `keys`.
+    """
+    def __init__(self, _class, keys, hashes):
+        self._class = _class
+        order = np.argsort(keys)
+        self.keys = keys[order]
+        self.hashes = hashes[order]
+        self.seen = np.zeros(len(keys), dtype=bool)
+
+    @property
+    def nbytes(self):
+        return self.keys.nbytes + self.hashes.nbytes + self.seen.nbytes
+
+    @classmethod
+    def from_db(cls, engine, _class, chunksize=100000):
+        """Read the PKs and content hashes of all rows of the table, streamed
+        in batches.
+
+        Args:
+            engine: An SQLalchemy engine or connection.
+            _class: SQLalchemy ORM object.
+            chunksize (int): Number of rows to read per batch.
+        """
+        keys, hashes = [], []
+        for df in iter_table(engine, _class, batch_size=chunksize):
+            keys.append(chunk_keys(df, _class))
+            hashes.append(content_hashes(df, _class))
+        if len(keys) == 0:
+            keys, hashes = [np.empty(0, dtype=pk_dtype(_class))], \
+                [np.empty(0, dtype=np.uint64)]
+        index = cls(_class, np.concatenate(keys), np.concatenate(hashes))
+        logging.info(f"Loaded {len(index)} PKs and hashes ({index.nbytes} "
+                     f"bytes) for {_class.__tablename__}")
+        return index
+
+    def lookup(self, keys):
+        """Find each key in the index.
+
+        Args:
+            keys (:obj:`np.array`): PKs with the dtype of :obj:`pk_dtype`.
+        Returns:
+            idx, found (:obj:`np.array`, :obj:`np.array`): Position of each
+                                                           key, and whether
+                                                           it was found there.
+        """
+        if len(self.keys) == 0:
+            return np.zeros(len(keys), dtype=int), np.zeros(len(keys), dtype=bool)
+        idx = np.searchsorted(self.keys, keys)
+        idx[idx == len(self.keys)] = 0
+        return idx, self.keys[idx] == keys
+
+    def unseen(self):
+        """PKs in the index which haven't been seen in the new edition"""
+        return self.keys[~self.seen]
+
+
+def delete_by_pk(conn, table, keys):
+    """Delete the rows of a table with these PKs, in chunks.
+
+    Args:
+        conn: An SQLalchemy connection.
+        table (:obj:`sqlalchemy.Table`): The table.
+        keys (:obj:`np.array`): PKs with the dtype of :obj:`pk_dtype`.
+    """
+    pkey_cols = list(table.primary_key.columns)
+    for start in range(0, len(keys), DELETE_CHUNKSIZE):
+        _keys = from_pk_array(keys[start:start + DELETE_CHUNKSIZE])
+        if len(pkey_cols) == 1:
+            clause = pkey_cols[0].in_([key[0] for key in _keys])
+        else:
+            clause = tuple_(*pkey_cols).in_(_keys)
+        conn.execute(table.delete().where(clause))
+
+
+class DeltaLoader(PatstatLoader):
+    """Apply a new PATSTAT edition to a database holding the previous one.
+    Each table's PKs and content hashes are loaded once, and the new
+    edition's rows are then inserted (new PKs), replaced (changed contents) or
+    skipped (unchanged). Rows of the previous edition which are not in the new
+    one are deleted by :obj:`apply_deletes`, once every file has been loaded.
+
+    Args:
+        db_url (str): Connection string of the database to update.
+        Base: SQLalchemy ORM Base object of the new edition.
+        bulk (bool): Use the database's native bulk load, if there is one?
+    """
+    def __init__(self, db_url, Base, bulk=True):
+        super().__init__(db_url, Base, create_db=False, bulk=bulk, resume=False)
+        self.content_indexes = {}
+        self.counts = {"inserted": 0, "updated": 0, "unchanged": 0, "deleted": 0}
+
+    def content_index(self, _class):
+        """The table's index of PKs and content hashes, loaded once, after
+        bringing the table up to the new edition's schema"""
+        tablename = _class.__tablename__
+        if tablename not in self.content_indexes:
+            self.migrate_table(_class)
+            logging.info(f'Loading existing PKs and hashes for {tablename}')
+            # Only connecting is retried, not errors in the queries
+            with try_until_allowed(self.engine.connect) as conn:
+                self.content_indexes[tablename] = ContentIndex.from_db(conn, _class)
+        return self.content_indexes[tablename]
+
+    def migrate_table(self, _class):
+        """Bring a table of the previous edition up to the new edition's
+        schema: columns new to the edition are added (and filled in as their
+        rows are updated), while a table whose primary key or column types
+        changed is dropped and recreated, so that all of its rows are
+        reloaded. See :obj:`schema_changes`."""
+        table = _class.__table__
+        with try_until_allowed(self.engine.connect) as conn, conn.begin():
+            missing, rebuild = schema_changes(conn, table)
+            if rebuild is not None:
+                logging.warning(f"Rebuilding {table.name}, as {rebuild}. "
+                                "All of its rows will be reloaded.")
+                table.drop(conn)
+                table.create(conn)
+                return
+            name = conn.dialect.identifier_preparer.format_table(table)
+            for column in missing:
+                logging.info(f"Adding column {column.name} to {table.name}")
+                ddl = CreateColumn(column).compile(dialect=conn.dialect)
+                conn.execute(f"ALTER TABLE {name} ADD {ddl}")
+
+    def apply_chunk(self, _class, chunk):
+        """Insert the new rows and replace the changed rows of a chunk, in
+        a single transaction.
+
+        Args:
+            _class: SQLalchemy ORM object.
+            chunk (:obj:`pd.DataFrame`): A chunk of the new edition's CSV.
+        Returns:
+            n_rows (int): The number of rows inserted or replaced.
+        """
+        index = self.content_index(_class)
+        chunk = chunk.loc[~null_pk_mask(chunk, _class)]
+        keys = chunk_keys(chunk, _class)
+        idx, found = index.lookup(keys)
+        index.seen[idx[found]] = True
+        changed = found.copy()
+        changed[found] = index.hashes[idx[found]] != content_hashes(chunk, _class)[found]
+        new = ~found
+        self.counts["inserted"] += int(new.sum())
+        self.counts["updated"] += int(changed.sum())
+        self.counts["unchanged"] += int((found & ~changed).sum())
+        batch = chunk_to_batch(chunk.loc[new | changed], _class)
+        if batch.n_rows == 0:
+            return 0
+        with try_until_allowed(self.engine.connect) as conn, conn.begin():
+            delete_by_pk(conn, _class.__table__, keys[changed])
+            self.backend.insert(conn, _class.__table__, batch)
+        return batch.n_rows
+
+    def load_nested_file(self, zf, fname, chunksize=1000, filter_pks=False,
+                         archive=None):
+        """Apply one nested (zipped CSV) file of the new edition.
+
+        Args:
+            zf (ZipFile): The open zipfile.
+            fname (str): Name of the nested file in the zipfile.
+            chunksize (int): Size parameter to pass to :obj:`pd.read_csv`.
+        Returns:
+            n_rows (int): The number of rows inserted or replaced.
+        """
+        logging.info(f"\tProcessing nested file {fname}...")
+        tablename = fname.split("_")[0]
+        _class = get_class_by_tablename(self.Base, tablename)
+        i = 0
+        with zf.open(fname) as z:
+            for _, f in stream_zip_members(z):
+                for chunk in read_chunks(f, chunksize=chunksize, _class=_class):
+                    i += self.apply_chunk(_class, chunk)
+        logging.info(f"\t\tInserted or replaced {i} entries for {tablename}.")
+        return i
+
+    def load_zipfile(self, zipfile, chunksize=1000, skip_table_prefixes=[],
+                     restart_filename=None, archive=None, n_workers=1,
+                     ordered=False):
+        """Apply a zipfile of the new edition, one nested file at a time:
+        rows must be seen by this loader's content indexes, so nested files
+        aren't loaded in parallel (`n_workers`, `ordered`), and progress
+        isn't journaled (`archive`)."""
+        if n_workers > 1 or ordered or archive is not None:
+            raise ValueError("Delta loads apply nested files one at a time, "
+                             "without journaling: n_workers, ordered and "
+                             "archive aren't supported")
+        super().load_zipfile(zipfile, chunksize=chunksize,
+                             skip_table_prefixes=skip_table_prefixes,
+                             restart_filename=restart_filename)
+
+    def apply_deletes(self):
+        """Delete the rows of every table loaded so far which weren't in
+        the new edition.
+
+        Returns:
+            n_rows (int): The number of rows deleted.
+        """
+        n_rows = 0
+        for tablename, index in self.content_indexes.items():
+            keys = index.unseen()
+            logging.info(f"Deleting {len(keys)} rows from {tablename}")
+            with self.engine.begin() as conn:
+                delete_by_pk(conn, index._class.__table__, keys)
+            index.seen[:] = True
+            n_rows += len(keys)
+        self.counts["deleted"] += n_rows
+        return n_rows
+
+
+def _delta_patstat_to_db(db_url, Base, chunksize=10000, skip_table_prefixes=[],
+                         download_suffix='', cache_dir=None,
+                         n_download_workers=1, bulk=True, deletes=True,
+                         **session_credentials):
+    """Download a new patstat edition and apply it to an existing database.
+
+    Args:
+        db_url (str): Connection string of the database to update.
+        Base: SQLalchemy ORM Base object of the new edition.
+        chunksize (int): Size parameter to pass to :obj:`pd.read_csv`.
+        cache_dir (str): Directory in which to cache (and resume) downloads.
+        n_download_workers (int): Number of archives to download concurrently.
+        bulk (bool): Use the database's native bulk load, if there is one?
+        deletes (bool): Delete rows which aren't in the new edition? Only
+                        use this if every file of each loaded table is
+                        downloaded, e.g. not with `download_suffix`.
+    Returns:
+        counts (dict): The number of rows inserted, updated, unchanged and
+                       deleted.
+    """
+    with DeltaLoader(db_url, Base, bulk=bulk) as loader:
+        for url, zipfile in _zipfiles_on_pages(download_suffix=download_suffix,
+                                               cache_dir=cache_dir,
+                                               n_download_workers=n_download_workers,
+                                               skip_urls=[INDEX_DOC_STR],
+                                               **session_credentials):
+            logging.info(f"Processing file {url}...")
+            loader.load_zipfile(zipfile, chunksize=chunksize,
+                                skip_table_prefixes=skip_table_prefixes)
+        if deletes:
+            loader.apply_deletes()
+        logging.info(f"Applied delta: {loader.counts}")
+        return loader.counts
+
+
+def delta_patstat_to_db(patstat_usr, patstat_pwd, db_url, chunksize=10000,
+                        skip_table_prefixes=[], download_suffix='',
+                        cache_dir=None, n_download_workers=1, bulk=True,
+                        deletes=True):
+    """Update a database holding a previous PATSTAT edition to the latest
+    edition, applying only the rows which have changed between them.
+
+    Args:
+        patstat_{usr, pwd} (str): PATSTAT username and password.
+        db_url (str): Connection string of the database to update, including
+                      the database name, e.g. ".../patstat_2018_10_02".
+        chunksize (int): Size parameter to pass to :obj:`pd.read_csv`.
+        cache_dir (str): Directory in which to cache (and resume) downloads.
+        n_download_workers (int): Number of archives to download concurrently.
+        bulk (bool): Use the database's native bulk load, if there is one?
+        deletes (bool): Delete rows which aren't in the new edition?
+    Returns:
+        counts (dict): The number of rows inserted, updated, unchanged and
+                       deleted.
+    """
+    # Log into the PATSTAT website
+    session = login(username=patstat_usr, pwd=patstat_pwd)
+    logging.info("Downloading and generating the schema...")
+    # Generate the PATSTAT Global schema of the new edition
+    db_suffix, Base = patstat_base(session)
+    logging.info(f"Generated the schema for {db_suffix}. "
+                 f"The database at {db_url} will be updated")
+    return _delta_patstat_to_db(db_url=db_url, chunksize=chunksize,
+                                Base=Base,
+                                skip_table_prefixes=skip_table_prefixes,
+                                download_suffix=download_suffix,
+                                cache_dir=cache_dir,
+                                n_download_workers=n_download_workers,
+                                bulk=bulk, deletes=deletes,
+                                username=patstat_usr,
+                                pwd=patstat_pwd)
@@ -0,0 +1,85 @@
+'''Map the column types of the PATSTAT ORMs onto pandas and numpy types.'''
+
+import pandas as pd
+
+INT_DTYPES = {"INTEGER": "Int32", "INT": "Int32", "SMALLINT": "Int16",
+              "TINYINT": "Int16", "BIGINT": "Int64"}
+FLOAT_DTYPES = {"REAL": "float32", "FLOAT": "float64"}
+STR_TYPES = ("CHAR", "NCHAR", "VARCHAR", "NVARCHAR", "TEXT")
+DATE_TYPES = ("DATE",)
+MAX_CATEGORY_LENGTH = 2  # CHAR(1) and CHAR(2) codes have few distinct values
+
+
+def sql_type_name(column):
+    """The SQL type name of an ORM column, e.g. 'VARCHAR'"""
+    return column.type.__visit_name__.upper()
+
+
+def column_dtype(column):
+    """The pandas dtype with which to read this ORM column from CSV.
+
+    Args:
+        column (:obj:`sqlalchemy.Column`): An ORM column.
+    Returns:
+        dtype: A pandas dtype, or None for DATE columns, which are read as
+               strings and parsed by :obj:`parse_dates`.
+    """
+    type_name = sql_type_name(column)
+    if type_name in INT_DTYPES:
+        return INT_DTYPES[type_name]
+    if type_name in FLOAT_DTYPES:
+        return FLOAT_DTYPES[type_name]
+    if type_name in DATE_TYPES:
+        return None
+    if type_name in STR_TYPES:
+        length = getattr(column.type, "length", None)
+        if type_name in ("CHAR", "NCHAR") and length is not None \
+           and length <= MAX_CATEGORY_LENGTH:
+            return "category"
+        return str
+    raise ValueError(f"No dtype is known for {type_name} column {column.name}")
+
+
+def csv_dtypes(_class):
+    """Generate the arguments with which to read a table's CSV files.
+
+    Args:
+        _class: SQLalchemy ORM object.
+    Returns:
+        dtypes, date_columns (dict, list): pandas dtype by column name, and
+                                           names of the DATE columns.
+    """
+    dtypes, date_columns = {}, []
+    for column in _class.__table__.columns:
+        dtype = column_dtype(column)
+        if dtype is None:
+            date_columns.append(column.name)
+            dtype = str
+        dtypes[column.name] = dtype
+    return dtypes, date_columns
+
+
+def parse_dates(chunk, date_columns):
+    """Parse ISO formatted DATE columns in place, in one vectorized pass per
+    column. Seconds resolution is used so that PATSTAT's '9999-12-31'
+    sentinel, which overflows pandas' default nanosecond resolution, is kept.
+
+    Args:
+        chunk (:obj:`pd.DataFrame`): A chunk of the CSV.
+        date_columns (list): Names of the DATE columns.
+    """
+    for col in date_columns:
+        if col not in chunk:
+            continue
+        values = chunk[col].astype(object).fillna("NaT").to_numpy()
+        dates = values.astype("datetime64[D]").astype("datetime64[s]")
+        chunk[col] = pd.Series(dates, index=chunk.index)
+    return chunk
+
+
+def to_python_values(col):
+    """Convert a column to an object array of native python values, with
+    nulls as None, as expected by the DB drivers"""
+    if pd.api.types.is_datetime64_any_dtype(col):
+        return col.to_numpy().astype("datetime64[D]").astype(object)
+    return col.astype(object).where(col.notnull(), None).to_numpy()
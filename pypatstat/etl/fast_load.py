@@ -0,0 +1,109 @@
+'''"Fast load" mode: tables are created without primary keys or indexes, and
+loaded with per-session checks relaxed. Keys and indexes are then built in
+one final phase, in parallel across tables.'''
+
+from sqlalchemy import MetaData
+from sqlalchemy import Table
+from sqlalchemy import event
+from sqlalchemy import inspect
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+# Per-session settings which speed up loading, by dialect
+FAST_SESSION_SETTINGS = {
+    "mysql": ["SET SESSION unique_checks = 0",
+              "SET SESSION foreign_key_checks = 0"],
+    "postgresql": ["SET synchronous_commit TO OFF"],
+    "sqlite": ["PRAGMA synchronous = OFF"],
+}
+SQLITE_PK_PREFIX = "pk_"  # SQLite can't add a PK later, so use a unique index
+
+
+def keyless_metadata(Base, primary_keys=False):
+    """Copies of the ORM's tables without primary keys or indexes.
+
+    Args:
+        Base: SQLalchemy ORM Base object.
+        primary_keys (bool): Keep the primary keys, dropping only the indexes?
+    Returns:
+        metadata (:obj:`sqlalchemy.MetaData`): The keyless tables.
+    """
+    metadata = MetaData()
+    for table in Base.metadata.sorted_tables:
+        columns = []
+        for column in table.columns:
+            column = column.copy()
+            column.nullable = not column.primary_key
+            column.primary_key = column.primary_key and primary_keys
+            column.index = None
+            column.unique = None
+            columns.append(column)
+        Table(table.name, metadata, *columns)
+    return metadata
+
+
+def relax_session_checks(engine):
+    """Apply the dialect's fast-load session settings to every new connection.
+    They're committed, as otherwise (on PostgreSQL) they'd be rolled back with
+    the driver's implicit transaction when the connection returns to the pool."""
+    settings = FAST_SESSION_SETTINGS.get(engine.dialect.name, [])
+    @event.listens_for(engine, "connect")
+    def set_fast_session(dbapi_conn, connection_record):
+        cursor = dbapi_conn.cursor()
+        for setting in settings:
+            cursor.execute(setting)
+        cursor.close()
+        dbapi_conn.commit()
+
+
+def build_primary_key(engine, table):
+    """Add the table's primary key, unless it already has one"""
+    inspector = inspect(engine)
+    columns = [col.name for col in table.primary_key.columns]
+    if len(columns) == 0 or \
+            inspector.get_pk_constraint(table.name)["constrained_columns"]:
+        return
+    preparer = engine.dialect.identifier_preparer
+    name = preparer.format_table(table)
+    cols = ", ".join(preparer.quote(col) for col in columns)
+    if engine.dialect.name == "sqlite":
+        index_name = f"{SQLITE_PK_PREFIX}{table.name}"
+        if any(idx["name"] == index_name for idx in inspector.get_indexes(table.name)):
+            return
+        sql = f"CREATE UNIQUE INDEX {preparer.quote(index_name)} ON {name} ({cols})"
+    else:
+        sql = f"ALTER TABLE {name} ADD PRIMARY KEY ({cols})"
+    logging.info(f"Building primary key of {table.name}")
+    with engine.begin() as conn:
+        conn.execute(sql)
+
+
+def build_indexes(engine, table):
+    """Create the table's indexes, other than those which already exist"""
+    existing = {idx["name"] for idx in inspect(engine).get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name in existing:
+            continue
+        logging.info(f"Building index {index.name} of {table.name}")
+        index.create(engine)
+
+
+def build_keys(engine, Base, n_workers=4, indexes=True):
+    """Build the primary keys (and indexes) of all tables, in parallel.
+
+    Args:
+        engine: An SQLalchemy engine for the PATSTAT database.
+        Base: SQLalchemy ORM Base object.
+        n_workers (int): Number of tables to build at once.
+        indexes (bool): Build the indexes as well as the primary keys?
+    """
+    def build(table):
+        build_primary_key(engine, table)
+        if indexes:
+            build_indexes(engine, table)
+        return table.name
+    tables = [table for table in Base.metadata.sorted_tables
+              if engine.has_table(table.name)]
+    with ThreadPoolExecutor(n_workers) as executor:
+        for name in executor.map(build, tables):
+            logging.info(f"Built keys for {name}")
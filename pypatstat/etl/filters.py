@@ -0,0 +1,165 @@
+'''Load a subset of PATSTAT, by predicates on the applications in
+tls201_appln: the IDs of the applications which qualify, and of the
+families, publications, persons and non-patent literature which they lead
+to, are collected up front as compact sorted arrays, by which the other
+tables are filtered as they're read.'''
+
+import logging
+import numpy as np
+import pandas as pd
+
+APPLN_TABLE = "tls201_appln"
+# IDs collected from tls201_appln along with those of the applications
+# which qualify: {ID column: ID set}
+APPLN_IDS = {"appln_id": "appln_id", "docdb_family_id": "docdb_family_id"}
+# Tables through which IDs are propagated, once the ID set by which their
+# rows are kept has been collected: {table prefix: (ID set of the rows
+# kept, ID column collected, ID set it is collected into)}
+PROPAGATED_IDS = {"tls211": ("appln_id", "pat_publn_id", "pat_publn_id"),
+                  "tls207": ("appln_id", "person_id", "person_id"),
+                  "tls212": ("pat_publn_id", "cited_npl_publn_id", "npl_publn_id")}
+# Columns by which tables are filtered, in order of preference
+FILTER_KEYS = ("appln_id", "pat_publn_id", "person_id", "docdb_family_id",
+               "npl_publn_id")
+ID_DTYPE = "i4"  # PATSTAT's IDs are INT columns
+
+
+def row_mask(chunk, predicates):
+    """Flag the rows of a chunk which satisfy every predicate.
+
+    Args:
+        chunk (:obj:`pd.DataFrame`): A chunk of the CSV.
+        predicates (dict): By column name, either a list (or set) of values
+                           to keep, a (low, high) tuple of the inclusive range
+                           to keep, with None for no bound, a function of the
+                           column returning a boolean mask, or otherwise a
+                           single value to keep. Null values never qualify.
+    Returns:
+        mask (:obj:`np.array`): True for rows to keep.
+    """
+    mask = np.ones(len(chunk), dtype=bool)
+    for column, predicate in predicates.items():
+        values = chunk[column]
+        if callable(predicate):
+            matches = predicate(values)
+        elif isinstance(predicate, tuple):
+            low, high = predicate
+            matches = pd.Series(True, index=values.index)
+            if low is not None:
+                matches &= values >= low
+            if high is not None:
+                matches &= values <= high
+        elif isinstance(predicate, (list, set, frozenset)):
+            matches = values.isin(predicate)
+        else:
+            matches = values == predicate
+        mask &= pd.Series(matches).fillna(False).to_numpy(dtype=bool)
+    return mask
+
+
+class IdSet:
+    """A sorted array of unique IDs, taking 4 bytes per ID.
+
+    Args:
+        ids (:obj:`np.array`): IDs, in any order and with duplicates.
+    """
+    def __init__(self, ids=()):
+        self.ids = np.unique(np.asarray(ids, dtype=ID_DTYPE))
+
+    @classmethod
+    def from_parts(cls, parts):
+        """An ID set of arrays of IDs, e.g. one per chunk"""
+        return cls(np.concatenate(parts) if parts else ())
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes
+
+    def contains(self, values):
+        """Flag which values are in the set, nulls never being.
+
+        Args:
+            values (:obj:`pd.Series`): A column of IDs.
+        Returns:
+            mask (:obj:`np.array`): True for values in the set.
+        """
+        values = pd.Series(values)
+        is_null = values.isnull().to_numpy(dtype=bool)
+        values = values.to_numpy(dtype="i8", na_value=0)
+        if len(self.ids) == 0:
+            return np.zeros(len(values), dtype=bool)
+        idx = np.searchsorted(self.ids, values)
+        idx[idx == len(self.ids)] = 0
+        return (self.ids[idx] == values) & ~is_null
+
+
+def filter_key(_class):
+    """The column by which a table is filtered, or None if it isn't"""
+    columns = _class.__table__.columns.keys()
+    for key in FILTER_KEYS:
+        if key in columns:
+            return key
+    return None
+
+
+class RowFilter:
+    """Filter each table's rows as they're read: tls201_appln by predicates
+    on its columns, and the tables which refer to applications,
+    publications, persons, DOCDB families (tls228) or non-patent literature
+    (tls214) by the IDs of those which qualify. Other tables, i.e. the
+    tls8xx and tls9xx lookups, are kept in full.
+
+    Args:
+        predicates (dict): Predicates on the columns of tls201_appln, see
+                           :obj:`row_mask`.
+        id_sets (dict): :obj:`IdSet` of the IDs to keep, by ID column.
+    """
+    def __init__(self, predicates, id_sets):
+        self.predicates = predicates
+        self.id_sets = id_sets
+
+    def mask(self, _class, chunk):
+        """Flag the rows of a chunk of the table to keep, or return None if
+        the table isn't filtered"""
+        if _class.__tablename__ == APPLN_TABLE:
+            return row_mask(chunk, self.predicates)
+        key = filter_key(_class)
+        if key not in self.id_sets:
+            return None
+        return self.id_sets[key].contains(chunk[key])
+
+    def summary(self):
+        return ", ".join(f"{len(ids):,} {key}s ({ids.nbytes/2**20:,.1f} MB)"
+                         for key, ids in self.id_sets.items())
+
+
+def collect_ids(zipfiles, targets, read_table):
+    """Collect the IDs of the rows to keep from tables in the zipfiles, in
+    one pass over them.
+
+    Args:
+        zipfiles: Iterable of (name, zipfile).
+        targets (dict): By table prefix, the ORM class to read (projected to
+                        just the columns needed), a function of a chunk
+                        flagging the rows to keep, and the ID columns to
+                        collect from them, each mapped to the name of the ID
+                        set it is collected into.
+        read_table: Function of a zipfile, table prefix and ORM class,
+                    yielding chunks of the table's CSVs in the zipfile.
+    Returns:
+        id_sets (dict): :obj:`IdSet` by name.
+    """
+    parts = {key: [] for _, _, columns in targets.values()
+             for key in columns.values()}
+    for name, zipfile in zipfiles:
+        logging.info(f"\tCollecting IDs from {name}...")
+        for prefix, (_class, keep, columns) in targets.items():
+            for chunk in read_table(zipfile, prefix, _class):
+                mask = keep(chunk)
+                for id_column, key in columns.items():
+                    ids = chunk[id_column].to_numpy(dtype="i8", na_value=0)
+                    parts[key].append(ids[mask].astype(ID_DTYPE))
+    return {key: IdSet.from_parts(_parts) for key, _parts in parts.items()}
@@ -0,0 +1,167 @@
+'''A budget on the memory held in the loader's buffers and caches, split
+between its stages. Downloads beyond their share spill to temporary files,
+PK indexes beyond theirs are memory-mapped from temporary files, and chunks
+are kept small enough that their share holds a few of them, with the reader
+waiting on the writer once it's full (backpressure).
+
+Usage is shared between the processes of a pipelined load, which are forked
+from the one which creates the budget, so that peaks are reported across
+all of them.'''
+
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+import multiprocessing
+import re
+import resource
+import sys
+
+from pypatstat.etl.utils import fork_context
+
+# Fraction of the budget for each stage: archives held in memory, parsed
+# chunks (including the one being converted and written) and PK indexes
+MEMORY_SHARES = {"download": 0.4, "chunks": 0.4, "pk_index": 0.2}
+# Size of a converted batch relative to its chunk, as Python objects are
+# larger than pandas' (arrow) columns
+BATCH_OVERHEAD = 5
+POLL_INTERVAL = 0.1  # Seconds between checks for room in the budget
+SIZE_UNITS = {"": 1, "B": 1, "K": 2**10, "KB": 2**10, "M": 2**20, "MB": 2**20,
+              "G": 2**30, "GB": 2**30, "T": 2**40, "TB": 2**40}
+
+
+def parse_size(size):
+    """Number of bytes in a size, e.g. 4294967296, "4GB" or "512 MB" """
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.fullmatch(r"\s*([\d.]+)\s*([A-Za-z]*)\s*", size)
+    if match is None or match.group(2).upper() not in SIZE_UNITS:
+        raise ValueError(f"Can't parse '{size}' as a size, e.g. '4GB'")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def chunk_nbytes(chunk):
+    """In-memory size of a chunk of the CSV"""
+    return int(chunk.memory_usage(index=False, deep=True).sum())
+
+
+def in_memory_bytes(f):
+    """Number of bytes of a file held in memory, rather than on disk"""
+    if isinstance(f, SpooledTemporaryFile) and not f._rolled:
+        f = f._file
+    if isinstance(f, BytesIO):
+        return f.getbuffer().nbytes
+    return 0
+
+
+def peak_rss():
+    """Peak resident set size of this process, in bytes (which macOS reports
+    in bytes, and other systems in KiB)"""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 2**10
+
+
+class MemoryBudget:
+    """Account for the memory held by each stage of a load, within a total
+    budget split between the stages.
+
+    Args:
+        max_memory (int or str): The budget, in bytes or e.g. "4GB".
+        shares (dict): Fraction of the budget for each stage, updating
+                       `MEMORY_SHARES`.
+        spill_dir (str): Directory for temporary files, defaulting to the
+                         system's.
+    """
+    def __init__(self, max_memory, shares=None, spill_dir=None):
+        self.max_memory = parse_size(max_memory)
+        self.shares = {**MEMORY_SHARES, **(shares or {})}
+        self.spill_dir = spill_dir
+        try:  # Shared with the (forked) processes of a pipelined load
+            context = fork_context()
+        except ValueError:
+            context = multiprocessing.get_context()
+        self.condition = context.Condition()
+        self.usage = {stage: context.Value("q", 0, lock=False)
+                      for stage in self.shares}
+        self.peaks = {stage: context.Value("q", 0, lock=False)
+                      for stage in self.shares}
+        self.bytes_per_row = {}
+
+    def share(self, stage):
+        """The stage's share of the budget, in bytes"""
+        return int(self.max_memory * self.shares[stage])
+
+    @property
+    def chunk_bytes(self):
+        """Largest chunk for which the chunks' share holds the chunk being
+        read, and the one being written along with its converted batch"""
+        return int(self.share("chunks") / (BATCH_OVERHEAD + 2))
+
+    def acquire(self, stage, n_bytes, wait=True):
+        """Add to the stage's usage, first waiting until it fits within the
+        stage's share if `wait`. A stage with nothing in use always has
+        room, so that oversized items get through one at a time."""
+        with self.condition:
+            usage = self.usage[stage]
+            while wait and usage.value > 0 and \
+                    usage.value + n_bytes > self.share(stage):
+                self.condition.wait(POLL_INTERVAL)
+            usage.value += n_bytes
+            self.peaks[stage].value = max(self.peaks[stage].value, usage.value)
+
+    def release(self, stage, n_bytes):
+        """Take from the stage's usage, waking anything waiting on it"""
+        with self.condition:
+            self.usage[stage].value = max(self.usage[stage].value - n_bytes, 0)
+            self.condition.notify_all()
+
+    def release_all(self, stage):
+        """Empty the stage, e.g. once its consumer has stopped"""
+        with self.condition:
+            self.usage[stage].value = 0
+            self.condition.notify_all()
+
+    def room(self, stage):
+        """Bytes left in the stage's share"""
+        return max(self.share(stage) - self.usage[stage].value, 0)
+
+    def over(self, stage):
+        """Is the stage using more than its share?"""
+        return self.usage[stage].value > self.share(stage)
+
+    def observe_chunk(self, table, chunk, n_bytes):
+        """Record the table's bytes per row, for :obj:`max_rows`"""
+        if len(chunk) > 0:
+            self.bytes_per_row[table] = n_bytes / len(chunk)
+
+    def max_rows(self, table, rows):
+        """Cap the number of rows in the table's next chunk at
+        :obj:`chunk_bytes`, once its size per row is known.
+
+        Args:
+            table (str): Table name.
+            rows (int or function): Rows otherwise in the next chunk, or a
+                                    function returning them.
+        """
+        n_rows = rows() if callable(rows) else rows
+        if table not in self.bytes_per_row:
+            return n_rows
+        return min(n_rows, max(int(self.chunk_bytes / self.bytes_per_row[table]), 1))
+
+    def spooled_file(self, n_files=1):
+        """A temporary file, held in memory until it outgrows an equal part
+        of the downloads' share between `n_files`, then spilled to disk"""
+        return SpooledTemporaryFile(max_size=self.share("download") // n_files,
+                                    dir=self.spill_dir)
+
+    def record(self, metrics):
+        """Set the peak usage of each stage, and of the process, as gauges"""
+        for stage, peak in self.peaks.items():
+            metrics.set(f"memory_peak_{stage}_bytes", peak.value)
+        metrics.set("memory_peak_rss_bytes", peak_rss())
+
+    def summary(self):
+        """One line of the peak usage of each stage, against its share"""
+        peaks = ", ".join(f"{stage} {peak.value/2**20:,.0f}/"
+                          f"{self.share(stage)/2**20:,.0f} MB"
+                          for stage, peak in self.peaks.items())
+        return (f"Peak memory: {peaks}; "
+                f"process {peak_rss()/2**20:,.0f}/{self.max_memory/2**20:,.0f} MB")
@@ -0,0 +1,299 @@
+'''Counters, timers and latency percentiles for each stage of a load, with
+progress and ETA, exportable as JSON or as a Prometheus textfile.'''
+
+from collections import defaultdict
+from contextlib import contextmanager
+import json
+import logging
+import numpy as np
+import os
+import random
+import threading
+import time
+
+PERCENTILES = (50, 90, 99)
+MAX_SAMPLES = 10000  # Latencies kept per metric, as a uniform reservoir
+PROMETHEUS_PREFIX = "pypatstat"
+
+
+def merge_reservoirs(samples, n_observed, other, n_other, max_samples):
+    """Combine two uniform reservoirs of samples into one of the combined
+    stream, taking from each in proportion to the observations it stands for.
+
+    Args:
+        samples, other (list): The two reservoirs.
+        n_observed, n_other (int): Number of observations each was drawn from.
+        max_samples (int): Size of the combined reservoir.
+    Returns:
+        samples (list): The combined reservoir.
+    """
+    if n_observed + n_other <= max_samples:
+        return samples + other
+    # The number of the combined sample's observations which are in the
+    # first stream, had the streams been sampled as one
+    n_first = int(np.random.hypergeometric(n_observed, n_other, max_samples))
+    n_first = min(n_first, len(samples))
+    n_second = min(max_samples - n_first, len(other))
+    return random.sample(samples, n_first) + random.sample(other, n_second)
+
+
+class Metrics:
+    """Thread-safe counters (e.g. rows inserted), timers (seconds spent in
+    each stage) and latency samples (e.g. per batch insert), each optionally
+    per table. Metrics from other processes are combined with :obj:`merge`.
+
+    Args:
+        max_samples (int): Number of latency samples to keep per metric.
+    """
+    def __init__(self, max_samples=MAX_SAMPLES):
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.gauges = {}
+        self._reset()
+
+    def _reset(self):
+        self.counters = defaultdict(float)
+        self.timers = defaultdict(float)
+        self.samples = defaultdict(list)
+        self.n_observed = defaultdict(int)
+
+    def inc(self, name, value=1, table=None):
+        with self.lock:
+            self.counters[name, table] += value
+
+    def set(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def count(self, name, table=None):
+        """A counter's value for one table, or summed over all tables"""
+        with self.lock:
+            return sum(v for (_name, _table), v in self.counters.items()
+                       if _name == name and table in (None, _table))
+
+    def observe(self, name, seconds, table=None):
+        """Record a latency, and add its time to the timer of the same name"""
+        with self.lock:
+            key = (name, table)
+            self.timers[key] += seconds
+            self.n_observed[key] += 1
+            samples = self.samples[key]
+            if len(samples) < self.max_samples:
+                samples.append(seconds)
+            else:
+                i = random.randrange(self.n_observed[key])
+                if i < self.max_samples:
+                    samples[i] = seconds
+
+    @contextmanager
+    def timer(self, name, table=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.timers[name, table] += time.time() - start
+
+    @contextmanager
+    def latency(self, name, table=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, table=table)
+
+    def percentiles(self, name, table=None):
+        """Latency percentiles, by percentile"""
+        with self.lock:
+            samples = self.samples.get((name, table), [])
+            if len(samples) == 0:
+                return {}
+            return dict(zip(PERCENTILES, np.percentile(samples, PERCENTILES)))
+
+    def pop(self):
+        """Take a snapshot of the counters, timers and samples and reset
+        them, e.g. to report a worker process's metrics back to the parent"""
+        with self.lock:
+            snapshot = {"gauges": dict(self.gauges),
+                        "counters": dict(self.counters),
+                        "timers": dict(self.timers),
+                        "samples": dict(self.samples),
+                        "n_observed": dict(self.n_observed)}
+            self._reset()
+        return snapshot
+
+    def merge(self, snapshot):
+        """Add the metrics of a snapshot, from :obj:`pop`"""
+        with self.lock:
+            self.gauges.update(snapshot.get("gauges", {}))
+            for key, value in snapshot["counters"].items():
+                self.counters[key] += value
+            for key, value in snapshot["timers"].items():
+                self.timers[key] += value
+            for key, samples in snapshot["samples"].items():
+                n_observed = snapshot["n_observed"].get(key, len(samples))
+                self.samples[key] = merge_reservoirs(self.samples[key],
+                                                     self.n_observed[key],
+                                                     samples, n_observed,
+                                                     self.max_samples)
+            for key, value in snapshot["n_observed"].items():
+                self.n_observed[key] += value
+
+    def progress(self):
+        """Progress through the download, and the estimated time remaining.
+        The total size is estimated from the archives downloaded so far,
+        extrapolated to the number of archives to load.
+
+        Returns:
+            fraction, eta (float, float): Fraction of the (compressed) bytes
+                                          loaded so far, and seconds left.
+                                          Both are None until known.
+        """
+        n_archives = self.gauges.get("archives_total")
+        n_seen = self.count("archives_downloaded")
+        if not n_archives or not n_seen:
+            return None, None
+        total = self.count("bytes_downloaded") / n_seen * n_archives
+        fraction = min(self.count("bytes_loaded") / total, 1) if total else 0
+        if fraction == 0:
+            return fraction, None
+        return fraction, (time.time() - self.start) * (1 - fraction) / fraction
+
+    def to_dict(self):
+        """All metrics, with counters and timers by table"""
+        fraction, eta = self.progress()
+        data = {"elapsed_seconds": time.time() - self.start,
+                "progress": fraction, "eta_seconds": eta,
+                "gauges": dict(self.gauges),
+                "counters": defaultdict(dict), "timers": defaultdict(dict),
+                "latencies": defaultdict(dict)}
+        with self.lock:
+            counters, timers = dict(self.counters), dict(self.timers)
+            n_observed = dict(self.n_observed)
+        for (name, table), value in counters.items():
+            data["counters"][name][table or "all"] = value
+        for (name, table), value in timers.items():
+            data["timers"][name][table or "all"] = value
+        for (name, table), n in n_observed.items():
+            data["latencies"][name][table or "all"] = {
+                "count": n, **{f"p{p}": v for p, v
+                               in self.percentiles(name, table).items()}}
+        return data
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        """All metrics in the Prometheus text exposition format, e.g. for
+        node_exporter's textfile collector"""
+        def labels(table, **extra):
+            _labels = {} if table is None else {"table": table}
+            _labels.update(extra)
+            if not _labels:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in _labels.items()) + "}"
+
+        lines = []
+        with self.lock:
+            counters, timers = dict(self.counters), dict(self.timers)
+            n_observed = dict(self.n_observed)
+        for name in sorted({name for name, _ in counters}):
+            metric = f"{PROMETHEUS_PREFIX}_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines += [f"{metric}{labels(table)} {value}"
+                      for (_name, table), value in counters.items() if _name == name]
+        for name in sorted({name for name, _ in timers}):
+            if any(_name == name for _name, _ in n_observed):
+                continue  # Exported as a summary below
+            metric = f"{PROMETHEUS_PREFIX}_{name}_seconds_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines += [f"{metric}{labels(table)} {value}"
+                      for (_name, table), value in timers.items() if _name == name]
+        for name in sorted({name for name, _ in n_observed}):
+            metric = f"{PROMETHEUS_PREFIX}_{name}_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            for (_name, table), n in n_observed.items():
+                if _name != name:
+                    continue
+                for p, value in self.percentiles(name, table).items():
+                    lines.append(f"{metric}{labels(table, quantile=p / 100)} {value}")
+                lines.append(f"{metric}_sum{labels(table)} {timers[name, table]}")
+                lines.append(f"{metric}_count{labels(table)} {n}")
+        fraction, eta = self.progress()
+        for name, value in [("progress_ratio", fraction), ("eta_seconds", eta),
+                            *self.gauges.items()]:
+            if value is None:
+                continue
+            metric = f"{PROMETHEUS_PREFIX}_{name}"
+            lines += [f"# TYPE {metric} gauge", f"{metric} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """A one line summary of progress, for the logs"""
+        fraction, eta = self.progress()
+        text = (f"{self.count('rows_parsed'):,.0f} rows parsed, "
+                f"{self.count('rows_inserted'):,.0f} inserted, "
+                f"{self.count('bytes_downloaded')/2**20:,.0f} MB downloaded")
+        if fraction is not None:
+            text += f", {fraction:.1%} done"
+        if eta is not None:
+            text += f", ETA {eta/3600:.1f}h"
+        return text
+
+
+def write_metrics(metrics, path):
+    """Write the metrics to a file, atomically so that readers (e.g.
+    node_exporter) never see a partial file. Files ending in `.prom` are
+    written in the Prometheus text format, and the rest as JSON."""
+    text = metrics.to_prometheus() if path.endswith(".prom") else metrics.to_json()
+    with open(f"{path}.part", "w") as f:
+        f.write(text)
+    os.replace(f"{path}.part", path)
+
+
+class MetricsReporter:
+    """Periodically log a summary of the metrics, and export them to a file,
+    from a background thread, and once more on exit.
+
+    Args:
+        metrics (:obj:`Metrics`): The metrics to report.
+        path (str): File to write, see :obj:`write_metrics`. If not
+                    specified, the metrics are only logged.
+        interval (float): Seconds between reports.
+    """
+    def __init__(self, metrics, path=None, interval=60):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def report(self):
+        logging.info(f"Progress: {self.metrics.summary()}")
+        if self.path is not None:
+            write_metrics(self.metrics, self.path)
+
+    def _run(self):
+        while not self._done.wait(self.interval):
+            self.report()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._done.set()
+        self._thread.join()
+        self.report()
+
+
+def timed(iterable, metrics, name, table=None):
+    """Iterate, adding the time spent waiting on each item to a timer"""
+    iterator = iter(iterable)
+    while True:
+        with metrics.timer(name, table=table):
+            item = next(iterator, StopIteration)
+        if item is StopIteration:
+            return
+        yield item
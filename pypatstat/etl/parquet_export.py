@@ -0,0 +1,267 @@
+'''Export PATSTAT to a set of Parquet datasets, one per table, as an
+alternative to loading a database. Column types are taken from the ORM.'''
+
+from pypatstat.etl.utils import login
+from pypatstat.etl.utils import _zipfiles_on_pages
+from pypatstat.etl.utils import stream_zip_members
+from pypatstat.etl.utils import fork_context
+from pypatstat.etl.schema_maker import patstat_base
+from pypatstat.etl.schema_maker import INDEX_DOC_STR
+from pypatstat.etl.dtypes import sql_type_name
+from pypatstat.etl.dtypes import column_dtype
+from pypatstat.etl.data_loader import read_chunks
+from pypatstat.etl.data_loader import null_pk_mask
+from pypatstat.etl.data_loader import get_class_by_tablename
+from pypatstat.etl.data_loader import nested_files_to_load
+from pypatstat.etl.data_loader import local_zipfile_path
+from concurrent.futures import ProcessPoolExecutor
+from zipfile import ZipFile
+import logging
+import os
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+ARROW_TYPES = {"INTEGER": pa.int32(), "INT": pa.int32(),
+               "SMALLINT": pa.int16(), "TINYINT": pa.int16(),
+               "BIGINT": pa.int64(), "REAL": pa.float32(),
+               "FLOAT": pa.float64(), "DATE": pa.date32()}
+# Partition these tables by a natural column, and the rest by ID range
+PARTITION_COLUMNS = {"tls201_appln": "appln_filing_year"}
+BUCKET_SUFFIX = "_bucket"
+ID_BUCKET_SIZE = 10**7
+MIN_ROWS_PER_GROUP = 10**5
+
+
+def arrow_type(column):
+    """The Arrow type of an ORM column"""
+    type_name = sql_type_name(column)
+    if type_name in ARROW_TYPES:
+        return ARROW_TYPES[type_name]
+    if column_dtype(column) == "category":
+        return pa.dictionary(pa.int32(), pa.string())
+    return pa.string()
+
+
+def partition_column(_class):
+    """The column by which to partition a table's dataset.
+
+    Args:
+        _class: SQLalchemy ORM object.
+    Returns:
+        name, source (str, str): Name of the partition column, and of the
+                                 column from which it is derived. Both are
+                                 None if the table isn't partitioned.
+    """
+    table = _class.__table__
+    name = PARTITION_COLUMNS.get(table.name)
+    if name in table.columns.keys():  # Unless left out by project_base
+        return name, name
+    pk = list(table.primary_key.columns)[0]
+    if pa.types.is_integer(arrow_type(pk)):
+        return f"{pk.name}{BUCKET_SUFFIX}", pk.name
+    return None, None
+
+
+def arrow_schema(_class):
+    """The Arrow schema of a table's dataset, including the partition column"""
+    fields = [pa.field(col.name, arrow_type(col), nullable=not col.primary_key)
+              for col in _class.__table__.columns]
+    name, source = partition_column(_class)
+    if name is not None and name != source:
+        fields.append(pa.field(name, pa.int32()))
+    return pa.schema(fields)
+
+
+def chunk_to_record_batch(chunk, _class, schema):
+    """Convert a CSV chunk to an Arrow record batch, dropping null-PK rows and
+    adding the partition column. Columns missing from the CSV are null.
+
+    Args:
+        chunk (:obj:`pd.DataFrame`): A chunk of the CSV, as read with the
+                                     ORM's dtypes by :obj:`read_chunks`.
+        _class: SQLalchemy ORM object.
+        schema (:obj:`pa.Schema`): The table's schema, from :obj:`arrow_schema`.
+    Returns:
+        batch (:obj:`pa.RecordBatch`)
+    """
+    chunk = chunk.loc[~null_pk_mask(chunk, _class)]
+    name, source = partition_column(_class)
+    if name is not None and name != source:
+        chunk = chunk.assign(**{name: (chunk[source] // ID_BUCKET_SIZE).astype("Int32")})
+    arrays = [pa.array(chunk[field.name], type=field.type, from_pandas=True)
+              if field.name in chunk else pa.nulls(len(chunk), field.type)
+              for field in schema]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def nested_file_to_parquet(zf, fname, out_dir, Base, chunksize=10000,
+                           compression="zstd"):
+    """Write one nested (zipped CSV) file of a zipfile to its table's dataset.
+    Files are named after the nested file, so rewriting it (e.g. after a
+    failure) replaces its previous output.
+
+    Args:
+        zf (ZipFile): The open zipfile.
+        fname (str): Name of the nested file in the zipfile.
+        out_dir (str): Directory holding one dataset per table.
+        Base: SQLalchemy ORM Base object.
+        chunksize (int): Size parameter to pass to :obj:`pd.read_csv`.
+        compression (str): Parquet compression codec.
+    Returns:
+        n_rows (int): The number of rows written.
+    """
+    logging.info(f"\tProcessing nested file {fname}...")
+    tablename = fname.split("_")[0]
+    _class = get_class_by_tablename(Base, tablename)
+    schema = arrow_schema(_class)
+    name, _ = partition_column(_class)
+    n_rows = 0
+
+    def batches():
+        nonlocal n_rows
+        with zf.open(fname) as z:
+            for _, f in stream_zip_members(z):
+                for chunk in read_chunks(f, chunksize=chunksize, _class=_class):
+                    batch = chunk_to_record_batch(chunk, _class, schema)
+                    n_rows += batch.num_rows
+                    yield batch
+
+    stem = os.path.splitext(os.path.basename(fname))[0]
+    ds.write_dataset(batches(), os.path.join(out_dir, _class.__tablename__),
+                     schema=schema, format="parquet",
+                     partitioning=None if name is None else [name],
+                     partitioning_flavor="hive",
+                     basename_template=f"{stem}-{{i}}.parquet",
+                     existing_data_behavior="overwrite_or_ignore",
+                     min_rows_per_group=MIN_ROWS_PER_GROUP,
+                     file_options=ds.ParquetFileFormat().make_write_options(
+                         compression=compression))
+    logging.info(f"\t\tWritten {n_rows} entries for {tablename}.")
+    return n_rows
+
+
+_worker_base = None
+
+
+def _init_worker(Base):
+    """Give each worker process the ORM, which can't be pickled per task"""
+    global _worker_base
+    _worker_base = Base
+
+
+def _nested_file_to_parquet(zip_path, fname, out_dir, chunksize, compression):
+    """Write one nested file of the zipfile, in a worker process"""
+    with ZipFile(zip_path) as zf:
+        return nested_file_to_parquet(zf, fname, out_dir, _worker_base,
+                                      chunksize=chunksize,
+                                      compression=compression)
+
+
+def zipfile_to_parquet(zipfile, out_dir, Base, chunksize=10000,
+                       skip_table_prefixes=[], restart_filename=None,
+                       n_workers=1, compression="zstd"):
+    """Write a zipfile contents (assumed zipped CSV) to Parquet datasets.
+
+    Args:
+        zipfile (ZipFile): A zipfile, assumed to contained zipped CSVs.
+        out_dir (str): Directory holding one dataset per table.
+        Base: SQLalchemy ORM Base object.
+        chunksize (int): Size parameter to pass to :obj:`pd.read_csv`.
+        skip_table_prefixes (list): Skip table names with these prefixes.
+        restart_filename (str): Skip nested files until this one.
+        n_workers (int): Number of processes writing nested files in parallel.
+        compression (str): Parquet compression codec.
+    Returns:
+        n_rows (int): The number of rows written.
+    """
+    fnames = [fname for fname, _ in nested_files_to_load(zipfile,
+                                                         skip_table_prefixes,
+                                                         restart_filename)]
+    if n_workers <= 1:
+        with ZipFile(zipfile) as zf:
+            n_rows = sum(nested_file_to_parquet(zf, fname, out_dir, Base,
+                                                chunksize=chunksize,
+                                                compression=compression)
+                         for fname in fnames)
+    else:
+        with local_zipfile_path(zipfile) as zip_path, \
+             ProcessPoolExecutor(n_workers, mp_context=fork_context(),
+                                 initializer=_init_worker,
+                                 initargs=(Base,)) as executor:
+            futures = [executor.submit(_nested_file_to_parquet, zip_path,
+                                       fname, out_dir, chunksize,
+                                       compression) for fname in fnames]
+            n_rows = sum(future.result() for future in futures)
+    zipfile.close()
+    return n_rows
+
+
+def _download_patstat_to_parquet(out_dir, Base, chunksize=10000,
+                                 skip_table_prefixes=[], restart_filename=None,
+                                 download_suffix='', cache_dir=None,
+                                 n_download_workers=1, n_workers=1,
+                                 compression="zstd", **session_credentials):
+    """Download all patstat global data and write to Parquet datasets.
+
+    Args:
+        out_dir (str): Directory holding one dataset per table.
+        Base: SQLalchemy ORM Base object.
+        chunksize (int): Size parameter to pass to :obj:`pd.read_csv`.
+        cache_dir (str): Directory in which to cache (and resume) downloads.
+        n_download_workers (int): Number of archives to download concurrently.
+        n_workers (int): Number of processes writing nested files in parallel.
+        compression (str): Parquet compression codec.
+    """
+    for url, zipfile in _zipfiles_on_pages(download_suffix=download_suffix,
+                                           cache_dir=cache_dir,
+                                           n_download_workers=n_download_workers,
+                                           skip_urls=[INDEX_DOC_STR],
+                                           **session_credentials):
+        logging.info(f"Processing file {url}...")
+        zipfile_to_parquet(zipfile, out_dir, Base, chunksize=chunksize,
+                           skip_table_prefixes=skip_table_prefixes,
+                           restart_filename=restart_filename,
+                           n_workers=n_workers, compression=compression)
+
+
+def download_patstat_to_parquet(patstat_usr, patstat_pwd, out_dir,
+                                chunksize=10000, skip_table_prefixes=[],
+                                download_suffix='', restart_filename=None,
+                                cache_dir=None, n_download_workers=1,
+                                n_workers=1, compression="zstd", columns=None):
+    """Automatically generate the PATSTAT schema and write all tables to
+    typed, compressed and partitioned Parquet datasets.
+
+    Args:
+        patstat_{usr, pwd} (str): PATSTAT username and password.
+        out_dir (str): Directory in which to create the datasets.
+        chunksize (int): Size parameter to pass to :obj:`pd.read_csv`.
+        cache_dir (str): Directory in which to cache (and resume) downloads.
+        n_download_workers (int): Number of archives to download concurrently.
+        n_workers (int): Number of processes writing nested files in parallel.
+        compression (str): Parquet compression codec.
+        columns (dict): Write only these columns (and the primary key) of
+                        these tables, by table name.
+    Returns:
+        out_dir (str): Directory holding one dataset per table.
+    """
+    # Log into the PATSTAT website
+    session = login(username=patstat_usr, pwd=patstat_pwd)
+    logging.info("Downloading and generating the schema...")
+    # Generate the PATSTAT Global schema
+    db_suffix, Base = patstat_base(session, columns=columns)
+    out_dir = os.path.join(out_dir, f"patstat_{db_suffix}")
+    logging.info(f"Generated the schema for {db_suffix}. "
+                 f"Datasets will be written to {out_dir}")
+    # Download the data and write the datasets
+    _download_patstat_to_parquet(out_dir=out_dir, chunksize=chunksize,
+                                 Base=Base,
+                                 skip_table_prefixes=skip_table_prefixes,
+                                 restart_filename=restart_filename,
+                                 download_suffix=download_suffix,
+                                 cache_dir=cache_dir,
+                                 n_download_workers=n_download_workers,
+                                 n_workers=n_workers, compression=compression,
+                                 username=patstat_usr,
+                                 pwd=patstat_pwd)
+    return out_dir
@@ -0,0 +1,262 @@
+'''Run the stages of a load concurrently, each in its own thread, connected
+by bounded queues. A stage which gets ahead blocks once its queue is full
+(backpressure), so memory is bounded by the depth of each queue, and the
+load runs at the pace of its slowest stage.
+
+Downloading and decompressing spend most of their time in code which
+releases the GIL, so they run in threads. Parsing and writing don't, so
+stages which compete with them for the GIL can instead run in a child
+process, whose items are pickled back to the consumer. The child is forked
+(see :obj:`fork_context`), so this needs a POSIX system. It is forked while
+other threads of the parent (e.g. the metrics reporter and downloads) are
+running, so it mustn't rely on locks they may hold.'''
+
+from contextlib import contextmanager
+from io import BufferedReader
+from io import RawIOBase
+from functools import partial
+import pickle
+import queue
+import threading
+import time
+import traceback
+
+from pypatstat.etl.metrics import Metrics
+from pypatstat.etl.utils import STREAM_BLOCK_SIZE
+from pypatstat.etl.utils import fork_context
+
+# Queue depth of each stage: archives downloaded ahead, blocks of
+# STREAM_BLOCK_SIZE decompressed ahead, and chunks parsed ahead of the writer
+PIPELINE_DEPTHS = {"download": 1, "decompress": 16, "parse": 4}
+POLL_INTERVAL = 0.1  # Seconds between checks for the consumer having stopped
+REPORT_INTERVAL = 1  # Seconds between sending metrics back from a child process
+JOIN_TIMEOUT = 10  # Seconds to wait for a stopped child process to exit
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class RemoteTraceback(Exception):
+    """The traceback of an exception raised in a child process"""
+    def __str__(self):
+        return self.args[0]
+
+
+def queue_depths(depths=None):
+    """The default depth of each stage's queue, updated with `depths`"""
+    return {**PIPELINE_DEPTHS, **(depths or {})}
+
+
+def prefetch(iterable, depth=1, name=None, metrics=None, table=None):
+    """Iterate in a background thread, up to `depth` items ahead of the
+    consumer. Exceptions are raised in the consumer, and closing the
+    generator stops the background thread (and closes the iterable).
+
+    Args:
+        iterable: The stage, e.g. a generator.
+        depth (int): Maximum number of items waiting in the queue.
+        name (str): Name of the stage, for the metrics.
+        metrics (:obj:`Metrics`): If specified, the time spent by the consumer
+                                  waiting on the stage (`{name}_wait`) and by
+                                  the stage waiting on the consumer
+                                  (`{name}_blocked`) are recorded.
+        table (str): Table name, for the metrics.
+    Yields:
+        The items of the iterable.
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if items.full() and metrics is not None:
+                    with metrics.timer(f"{name}_blocked", table=table):
+                        ok = put(item)
+                else:
+                    ok = put(item)
+                if not ok:
+                    return
+            put(_DONE)
+        except BaseException as exc:
+            put(_Failure(exc))
+        finally:
+            if hasattr(iterator, "close"):
+                iterator.close()
+
+    thread = threading.Thread(target=produce, daemon=True,
+                              name=f"pypatstat-{name or 'prefetch'}")
+    thread.start()
+    try:
+        while True:
+            if items.empty() and metrics is not None:
+                with metrics.timer(f"{name}_wait", table=table):
+                    item = items.get()
+            else:
+                item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.exc
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class PrefetchReader(RawIOBase):
+    """A binary file whose blocks are read ahead in a background thread,
+    e.g. to decompress a CSV while the previous blocks are being parsed.
+
+    Args:
+        f: Binary file-like object to read.
+        depth (int): Number of blocks to read ahead.
+        block_size (int): Size of each block.
+        {name, metrics, table}: See :obj:`prefetch`.
+    """
+    def __init__(self, f, depth, block_size=STREAM_BLOCK_SIZE, name=None,
+                 metrics=None, table=None):
+        self.blocks = prefetch(iter(partial(f.read, block_size), b""), depth,
+                               name=name, metrics=metrics, table=table)
+        self.pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self.pending:
+            self.pending = next(self.blocks, b"")
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def close(self):
+        self.blocks.close()
+        super().close()
+
+
+@contextmanager
+def prefetch_reader(f, depth, **kwargs):
+    """A buffered :obj:`PrefetchReader` of the file, closed on exit, or the
+    file itself if `depth` is zero"""
+    if depth == 0:
+        yield f
+        return
+    reader = BufferedReader(PrefetchReader(f, depth, **kwargs), STREAM_BLOCK_SIZE)
+    try:
+        yield reader
+    finally:
+        reader.close()
+
+
+def _produce_in_process(make_iterable, args, items, stop, report_interval):
+    """Put the items of `make_iterable(metrics, *args)` on the queue, along
+    with snapshots of the metrics, until done or told to stop"""
+    def put(message):
+        while not stop.is_set():
+            try:
+                items.put(message, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    metrics = Metrics()
+    last_report = time.time()
+    try:
+        for item in make_iterable(metrics, *args):
+            if time.time() - last_report > report_interval:
+                last_report = time.time()
+                put(("metrics", metrics.pop()))
+            if not put(("item", item)):
+                break
+        else:
+            put(("metrics", metrics.pop()))
+            put(("done", None))
+    except BaseException as exc:
+        tb = traceback.format_exc()
+        try:
+            pickle.dumps(exc)
+        except Exception:
+            exc = RuntimeError(repr(exc))
+        put(("metrics", metrics.pop()))
+        put(("error", (exc, tb)))
+    if stop.is_set():
+        items.cancel_join_thread()  # Don't wait for the consumer to drain it
+
+
+def prefetch_process(make_iterable, args=(), depth=1, name=None, metrics=None,
+                     report_interval=REPORT_INTERVAL):
+    """Like :obj:`prefetch`, but iterate in a child process, up to `depth`
+    items ahead of the consumer. The child is explicitly forked, whatever
+    the platform's default start method, so the arguments needn't be
+    picklable, but the items must be, and fork must be available (i.e. on
+    POSIX systems). Exceptions are raised in the consumer, with the child's
+    traceback as their cause.
+
+    Args:
+        make_iterable: Function returning the iterable, called in the child
+                       as `make_iterable(child_metrics, *args)`.
+        args (tuple): Further arguments of `make_iterable`.
+        depth (int): Maximum number of items waiting in the queue.
+        name (str): Name of the stage, for the metrics.
+        metrics (:obj:`Metrics`): If specified, the child's metrics are merged
+                                  into these every `report_interval` seconds,
+                                  and the time spent by the consumer waiting
+                                  on the child is recorded (`{name}_wait`).
+        report_interval (float): Seconds between merging the child's metrics.
+    Yields:
+        The items of the iterable.
+    """
+    context = fork_context()
+    items = context.Queue(maxsize=depth)
+    stop = context.Event()
+    process = context.Process(target=_produce_in_process,
+                              args=(make_iterable, args, items, stop,
+                                    report_interval),
+                              name=f"pypatstat-{name or 'prefetch'}",
+                              daemon=True)
+    process.start()
+    try:
+        while True:
+            start = time.time()
+            try:
+                kind, payload = items.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if not process.is_alive():
+                    raise RuntimeError(f"The {name or 'prefetch'} process exited "
+                                       f"with code {process.exitcode}")
+                continue
+            finally:
+                if metrics is not None:
+                    with metrics.lock:
+                        metrics.timers[f"{name}_wait", None] += time.time() - start
+            if kind == "item":
+                yield payload
+            elif kind == "metrics" and metrics is not None:
+                metrics.merge(payload)
+            elif kind == "error":
+                exc, tb = payload
+                raise exc from RemoteTraceback(tb)
+            elif kind == "done":
+                return
+    finally:
+        stop.set()
+        process.join(JOIN_TIMEOUT)
+        if process.is_alive():
+            process.terminate()
+            process.join()
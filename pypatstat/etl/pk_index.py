@@ -0,0 +1,208 @@
+'''A compact, sorted in-memory index of the primary keys already in a table,
+for filtering out rows on restart where the database can't skip them.'''
+
+from pypatstat.etl.dtypes import sql_type_name
+from sqlalchemy import and_
+from sqlalchemy import or_
+from sqlalchemy import select
+import logging
+import numpy as np
+import pandas as pd
+import tempfile
+
+PK_INT_DTYPES = {"INTEGER": "i4", "INT": "i4", "SMALLINT": "i2",
+                 "TINYINT": "i2", "BIGINT": "i8"}
+# Single-byte string types, whose (ASCII) codes are held as UTF-8 bytes
+# rather than as numpy's 4-byte-per-character unicode
+PK_BYTES_TYPES = {"VARCHAR", "CHAR"}
+
+
+def pk_dtype(_class):
+    """The numpy (structured) dtype of a table's primary key. Integers take
+    their SQL width, VARCHAR/CHAR codes one byte per character and other
+    strings (e.g. NVARCHAR) four bytes per character.
+
+    Args:
+        _class: SQLalchemy ORM object.
+    Returns:
+        dtype (:obj:`np.dtype`): One field per primary key column.
+    """
+    fields = []
+    for pkey in _class.__table__.primary_key.columns:
+        type_name = sql_type_name(pkey)
+        length = getattr(pkey.type, "length", None)
+        if type_name in PK_INT_DTYPES:
+            fields.append((pkey.name, PK_INT_DTYPES[type_name]))
+        elif length is not None and type_name in PK_BYTES_TYPES:
+            fields.append((pkey.name, f"S{length}"))
+        elif length is not None:
+            fields.append((pkey.name, f"U{length}"))
+        else:
+            fields.append((pkey.name, "O"))
+    return np.dtype(fields)
+
+
+def _pk_column(values, field):
+    """PK values as an object series ready to cast to the field's dtype"""
+    values = pd.Series(values, dtype=object).fillna(0 if field.kind == "i" else "")
+    if field.kind == "S":
+        values = values.map(lambda value: value if isinstance(value, bytes)
+                            else str(value).encode("utf-8"))
+    return values
+
+
+def to_pk_array(columns, dtype):
+    """Pack columns of PK values into a structured array of the PK dtype"""
+    keys = np.empty(len(columns[0]) if columns else 0, dtype=dtype)
+    for name, values in zip(dtype.names, columns):
+        field = dtype.fields[name][0]
+        keys[name] = _pk_column(values, field).to_numpy().astype(field)
+    return keys
+
+
+def overlong_keys(columns, dtype):
+    """Flag the keys with a byte string too long for its field (e.g. with
+    non-ASCII characters), which would be truncated in a PK array"""
+    overlong = np.zeros(len(columns[0]) if columns else 0, dtype=bool)
+    for name, values in zip(dtype.names, columns):
+        field = dtype.fields[name][0]
+        if field.kind == "S":
+            lengths = _pk_column(values, field).map(len).to_numpy(dtype=int)
+            overlong |= lengths > field.itemsize
+    return overlong
+
+
+def from_pk_array(keys):
+    """Unpack a PK array into a list of tuples of (str, not byte) values,
+    e.g. to query by"""
+    return [tuple(value.decode("utf-8") if isinstance(value, bytes) else value
+                  for value in key) for key in keys.tolist()]
+
+
+def keys_after(pkey_cols, last):
+    """The keyset condition for PKs after `last`, in PK order, spelled out
+    as `a > x OR (a = x AND b > y) OR ...` as SQL Server and Oracle have no
+    row-value comparison.
+
+    Args:
+        pkey_cols (list): PK columns, in order.
+        last (tuple): Values of the last PK read.
+    """
+    return or_(*(and_(*(col == value for col, value in zip(pkey_cols, last[:i])),
+                      pkey_cols[i] > last[i])
+                 for i in range(len(pkey_cols))))
+
+
+class PkIndex:
+    """A sorted structured array of a table's primary keys, with one field per
+    PK column, so that each key takes only a few bytes (or a few tens of
+    bytes for string keys, see :obj:`pk_dtype`).
+
+    Args:
+        _class: SQLalchemy ORM object.
+        keys (:obj:`np.array`): PKs with the dtype of :obj:`pk_dtype`, which
+                                are sorted in place.
+        spill_file: The temporary file which `keys` are mapped from, if any.
+    """
+    def __init__(self, _class, keys, spill_file=None):
+        self._class = _class
+        keys.sort()
+        self.keys = keys
+        self.spill_file = spill_file
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def nbytes(self):
+        """Bytes of keys held in memory"""
+        return 0 if self.spill_file is not None else self.keys.nbytes
+
+    def spill(self, directory=None):
+        """Move the keys to a temporary file, and memory-map them from it,
+        so that they are paged in by the OS as needed. Keys with variable
+        length (object) fields can't be mapped.
+
+        Args:
+            directory (str): Directory for the temporary file.
+        Returns:
+            spilled (bool): Whether the keys were spilled.
+        """
+        if self.spill_file is not None or self.keys.dtype.hasobject:
+            return False
+        self.spill_file = tempfile.NamedTemporaryFile(suffix=".npy",
+                                                      dir=directory)
+        np.save(self.spill_file, self.keys)
+        self.spill_file.flush()
+        self.keys = np.load(self.spill_file.name, mmap_mode="r")
+        return True
+
+    @classmethod
+    def from_db(cls, conn, _class, chunksize=100000, max_bytes=None,
+                spill_dir=None):
+        """Read all PKs from the table, one page at a time, with keyset
+        (WHERE pk > last ORDER BY pk, see :obj:`keys_after`) rather than
+        OFFSET pagination. Once the pages held exceed `max_bytes`, they are
+        written to a temporary file, and the keys memory-mapped from it (as
+        with :obj:`spill`), so that the whole index is never held in memory.
+
+        Args:
+            conn: An SQLalchemy engine or connection.
+            _class: SQLalchemy ORM object.
+            chunksize (int): Number of PKs to read per page.
+            max_bytes (int): Bytes of pages to hold in memory before spilling.
+            spill_dir (str): Directory for the temporary file.
+        """
+        pkey_cols = list(_class.__table__.primary_key.columns)
+        dtype = pk_dtype(_class)
+        q = select(pkey_cols).order_by(*pkey_cols).limit(chunksize)
+        pages, last, n_keys, spill_file = [], None, 0, None
+        while True:
+            page_q = q if last is None else q.where(keys_after(pkey_cols, last))
+            rows = conn.execute(page_q).fetchall()
+            if len(rows) == 0:
+                break
+            pages.append(to_pk_array(list(zip(*rows)), dtype))
+            n_keys += len(rows)
+            last = tuple(rows[-1])
+            if max_bytes is not None and not dtype.hasobject and \
+                    sum(page.nbytes for page in pages) > max_bytes:
+                if spill_file is None:
+                    spill_file = tempfile.NamedTemporaryFile(suffix=".keys",
+                                                             dir=spill_dir)
+                for page in pages:
+                    spill_file.write(page.tobytes())
+                pages = []
+            if len(rows) < chunksize:
+                break
+        if spill_file is not None:
+            for page in pages:
+                spill_file.write(page.tobytes())
+            spill_file.flush()
+            keys = np.memmap(spill_file.name, dtype=dtype, mode="r+",
+                             shape=(n_keys,))
+        else:
+            keys = np.concatenate(pages) if pages else np.empty(0, dtype=dtype)
+        del pages
+        index = cls(_class, keys, spill_file=spill_file)
+        logging.info(f"Loaded {len(index)} PKs ({index.nbytes} bytes in memory) "
+                     f"for {_class.__tablename__}")
+        return index
+
+    def contains(self, batch):
+        """Flag which rows of the batch have a PK in the index. Keys too long
+        for the index's fields are never flagged, as they can't be compared.
+
+        Args:
+            batch (:obj:`Batch`): Rows of data.
+        Returns:
+            mask (:obj:`np.array`): True for rows whose PK is in the index.
+        """
+        dtype = self.keys.dtype
+        columns = [batch.values[batch.columns.index(name)] for name in dtype.names]
+        keys = to_pk_array(columns, dtype)
+        if len(self.keys) == 0:
+            return np.zeros(len(keys), dtype=bool)
+        idx = np.searchsorted(self.keys, keys)
+        idx[idx == len(self.keys)] = 0
+        return (self.keys[idx] == keys) & ~overlong_keys(columns, dtype)
@@ -0,0 +1,215 @@
+'''Opt-in profiling of the loader's hot paths (decompressing, parsing,
+converting and inserting) for a sample of the chunks of each table, with
+cProfile or a stack sampling profiler, and with tracemalloc snapshots.
+
+For each table, a profile is dumped alongside a summary of its hotspots and
+top allocators. Files are suffixed with the process ID, since each worker
+process profiles the nested files that it loads.'''
+
+from collections import Counter
+from collections import defaultdict
+from io import StringIO
+import cProfile
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import tracemalloc
+
+PROFILE_MODES = ("cprofile", "sample")
+SAMPLE_INTERVAL = 0.005  # Seconds between stack samples
+N_TOP = 25  # Hotspots and allocators in each summary
+
+
+class StackSampler:
+    """A sampling profiler, which periodically records the call stack of
+    the thread that started it, from a background thread. Unlike cProfile,
+    its overhead doesn't grow with the number of function calls.
+
+    Args:
+        interval (float): Seconds between samples.
+    """
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self._done = None
+
+    def enable(self):
+        self._thread_id = threading.get_ident()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def disable(self):
+        self._done.set()
+        self._thread.join()
+
+    def _sample(self):
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:"
+                             f"{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def dump_stats(self, path):
+        """Write the stacks in the 'folded' format of flamegraph.pl, which
+        speedscope and other flame graph viewers also read"""
+        with open(path, "w") as f:
+            for stack, n in self.stacks.most_common():
+                f.write(f"{stack} {n}\n")
+
+    def hotspots(self, n_top=N_TOP):
+        """The lines most often on top of the stack, and most often anywhere
+        in it, with their fraction of the samples"""
+        total = sum(self.stacks.values()) or 1
+        own, cumulative = Counter(), Counter()
+        for stack, n in self.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += n
+            for frame in set(frames):
+                cumulative[frame] += n
+        lines = [f"{total} samples, every {self.interval * 1000:.0f}ms",
+                 "", "Hotspots (by own samples):"]
+        lines += [f"  {n / total:7.1%}  {frame}" for frame, n in own.most_common(n_top)]
+        lines += ["", "Hotspots (by cumulative samples):"]
+        lines += [f"  {n / total:7.1%}  {frame}"
+                  for frame, n in cumulative.most_common(n_top)]
+        return "\n".join(lines)
+
+
+def _cprofile_hotspots(profile, n_top=N_TOP):
+    stream = StringIO()
+    stats = pstats.Stats(profile, stream=stream)
+    for sort in ("cumulative", "tottime"):
+        stream.write(f"Hotspots (by {sort} time):\n")
+        stats.sort_stats(sort).print_stats(n_top)
+    return stream.getvalue()
+
+
+class Profiler:
+    """Profile the first `n_chunks` chunks of each table, or otherwise a
+    random `fraction` of them, accumulating one profile per table.
+
+    Args:
+        out_dir (str): Directory for the profiles and summaries. If not
+                       specified, nothing is profiled.
+        n_chunks (int): Number of chunks to profile per table.
+        fraction (float): Fraction of chunks to profile, instead of the
+                          first `n_chunks`.
+        mode (str): "cprofile" (deterministic, but slows down the profiled
+                    chunks) or "sample" (see :obj:`StackSampler`).
+    """
+    def __init__(self, out_dir=None, n_chunks=3, fraction=None, mode="cprofile"):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Profile mode should be one of {PROFILE_MODES}, "
+                             f"not '{mode}'")
+        self.out_dir = out_dir
+        self.n_chunks = n_chunks
+        self.fraction = fraction
+        self.mode = mode
+        self.profiles = {}
+        self.n_profiled = Counter()
+        self.n_seen = Counter()
+        self.allocated = defaultdict(Counter)
+        self.peak_memory = Counter()
+        self.active = None
+        if out_dir is not None:
+            os.makedirs(out_dir, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.out_dir is not None
+
+    def sampled(self, table):
+        """Should the next chunk of the table be profiled?"""
+        if self.fraction is not None:
+            return random.random() < self.fraction
+        return self.n_seen[table] < self.n_chunks
+
+    def start(self, table):
+        if self.active is not None:
+            self.stop()
+        if table not in self.profiles:
+            self.profiles[table] = (cProfile.Profile() if self.mode == "cprofile"
+                                    else StackSampler())
+        self._started_tracing = not tracemalloc.is_tracing()
+        if self._started_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        self._snapshot = tracemalloc.take_snapshot()
+        self.active = table
+        self.profiles[table].enable()
+
+    def stop(self, count=True):
+        """Stop profiling, counting the chunk as profiled if `count`"""
+        table, self.active = self.active, None
+        self.profiles[table].disable()
+        if count:
+            self.n_profiled[table] += 1
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        if self._started_tracing:
+            tracemalloc.stop()
+        self.peak_memory[table] = max(self.peak_memory[table], peak)
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        stats = snapshot.filter_traces(ignore).compare_to(
+            self._snapshot.filter_traces(ignore), "lineno")
+        for stat in stats:
+            self.allocated[table][str(stat.traceback)] += stat.size_diff
+
+    def chunks(self, iterable, table):
+        """Iterate over the chunks of a table, profiling the sampled ones.
+        Profiling spans both reading the chunk (decompressing and parsing)
+        and whatever is done with it (converting and inserting) before the
+        next chunk is requested. In a pipelined load, chunks are converted
+        and inserted by another process, so aren't covered."""
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            sampled = self.sampled(table)
+            if sampled:
+                self.start(table)
+            try:
+                chunk = next(iterator, StopIteration)
+                if chunk is StopIteration:
+                    if sampled:  # Nothing was read, so there's no chunk to count
+                        self.stop(count=False)
+                    return
+                self.n_seen[table] += 1
+                yield chunk
+            finally:
+                if sampled and self.active == table:
+                    self.stop()
+
+    def summary(self, table, n_top=N_TOP):
+        """The hotspots and top allocators of the profiled chunks"""
+        profile = self.profiles[table]
+        hotspots = (_cprofile_hotspots(profile, n_top) if self.mode == "cprofile"
+                    else profile.hotspots(n_top))
+        lines = [f"Profiled {self.n_profiled[table]} of {self.n_seen[table]} "
+                 f"chunks of {table} in process {os.getpid()}",
+                 f"Peak traced memory: {self.peak_memory[table] / 2**20:.1f} MB",
+                 "", "Top allocators (net bytes over the profiled chunks):"]
+        lines += [f"  {size / 2**20:10.2f} MB  {line}" for line, size
+                  in self.allocated[table].most_common(n_top) if size > 0]
+        return "\n".join(lines) + "\n\n" + hotspots
+
+    def dump(self, table):
+        """Write the table's profile and its summary, if it was profiled"""
+        if not self.enabled or self.n_profiled[table] == 0:
+            return
+        stem = os.path.join(self.out_dir, f"{table}.{os.getpid()}")
+        extension = "prof" if self.mode == "cprofile" else "folded"
+        self.profiles[table].dump_stats(f"{stem}.{extension}")
+        with open(f"{stem}.txt", "w") as f:
+            f.write(self.summary(table))
+        logging.info(f"\t\tWritten the profile of {table} to {stem}.{extension}")
@@ -0,0 +1,108 @@
+'''Stream PATSTAT tables out of the database in batches, through server-side
+cursors, so that any table can be read in bounded memory.'''
+
+from pypatstat.etl.dtypes import csv_dtypes
+from sqlalchemy import and_
+from sqlalchemy import create_engine
+from sqlalchemy import select
+import numpy as np
+import pandas as pd
+
+
+def table_query(_class, columns=None, where=None):
+    """Select (some of) a table's columns, optionally filtered.
+
+    Args:
+        _class: SQLalchemy ORM object.
+        columns (list): Names of the columns to select. Defaults to all.
+        where: An SQLalchemy clause, or list of clauses to be combined with
+               AND, e.g. `Tls201Appln.appln_filing_year >= 2000`.
+    Returns:
+        query (:obj:`sqlalchemy.sql.Select`)
+    """
+    table = _class.__table__
+    columns = list(table.columns) if columns is None \
+        else [table.columns[col] for col in columns]
+    query = select(columns)
+    if type(where) in (list, tuple):
+        where = and_(*where)
+    if where is not None:
+        query = query.where(where)
+    return query
+
+
+def rows_to_frame(rows, columns, _class):
+    """Convert fetched rows to a DataFrame with the ORM's dtypes, as read
+    from CSV (see :obj:`read_chunks`).
+
+    Args:
+        rows (list): Rows as fetched from the database.
+        columns (list): Names of the selected columns.
+        _class: SQLalchemy ORM object.
+    Returns:
+        df (:obj:`pd.DataFrame`)
+    """
+    dtypes, date_columns = csv_dtypes(_class)
+    values = list(zip(*rows)) if len(rows) > 0 else [()] * len(columns)
+    data = {}
+    for col, vals in zip(columns, values):
+        if col in date_columns:
+            data[col] = np.array(vals, dtype="datetime64[D]").astype("datetime64[s]")
+        else:
+            series = pd.Series(vals, dtype=object)
+            # Keep NULLs missing, rather than cast to 'None' strings
+            data[col] = series.astype(dtypes[col]).where(series.notnull(), None)
+    return pd.DataFrame(data, columns=columns)
+
+
+def frame_to_record_batch(df, _class):
+    """Convert a DataFrame of the table's columns to an Arrow record batch,
+    with the Arrow types of the ORM columns"""
+    # pyarrow is only needed for Arrow batches (and Parquet exports)
+    import pyarrow as pa
+    from pypatstat.etl.parquet_export import arrow_type
+    table = _class.__table__
+    schema = pa.schema([pa.field(col, arrow_type(table.columns[col]))
+                        for col in df.columns])
+    arrays = [pa.array(df[field.name], type=field.type, from_pandas=True)
+              for field in schema]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def iter_table(engine, _class, columns=None, where=None, batch_size=10000,
+               arrow=False):
+    """Stream a table out of the database in batches. Results are read
+    through a server-side cursor (where the driver supports one), so only
+    one batch is held in memory at a time, whatever the size of the table.
+
+    Args:
+        engine: An SQLalchemy engine, or a database connection string.
+        _class: SQLalchemy ORM object of the table to read.
+        columns (list): Names of the columns to select. Defaults to all.
+        where: An SQLalchemy clause, or list of clauses to be combined with
+               AND, e.g. `Tls201Appln.appln_filing_year >= 2000`.
+        batch_size (int): Number of rows per batch.
+        arrow (bool): Yield Arrow record batches rather than DataFrames?
+    Yields:
+        batch (:obj:`pd.DataFrame` or :obj:`pa.RecordBatch`): A batch of rows,
+                                                             typed by the ORM.
+    """
+    dispose = type(engine) is str
+    if dispose:
+        engine = create_engine(engine)
+    if columns is None:
+        columns = [col.name for col in _class.__table__.columns]
+    query = table_query(_class, columns=columns, where=where)
+    try:
+        with engine.connect() as conn:
+            results = conn.execution_options(stream_results=True).execute(query)
+            while True:
+                rows = results.fetchmany(batch_size)
+                if len(rows) == 0:
+                    break
+                df = rows_to_frame(rows, columns, _class)
+                yield frame_to_record_batch(df, _class) if arrow else df
+            results.close()
+    finally:
+        if dispose:
+            engine.dispose()
@@ -1,16 +1,36 @@
-from pypatstat.etl.utils import zipfiles_on_pages
+from pypatstat.etl.utils import zipfile_urls
+from pypatstat.etl.utils import _zipfile_from_url
 from pypatstat.etl.utils import files_in_zipfile
 
+from sqlalchemy import Column
+from sqlalchemy import Index
+from sqlalchemy import types as sql_types
+from sqlalchemy.ext.declarative import declarative_base
 from collections import defaultdict
+from pydoc import locate
+import json
+import logging
+import os
 import re
 
 START_PATTERN = "CREATE TABLE"
 END_PATTERN = "PRIMARY KEY CLUSTERED"
-SQL_FIELD_REGEX_1 = "\[(\w+)\] \[(\w+)\]\((\w+)\)"
-SQL_FIELD_REGEX_2 = "\[(\w+)\] \[(\w+)\]"
-SQL_FIELD_DEFAULT = "('.*?')"
-SQL_FIELD_PKEY = "\[(\w+)\]"
-SQL_TABLE_NAME = "Table \[dbo\]\.\[(.*)\]"
+SQL_FIELD_REGEX_1 = re.compile(r"\[(\w+)\] \[(\w+)\]\((\w+)\)")
+SQL_FIELD_REGEX_2 = re.compile(r"\[(\w+)\] \[(\w+)\]")
+SQL_FIELD_DEFAULT = re.compile(r"('.*?')")
+SQL_FIELD_PKEY = re.compile(r"\[(\w+)\]")
+SQL_TABLE_NAME = re.compile(r"Table \[dbo\]\.\[(.*)\]")
+SQL_INDEX = re.compile(r"CREATE\s+(UNIQUE\s+)?(?:NON)?(?:CLUSTERED\s+)?INDEX\s+"
+                       r"\[?(\w+)\]?\s+ON\s+(?:\[?\w+\]?\.)?\[?(\w+)\]?\s*"
+                       r"\((.*?)\)", re.IGNORECASE | re.DOTALL)
+SQL_INDEX_COLUMN = re.compile(r"\[?(\w+)\]?(?:\s+(?:ASC|DESC))?", re.IGNORECASE)
+DATESTAMP = re.compile(r"(\d+)")
+TABLE_SCRIPTS = 'CreateTableScripts'
+DEFAULT_FIELD_LENGTH = 100000  # Allows MySQL to default to MEDIUMTEXT
+ORM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "orms")
+SCHEMA_CACHE_DIR = os.environ.get("PYPATSTAT_SCHEMA_DIR",
+                                  os.path.join(os.path.expanduser("~"),
+                                               ".cache", "pypatstat"))
 
 INDEX_DOC_STR = 'index_documentation_scripts'
 
@@ -23,7 +43,7 @@ def extract_datestamp(url):
     Returns:
         datastamp (str): Date formatted as "%Y_%m_%d"
     """
-    numbers = re.findall("(\d+)", url)
+    numbers = DATESTAMP.findall(url)
     return "_".join(numbers[0:3])
 
 
@@ -36,9 +56,9 @@ def _get_field_data(sql_line):
         field_info (tuple): Field name, field type, field length and default value.
     """
     # Try to extract the field name, type and length
-    results = re.findall(SQL_FIELD_REGEX_1, sql_line)
+    results = SQL_FIELD_REGEX_1.findall(sql_line)
     if len(results) == 0:
-        field_name, field_type = re.findall(SQL_FIELD_REGEX_2, sql_line)[0]
+        field_name, field_type = SQL_FIELD_REGEX_2.findall(sql_line)[0]
         field_length = None
     else:        
         field_name, field_type, field_length = results[0]
@@ -51,7 +71,7 @@ def _get_field_data(sql_line):
                              f"'{field_length}'")
     # Find the default value, if any
     default_value = None
-    result = re.findall(SQL_FIELD_DEFAULT, sql_line)
+    result = SQL_FIELD_DEFAULT.findall(sql_line)
     if len(result) > 0:
         default_value = result[0]
         # Strip out quotes if this is a number
@@ -67,22 +87,35 @@ def _get_pkey_field(sql_line):
     Returns:
         results (list): A list of found primary key fields.
     """
-    results = re.findall(SQL_FIELD_PKEY, sql_line)[0]
+    results = SQL_FIELD_PKEY.findall(sql_line)[0]
     return results
 
 
+def get_index_doc_url(s):
+    """Find the URL of the PATSTAT index document, without downloading
+    any zipfiles.
+
+    Args:
+        s (:obj:`requests.session`): A requests session, logged into the PATSTAT website.
+    Returns:
+        url (str): Relative URL of the PATSTAT index document.
+    """
+    for url in zipfile_urls(s):
+        if INDEX_DOC_STR in url:
+            return url
+    raise ValueError("No PATSTAT index document was found")
+
+
 def get_index_doc(s):
-    """Scan forwards for the PATSTAT index document, which contains the schema.
+    """Download the PATSTAT index document, which contains the schema.
     
     Args:
         s (:obj:`requests.session`): A requests session, logged into the PATSTAT website.
     Returns:
         info (tuple): URL and ZipFile corresponding to the PATSTAT index document.
     """
-    for url, zipfile in zipfiles_on_pages(s):
-        if INDEX_DOC_STR in url:
-            break
-    return url, zipfile
+    url = get_index_doc_url(s)
+    return url, _zipfile_from_url(s, url)
 
 
 def get_sql_data(zipfile):
@@ -134,11 +167,61 @@ def parse_sql_table_fields(sql_table_text):
 
     return field_data, pkeys
 
-def generate_model_text(table_name, field_data, pkeys, 
-                        default_field_length=100000):  ## Allows MySQL to default to MEDIUMTEXT
+def parse_sql_indexes(sql_text):
+    """Extract secondary index definitions from SQL CREATE INDEX scripts.
+
+    Args:
+        sql_text (str): SQL code containing CREATE INDEX statements.
+    Returns:
+        indexes (dict): Lists of (index name, column names, unique) by table name.
+    """
+    indexes = defaultdict(list)
+    for unique, index_name, table_name, columns in SQL_INDEX.findall(sql_text):
+        columns = [col.lower() for col in SQL_INDEX_COLUMN.findall(columns)]
+        index_name, table_name = index_name.lower(), table_name.lower()
+        if table_name not in index_name:  # Index names must be unique per DB
+            index_name = f"{table_name}_{index_name}"
+        indexes[table_name].append((index_name, columns, bool(unique)))
+    return indexes
+
+
+def get_sql_indexes(sql_data):
+    """Collect the secondary indexes from every script category
+    other than the table creation scripts.
+
+    Args:
+        sql_data (dict): The SQL creation scripts organised by table type.
+    Returns:
+        indexes (dict): Lists of (index name, column names, unique) by table name.
+    """
+    indexes = defaultdict(list)
+    for table_type, scripts in sql_data.items():
+        if table_type == TABLE_SCRIPTS:
+            continue
+        for sql_text in scripts.values():
+            for table_name, _indexes in parse_sql_indexes(sql_text).items():
+                indexes[table_name] += _indexes
+    return indexes
+
+
+def generate_index_text(indexes):
+    """Generate the __table_args__ of a model, declaring its indexes"""
+    if len(indexes) == 0:
+        return ""
+    text = "\t__table_args__ = (\n"
+    for index_name, columns, unique in indexes:
+        args = ", ".join(f"'{col}'" for col in [index_name] + columns)
+        text += f"\t\tIndex({args}{', unique=True' if unique else ''}),\n"
+    text += "\t)\n"
+    return text
+
+
+def generate_model_text(table_name, field_data, pkeys, indexes=[],
+                        default_field_length=DEFAULT_FIELD_LENGTH):
     types = []
     model_text = (f"class {table_name.title().replace('_','')}(Base):\n"
                   f"\t__tablename__ = '{table_name}'\n")
+    model_text += generate_index_text(indexes)
     for field_name, (field_type, field_length, default_value) in field_data.items():
         if field_type.upper() == "TINYINT":
             field_type = "SMALLINT"
@@ -157,38 +240,234 @@ def generate_model_text(table_name, field_data, pkeys,
         types.append(field_type.upper())
     return model_text, types
 
-def generate_orm_head(types):
+def generate_orm_head(types, has_indexes=False):
     text = "'''Automatically generated by pypatstat "
     text += "(https://github.com/nestauk/pypatstat)'''\n\n"
     text += "from sqlalchemy.ext.declarative import declarative_base\n"
     text += "from sqlalchemy import Column\n"
+    if has_indexes:
+        text += "from sqlalchemy import Index\n"
     text += f"from sqlalchemy.types import {','.join(set(types))}\n\n"
     text += "Base = declarative_base()\n\n"
     return text
 
 
 def get_sql_table_name(sql_table_text):
-    return re.findall(SQL_TABLE_NAME, sql_table_text)[0]
+    return SQL_TABLE_NAME.findall(sql_table_text)[0]
 
-def generate_schema(session):
-    url, zipfile = get_index_doc(session)  
-    db_suffix = extract_datestamp(url)
-    sql_data = get_sql_data(zipfile)
-    
-    all_model_texts = []
-    types = []
-    for sql_table_text in sql_data['CreateTableScripts'].values():
+def parse_schema(sql_data):
+    """Parse the SQL creation scripts into a JSON-serialisable schema.
+
+    Args:
+        sql_data (dict): The SQL creation scripts organised by table type.
+    Returns:
+        schema (dict): For each table name, its fields (name, type, length,
+                       default), primary key field names and indexes.
+    """
+    indexes = get_sql_indexes(sql_data)
+    schema = {}
+    for sql_table_text in sql_data[TABLE_SCRIPTS].values():
         field_data, pkeys = parse_sql_table_fields(sql_table_text)
         table_name = get_sql_table_name(sql_table_text)
-        model_text, _types = generate_model_text(table_name, field_data, pkeys)
+        schema[table_name] = {"fields": [[field_name, *info] for field_name, info
+                                         in field_data.items()],
+                              "pkeys": pkeys,
+                              "indexes": [list(idx) for idx in indexes[table_name]]}
+    return schema
+
+
+def schema_path(db_suffix, cache_dir=SCHEMA_CACHE_DIR):
+    return os.path.join(cache_dir, f"patstat_{db_suffix}.json")
+
+
+def save_schema(schema, db_suffix, cache_dir=SCHEMA_CACHE_DIR):
+    """Cache the parsed schema of an edition, replacing it atomically"""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = schema_path(db_suffix, cache_dir)
+    with open(f"{path}.part", "w") as f:
+        json.dump(schema, f, separators=(",", ":"))
+    os.replace(f"{path}.part", path)
+    return path
+
+
+def load_schema(db_suffix, cache_dir=SCHEMA_CACHE_DIR):
+    """The cached schema of an edition, or None if it isn't cached"""
+    path = schema_path(db_suffix, cache_dir)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def make_column(field_type, field_length, default_value, primary_key=False):
+    """Construct an ORM column from a parsed field, typed as in
+    :obj:`generate_model_text`"""
+    field_type = field_type.upper()
+    if field_type == "TINYINT":
+        field_type = "SMALLINT"
+    _type = getattr(sql_types, field_type)
+    if field_length is not None:
+        if type(field_length) is str and field_length.lower() == "max":
+            field_length = DEFAULT_FIELD_LENGTH
+        _type = _type(field_length)
+    if type(default_value) is str:
+        default_value = default_value[1:-1]  # Strip the SQL quotes
+    return Column(_type, primary_key=primary_key, default=default_value)
+
+
+def schema_base(schema):
+    """Construct the ORM of a parsed schema directly, in memory.
+
+    Args:
+        schema (dict): A schema, as returned by :obj:`parse_schema`.
+    Returns:
+        Base: SQLalchemy ORM Base object, with one class per table.
+    """
+    Base = declarative_base()
+    Base.classes = []  # As the class registry only holds weak references
+    for table_name, table in schema.items():
+        attrs = {"__tablename__": table_name}
+        if len(table["indexes"]) > 0:
+            attrs["__table_args__"] = tuple(Index(index_name, *columns, unique=unique)
+                                            for index_name, columns, unique
+                                            in table["indexes"])
+        for field_name, *info in table["fields"]:
+            attrs[field_name] = make_column(*info,
+                                            primary_key=field_name in table["pkeys"])
+        Base.classes.append(type(table_name.title().replace('_',''), (Base,), attrs))
+    return Base
+
+
+def project_base(Base, columns):
+    """A copy of an ORM with only the selected columns of some of its tables,
+    e.g. leaving out `tls203_appln_abstr.appln_abstract`. Primary key columns
+    are always kept, as are the other tables' columns, while indexes on
+    dropped columns are dropped.
+
+    Args:
+        Base: SQLalchemy ORM Base object.
+        columns (dict): Names of the columns to keep, by table name.
+    Returns:
+        Base: A new SQLalchemy ORM Base object, with one class per table.
+    """
+    columns = dict(columns)
+    _Base = declarative_base()
+    _Base.classes = []  # As the class registry only holds weak references
+    for class_name, _class in list(Base._decl_class_registry.items()):
+        table = getattr(_class, "__table__", None)
+        if table is None:
+            continue
+        selected = columns.pop(table.name, None)
+        if selected is not None:
+            unknown = set(selected) - set(table.columns.keys())
+            if unknown:
+                raise ValueError(f"{table.name} has no columns {sorted(unknown)}")
+        attrs = {"__tablename__": table.name}
+        for column in table.columns:
+            if selected is None or column.primary_key or column.name in selected:
+                attrs[column.name] = column.copy()
+        indexes = [Index(index.name, *(col.name for col in index.columns),
+                         unique=index.unique)
+                   for index in table.indexes
+                   if all(col.name in attrs for col in index.columns)]
+        if len(indexes) > 0:
+            attrs["__table_args__"] = tuple(indexes)
+        _Base.classes.append(type(class_name, (_Base,), attrs))
+    if columns:
+        raise ValueError(f"No tables named {sorted(columns)}")
+    return _Base
+
+
+def get_schema(session=None, db_suffix=None, cache_dir=SCHEMA_CACHE_DIR):
+    """The parsed schema of a PATSTAT edition, from the cache if possible.
+    Otherwise the index document is downloaded, parsed and cached.
+
+    Args:
+        session (:obj:`requests.session`): A requests session, logged into the
+                                           PATSTAT website. Only needed if
+                                           the edition isn't cached.
+        db_suffix (str): Datestamp of the edition, e.g. "2019_05_13". If not
+                         specified, the latest edition online is used.
+    Returns:
+        db_suffix, schema (str, dict): The edition and its schema.
+    """
+    url = None
+    if db_suffix is None:
+        url = get_index_doc_url(session)
+        db_suffix = extract_datestamp(url)
+    schema = load_schema(db_suffix, cache_dir)
+    if schema is not None:
+        return db_suffix, schema
+    if session is None:
+        raise ValueError(f"The schema of {db_suffix} isn't cached in "
+                         f"{cache_dir}, and no session was given to download it")
+    url, zipfile = get_index_doc(session) if url is None \
+        else (url, _zipfile_from_url(session, url))
+    if extract_datestamp(url) != db_suffix:
+        raise ValueError(f"Only the latest edition, {extract_datestamp(url)}, "
+                         f"can be downloaded, not {db_suffix}")
+    schema = parse_schema(get_sql_data(zipfile))
+    logging.info(f"Caching the schema of {db_suffix} at "
+                 f"{save_schema(schema, db_suffix, cache_dir)}")
+    return db_suffix, schema
+
+
+def patstat_base(session=None, db_suffix=None, cache_dir=SCHEMA_CACHE_DIR,
+                 columns=None):
+    """The ORM of a PATSTAT edition, built in memory from its (cached) schema,
+    or otherwise imported from the ORMs shipped with pypatstat.
+
+    Args:
+        session (:obj:`requests.session`): A requests session, logged into the
+                                           PATSTAT website. Only needed if
+                                           the edition isn't known locally.
+        db_suffix (str): Datestamp of the edition, e.g. "2019_05_13". If not
+                         specified, the latest edition online is used.
+        columns (dict): If specified, keep only these columns of these
+                        tables, by table name. See :obj:`project_base`.
+    Returns:
+        db_suffix, Base (str, Base): The edition and its ORM Base object.
+    """
+    Base = None
+    if db_suffix is not None and load_schema(db_suffix, cache_dir) is None:
+        Base = locate(f'pypatstat.etl.orms.patstat_{db_suffix}.Base')
+    if Base is None:
+        db_suffix, schema = get_schema(session, db_suffix, cache_dir)
+        Base = schema_base(schema)
+    if columns is not None:
+        Base = project_base(Base, columns)
+    return db_suffix, Base
+
+
+def generate_orm_text(schema):
+    """Generate the source code of an ORM module for a parsed schema"""
+    all_model_texts = []
+    types = []
+    for table_name, table in schema.items():
+        field_data = {field_name: tuple(info) for field_name, *info in table["fields"]}
+        model_text, _types = generate_model_text(table_name, field_data,
+                                                 table["pkeys"],
+                                                 indexes=table["indexes"])
         types += _types
         all_model_texts.append(model_text)
-        
-    head = generate_orm_head(types)
-    orm_text = head + "\n\n".join(all_model_texts)
-    
-    with open(f"orms/patstat_{db_suffix}.py", "w") as f:
-        f.write(orm_text)
+    has_indexes = any(len(table["indexes"]) > 0 for table in schema.values())
+    head = generate_orm_head(types, has_indexes=has_indexes)
+    return head + "\n\n".join(all_model_texts)
+
+
+def generate_schema(session, orm_dir=ORM_DIR, cache_dir=SCHEMA_CACHE_DIR):
+    """Write the ORM of the latest edition as source code, e.g. to ship it
+    with pypatstat. Loading doesn't need this: see :obj:`patstat_base`.
+
+    Args:
+        session (:obj:`requests.session`): A requests session, logged into the PATSTAT website.
+        orm_dir (str): Directory in which to write the ORM module.
+    Returns:
+        db_suffix (str): Datestamp of the edition.
+    """
+    db_suffix, schema = get_schema(session, cache_dir=cache_dir)
+    with open(os.path.join(orm_dir, f"patstat_{db_suffix}.py"), "w") as f:
+        f.write(generate_orm_text(schema))
     return db_suffix
     
 
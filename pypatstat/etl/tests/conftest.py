@@ -0,0 +1,11 @@
+import pytest
+import multiprocessing
+
+
+@pytest.fixture
+def spawn_by_default():
+    """Make spawn the default start method, as on macOS and Windows"""
+    start_method = multiprocessing.get_start_method()
+    multiprocessing.set_start_method("spawn", force=True)
+    yield
+    multiprocessing.set_start_method(start_method, force=True)
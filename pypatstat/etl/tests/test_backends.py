@@ -0,0 +1,124 @@
+import pytest
+from unittest import mock
+import os
+import pandas as pd
+from datetime import date
+
+from backends import to_copy_text
+from backends import get_backend
+from backends import GenericBackend
+from backends import SQLiteBackend
+from backends import PostgresBackend
+from backends import MySQLBackend
+from data_loader import Batch
+from data_loader import PatstatLoader
+from data_loader import chunk_to_batch
+from orms.patstat_2019_05_13 import Base
+from orms.patstat_2019_05_13 import Tls209ApplnIpc
+
+# Set these to run the backend tests against local database instances, e.g.
+# postgresql+psycopg2://postgres@localhost/test_pypatstat
+POSTGRES_URL = os.environ.get("PYPATSTAT_TEST_POSTGRES_URL")
+MYSQL_URL = os.environ.get("PYPATSTAT_TEST_MYSQL_URL")
+
+ROWS = [(1, "A01B 1/00", "A", date(2006, 1, 1), "I", "F", "EP"),
+        (2, "tab\\there", None, date(9999, 12, 31), "N", None, None),
+        (3, "new\nline\\", "B", None, None, "L", "GB")]
+
+
+def _batch():
+    chunk = pd.DataFrame(ROWS, columns=[c.name for c in
+                                        Tls209ApplnIpc.__table__.columns])
+    return chunk_to_batch(chunk, Tls209ApplnIpc)
+
+
+def test_to_copy_text():
+    batch = Batch(["a", "b"], [pd.Series([1, None, 3], dtype=object).to_numpy(),
+                               pd.Series(["x\ty", "z\\", None]).to_numpy()])
+    assert to_copy_text(batch) == "1\tx\\ty\n\\N\tz\\\\\n3\t\\N\n"
+
+
+@pytest.mark.parametrize("db_url,bulk,backend", [
+    ("sqlite:///patstat.db", True, SQLiteBackend),
+    ("sqlite:///patstat.db", False, GenericBackend),
+    ("postgresql+psycopg2://localhost/patstat", True, PostgresBackend),
+    ("postgresql+pg8000://localhost/patstat", True, GenericBackend),
+    ("mysql+pymysql://localhost/patstat", True, MySQLBackend),
+    ("mssql+pyodbc://localhost/patstat", True, GenericBackend)])
+def test_get_backend(db_url, bulk, backend):
+    assert type(get_backend(db_url, bulk=bulk)) is backend
+
+
+def _roundtrip(db_url, bulk=True):
+    with PatstatLoader(db_url, Base, bulk=bulk) as loader:
+        try:
+            assert loader.write(Tls209ApplnIpc, _batch()) == len(ROWS)
+            rows = loader.engine.execute(Tls209ApplnIpc.__table__.select()
+                                         .order_by("appln_id")).fetchall()
+        finally:
+            Base.metadata.drop_all(loader.engine)
+    return [tuple(row) for row in rows]
+
+
+@pytest.mark.parametrize("bulk", [True, False])
+def test_sqlite_backend(tmpdir, bulk):
+    assert _roundtrip(f"sqlite:///{tmpdir}/patstat.db", bulk=bulk) == ROWS
+
+
+@pytest.mark.skipif(POSTGRES_URL is None, reason="No local PostgreSQL")
+def test_postgres_backend():
+    assert _roundtrip(POSTGRES_URL) == ROWS
+    assert _roundtrip(POSTGRES_URL, bulk=False) == ROWS
+
+
+@pytest.mark.skipif(MYSQL_URL is None, reason="No local MySQL")
+def test_mysql_backend():
+    assert _roundtrip(MYSQL_URL) == ROWS
+    assert _roundtrip(MYSQL_URL, bulk=False) == ROWS
+
+
+def _restart(db_url, bulk=True):
+    """Write the rows, then write them all again as if restarting"""
+    with PatstatLoader(db_url, Base, bulk=bulk) as loader:
+        try:
+            batch = _batch()
+            loader.write(Tls209ApplnIpc, batch.filter([True, False, True]))
+            loader.write(Tls209ApplnIpc, batch, filter_pks=True)
+            rows = loader.engine.execute(Tls209ApplnIpc.__table__.select()
+                                         .order_by("appln_id")).fetchall()
+        finally:
+            Base.metadata.drop_all(loader.engine)
+    return [tuple(row) for row in rows]
+
+
+@pytest.mark.parametrize("bulk", [True, False])
+def test_sqlite_skip_duplicates(tmpdir, bulk):
+    assert _restart(f"sqlite:///{tmpdir}/patstat.db", bulk=bulk) == ROWS
+
+
+def test_skip_duplicates_fallback(tmpdir):
+    # Without database support, existing PKs are filtered out client side
+    with PatstatLoader(f"sqlite:///{tmpdir}/patstat.db", Base) as loader:
+        loader.backend.can_skip_duplicates = lambda dialect: False
+        batch = _batch()
+        loader.write(Tls209ApplnIpc, batch.filter([True, False, True]))
+        with mock.patch.object(loader.backend, "insert",
+                               wraps=loader.backend.insert) as mocked:
+            assert loader.write(Tls209ApplnIpc, batch, filter_pks=True) == 1
+        _, kwargs = mocked.call_args
+        assert not kwargs["skip_duplicates"]
+        rows = loader.engine.execute(Tls209ApplnIpc.__table__.select()
+                                     .order_by("appln_id")).fetchall()
+    assert [tuple(row) for row in rows] == ROWS
+
+
+@pytest.mark.skipif(POSTGRES_URL is None, reason="No local PostgreSQL")
+def test_postgres_skip_duplicates():
+    assert _restart(POSTGRES_URL) == ROWS
+    assert _restart(POSTGRES_URL, bulk=False) == ROWS
+
+
+@pytest.mark.skipif(MYSQL_URL is None, reason="No local MySQL")
+def test_mysql_skip_duplicates():
+    assert _restart(MYSQL_URL) == ROWS
+    assert _restart(MYSQL_URL, bulk=False) == ROWS
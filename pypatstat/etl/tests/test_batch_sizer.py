@@ -0,0 +1,123 @@
+import pytest
+import multiprocessing
+import time
+from io import BytesIO
+from unittest import mock
+from zipfile import ZipFile
+from zipfile import ZIP_DEFLATED
+
+import pandas as pd
+
+from batch_sizer import BatchSizer
+from batch_sizer import packet_limit
+from batch_sizer import MAX_BYTES
+from batch_sizer import TARGET_BYTES
+from data_loader import read_chunks
+from data_loader import PatstatLoader
+from orms.patstat_2019_05_13 import Base
+from orms.patstat_2019_05_13 import Tls209ApplnIpc
+
+
+def _insert_seconds(n_bytes):
+    """Fixed overhead per insert, and a penalty for very large ones, making
+    the best throughput at about 7.5MB"""
+    return 0.01 + n_bytes / 1e8 + 0.05 * (n_bytes / 2**24)**2
+
+
+def _sizer_with_rows(table, bytes_per_row, **kwargs):
+    sizer = BatchSizer(**kwargs)
+    sizer.observe_chunk(table, pd.DataFrame({"x": [b"x" * bytes_per_row] * 10}))
+    return sizer
+
+
+def test_sizes_by_bytes_per_row():
+    narrow = pd.DataFrame({"appln_id": pd.array(range(1000), dtype="Int32")})
+    wide = pd.DataFrame({"abstract": pd.array(["x" * 2000] * 1000, dtype="string")})
+    sizer = BatchSizer()
+    assert sizer.rows("tls205_tech_rel", 1000) == 1000  # Not yet known
+    sizer.observe_chunk("tls205_tech_rel", narrow)
+    sizer.observe_chunk("tls203_appln_abstr", wide)
+    assert sizer.rows("tls205_tech_rel", 1000) > 100 * sizer.rows("tls203_appln_abstr", 1000)
+    n_bytes = sizer.rows("tls203_appln_abstr", 1000) * sizer.bytes_per_row["tls203_appln_abstr"]
+    assert n_bytes == pytest.approx(TARGET_BYTES, rel=0.01)
+
+
+def test_converges_on_best_throughput():
+    sizer = _sizer_with_rows("tls201_appln", 100)
+    for _ in range(200):
+        n_rows = sizer.rows("tls201_appln", 1000)
+        sizer.observe_insert("tls201_appln", n_rows, _insert_seconds(n_rows * 100))
+    assert 4 * 2**20 < sizer.controllers["tls201_appln"].size < 14 * 2**20
+
+
+def test_shrinks_slow_batches():
+    sizer = _sizer_with_rows("tls201_appln", 100, max_latency=0.01)
+    for _ in range(30):
+        n_rows = sizer.rows("tls201_appln", 1000)
+        sizer.observe_insert("tls201_appln", n_rows, _insert_seconds(n_rows * 100))
+    assert sizer.controllers["tls201_appln"].size < 2**20
+
+
+def test_packet_limit():
+    backend, engine = mock.MagicMock(), mock.MagicMock()
+    backend.max_packet_bytes.return_value = None
+    assert packet_limit(backend, engine) == MAX_BYTES
+    backend.max_packet_bytes.return_value = 2**22
+    assert packet_limit(backend, engine) == 2**21
+    sizer = _sizer_with_rows("tls201_appln", 100, max_bytes=2**21)
+    for _ in range(200):
+        n_rows = sizer.rows("tls201_appln", 1000)
+        sizer.observe_insert("tls201_appln", n_rows, n_rows * 1e-6)
+    assert sizer.controllers["tls201_appln"].size == 2**21
+
+
+def test_rows_are_shared_with_a_reader():
+    feedback = multiprocessing.Queue()
+    writer, reader = BatchSizer(), BatchSizer()
+    writer.share(feedback)
+    reader.share(feedback)
+    writer.observe_chunk("tls201_appln", pd.DataFrame({"x": [b"x" * 100] * 10}))
+    n_rows = writer.n_rows["tls201_appln"]
+    assert feedback.get(timeout=1) == ("tls201_appln", n_rows)
+    feedback.put(("tls201_appln", 123))
+    time.sleep(0.1)  # For the queue's feeder thread
+    assert reader.rows("tls201_appln", 1000) == 123
+
+
+def test_read_chunks_of_varying_size():
+    text = "appln_id,ipc_class_symbol\n" + "".join(f"{i},A{i}\n" for i in range(100))
+    sizes = iter([10, 30, 50, 50])
+    chunks = list(read_chunks(BytesIO(text.encode()), chunksize=lambda: next(sizes),
+                              _class=Tls209ApplnIpc))
+    assert [len(chunk) for chunk in chunks] == [10, 30, 50, 10]
+    assert pd.concat(chunks).appln_id.tolist() == list(range(100))
+
+
+def _tls209_archive(n_rows):
+    text = "appln_id,ipc_class_symbol\n" + "".join(f"{i},A{i}\n" for i in range(n_rows))
+    inner, outer = BytesIO(), BytesIO()
+    with ZipFile(inner, "w", compression=ZIP_DEFLATED) as zf:
+        zf.writestr("tls209_part01.csv", text)
+    with ZipFile(outer, "w") as zf:
+        zf.writestr("tls209_part01.zip", inner.getvalue())
+    outer.seek(0)
+    return outer
+
+
+def test_loader_auto_chunksize(tmpdir):
+    db_url = f"sqlite:///{tmpdir}/patstat.db"
+    with PatstatLoader(db_url, Base, auto_chunksize=True) as loader:
+        assert loader.batch_sizer.max_bytes == MAX_BYTES  # No packet limit
+        loader.batch_sizer = BatchSizer(target_bytes=2**12)
+        with mock.patch.object(loader.backend, "insert",
+                               wraps=loader.backend.insert) as mocked:
+            loader.load_zipfile(_tls209_archive(5000), chunksize=10)
+        n_rows = [call.args[2].n_rows for call in mocked.call_args_list]
+        # The first chunk is of chunksize rows, and the rest are sized by
+        # bytes, and then tuned by their insert times
+        assert n_rows[0] == 10
+        assert n_rows[1] > 10
+        assert len(set(n_rows[1:-1])) > 1
+        assert sum(n_rows) == 5000
+        n = loader.engine.execute("SELECT COUNT(*) FROM tls209_appln_ipc").scalar()
+    assert n == 5000
@@ -0,0 +1,260 @@
+import pytest
+from unittest import mock
+import numpy as np
+import pandas as pd
+from datetime import date
+from io import BytesIO
+from zipfile import ZipFile
+from zipfile import ZIP_DEFLATED
+
+from data_loader import chunk_to_batch
+from data_loader import null_pk_mask
+from data_loader import make_pks
+from data_loader import write_to_db
+from data_loader import iterchunks
+from data_loader import PatstatLoader
+from data_loader import zipfile_to_db
+from schema_maker import project_base
+from orms.patstat_2019_05_13 import Base
+from orms.patstat_2019_05_13 import Tls201Appln
+from orms.patstat_2019_05_13 import Tls207PersAppln
+from orms.patstat_2019_05_13 import Tls209ApplnIpc
+
+from sqlalchemy import create_engine
+
+
+def test_null_pk_mask():
+    # Only rows where every PK field is null are dropped
+    chunk = pd.DataFrame({"person_id": [1, 0, 0, None, 3],
+                          "appln_id": [2, 0, 5, 0, 4],
+                          "applt_seq_nr": [0, 0, 0, 0, 1],
+                          "invt_seq_nr": [1, 0, 0, None, 0]})
+    mask = null_pk_mask(chunk, Tls207PersAppln)
+    assert mask.tolist() == [False, True, False, True, False]
+
+    chunk = pd.DataFrame({"appln_id": [1, 0, 3],
+                          "ipc_class_symbol": ["A01", "  ", None]})
+    mask = null_pk_mask(chunk, Tls209ApplnIpc)
+    assert mask.tolist() == [False, True, False]
+
+
+def test_chunk_to_batch():
+    chunk = pd.DataFrame({"appln_id": [1, 0, 3, 4],
+                          "appln_auth": ["EP", "GB", None, "US"],
+                          "docdb_family_size": [1.5, 2.0, np.nan, 3.0]})
+    batch = chunk_to_batch(chunk, Tls201Appln)
+    assert batch.columns == ["appln_id", "appln_auth", "docdb_family_size"]
+    assert batch.n_rows == 3
+    assert batch.rows == [(1, "EP", 1.5), (3, None, None), (4, "US", 3.0)]
+    assert all(type(row[0]) is int for row in batch.rows)
+    assert make_pks(batch, Tls201Appln) == [(1,), (3,), (4,)]
+
+
+def _zipped_csv(text, fname="tls209_part01.csv"):
+    bio = BytesIO()
+    with ZipFile(bio, "w", compression=ZIP_DEFLATED) as zf:
+        zf.writestr(fname, text)
+    bio.seek(0)
+    return bio
+
+
+def test_iterchunks_orm_dtypes():
+    text = ("appln_id,ipc_class_symbol,ipc_class_level,ipc_version,"
+            "ipc_value,ipc_position,ipc_gener_auth\n"
+            "1,123,A,2006-01-01,I,F,EP\n"
+            "2,456,,9999-12-31,N,,\n")
+    chunks = list(iterchunks(_zipped_csv(text), _class=Tls209ApplnIpc))
+    assert len(chunks) == 1
+    batch = chunk_to_batch(chunks[0], Tls209ApplnIpc)
+    # Numeric looking string PKs are not guessed to be ints
+    assert make_pks(batch, Tls209ApplnIpc) == [(1, "123"), (2, "456")]
+    assert batch.rows[1] == (2, "456", None, date(9999, 12, 31), "N", None, None)
+    assert batch.rows[0][3] == date(2006, 1, 1)
+
+
+def test_iterchunks_projected():
+    text = ("person_id,person_name,person_address,person_ctry_code\n"
+            "1,ACME,1 Long Street,GB\n"
+            "2,Widgets,2 Long Street,US\n")
+    projected = project_base(Base, {"tls206_person": ["person_ctry_code"]})
+    _class = projected._decl_class_registry["Tls206Person"]
+    chunks = list(iterchunks(_zipped_csv(text, "tls206_part01.csv"), _class=_class))
+    assert list(chunks[0].columns) == ["person_id", "person_ctry_code"]
+    assert chunks[0].person_ctry_code.tolist() == ["GB", "US"]
+
+
+def test_zipfile_to_db_projected(tmpdir):
+    db_url = f"sqlite:///{tmpdir}/patstat.db"
+    projected = project_base(Base, {"tls207_pers_appln": ["applt_seq_nr"]})
+    # Primary key columns are always kept
+    assert len(projected.metadata.tables["tls207_pers_appln"].columns) == 4
+    projected = project_base(Base, {"tls209_appln_ipc": ["ipc_value"]})
+    text = ("appln_id,ipc_class_symbol,ipc_class_level,ipc_version,"
+            "ipc_value,ipc_position,ipc_gener_auth\n"
+            "1,123,A,2006-01-01,I,F,EP\n")
+    outer = BytesIO()
+    with ZipFile(outer, "w") as zf:
+        zf.writestr("tls209_part01.zip", _zipped_csv(text).getvalue())
+    outer.seek(0)
+    zipfile_to_db(outer, db_url, projected)
+    engine = create_engine(db_url)
+    rows = engine.execute("SELECT * FROM tls209_appln_ipc").fetchall()
+    assert [tuple(row) for row in rows] == [(1, "123", "I")]
+
+
+def _tls207_batch(rows):
+    chunk = pd.DataFrame(rows, columns=["person_id", "appln_id",
+                                        "applt_seq_nr", "invt_seq_nr"])
+    return chunk_to_batch(chunk, Tls207PersAppln)
+
+
+def test_write_to_db(tmpdir):
+    db_url = f"sqlite:///{tmpdir}/patstat.db"
+    write_to_db(db_url, Base, Tls207PersAppln,
+                _tls207_batch([(1, 1, 1, 0), (1, 2, 1, 0), (2, 2, 0, 1)]),
+                filter_pks=False)
+    # Rows already in the DB are filtered out
+    write_to_db(db_url, Base, Tls207PersAppln,
+                _tls207_batch([(2, 2, 0, 1), (3, 2, 0, 2)]),
+                filter_pks=True)
+    engine = create_engine(db_url)
+    rows = engine.execute("SELECT * FROM tls207_pers_appln "
+                          "ORDER BY person_id, appln_id").fetchall()
+    assert [tuple(row) for row in rows] == [(1, 1, 1, 0), (1, 2, 1, 0),
+                                            (2, 2, 0, 1), (3, 2, 0, 2)]
+
+
+def test_write_closes_connection_on_error(tmpdir):
+    db_url = f"sqlite:///{tmpdir}/patstat.db"
+    with PatstatLoader(db_url, Base) as loader:
+        connections = []
+        def connect(_connect=loader.engine.connect):
+            connections.append(_connect())
+            return connections[-1]
+        with mock.patch.object(loader.engine, "connect", side_effect=connect), \
+                mock.patch.object(loader.backend, "insert", side_effect=ValueError):
+            with pytest.raises(ValueError):
+                loader.write(Tls207PersAppln, _tls207_batch([(1, 1, 1, 0)]))
+    assert len(connections) == 1 and connections[0].closed
+
+
+def _tls207_archive(n_files, n_rows):
+    """An archive of zipped tls207 CSVs, as PATSTAT ships them"""
+    outer = BytesIO()
+    with ZipFile(outer, "w") as zf:
+        for i in range(n_files):
+            text = "person_id,appln_id,applt_seq_nr,invt_seq_nr\n"
+            text += "".join(f"{i},{j},1,0\n" for j in range(n_rows))
+            zf.writestr(f"tls207_part0{i}.zip",
+                        _zipped_csv(text, f"tls207_part0{i}.csv").getvalue())
+    outer.seek(0)
+    return outer
+
+
+def test_loader_reuses_engine(tmpdir):
+    db_url = f"sqlite:///{tmpdir}/patstat.db"
+    with PatstatLoader(db_url, Base) as loader:
+        engine = loader.engine
+        with mock.patch.object(Base.metadata, "create_all") as mocked_create:
+            loader.load_zipfile(_tls207_archive(3, 25), chunksize=10)
+            assert mocked_create.call_count == 0
+        assert loader.engine is engine
+        n = engine.execute("SELECT COUNT(*) FROM tls207_pers_appln").scalar()
+    assert n == 3*25
+
+
+def test_zipfile_to_db(tmpdir):
+    db_url = f"sqlite:///{tmpdir}/patstat.db"
+    zipfile_to_db(_tls207_archive(2, 10), db_url, Base, chunksize=3)
+    engine = create_engine(db_url)
+    n = engine.execute("SELECT COUNT(*) FROM tls207_pers_appln").scalar()
+    assert n == 2*10
+
+
+def test_resume_from_checkpoint(tmpdir):
+    db_url = f"sqlite:///{tmpdir}/patstat.db"
+    with PatstatLoader(db_url, Base) as loader:
+        insert = loader.backend.insert
+        n_calls = []
+        def crash_eventually(*args, **kwargs):
+            n_calls.append(1)
+            if len(n_calls) == 6:
+                raise RuntimeError("Crashed on day two")
+            return insert(*args, **kwargs)
+        loader.backend.insert = crash_eventually
+        with pytest.raises(RuntimeError):
+            loader.load_zipfile(_tls207_archive(3, 20), chunksize=7,
+                                archive="download/part01.zip")
+        n = loader.engine.execute("SELECT COUNT(*) FROM tls207_pers_appln").scalar()
+        assert n == 20 + 7 + 7  # The failed batch was rolled back
+
+    # Restarting carries on from the first uncommitted row, so no PK clashes
+    with PatstatLoader(db_url, Base) as loader:
+        with mock.patch.object(loader.backend, "insert",
+                               wraps=loader.backend.insert) as mocked:
+            loader.load_zipfile(_tls207_archive(3, 20), chunksize=7,
+                                archive="download/part01.zip")
+        assert mocked.call_count == 1 + 3
+        n = loader.engine.execute("SELECT COUNT(*) FROM tls207_pers_appln").scalar()
+        assert n == 3*20
+        assert loader.checkpoints.is_complete("download/part01.zip")
+
+    # A complete archive is skipped altogether
+    with PatstatLoader(db_url, Base) as loader:
+        assert loader.checkpoints.is_complete("download/part01.zip")
+        assert loader.checkpoints.rows_committed("download/part01.zip",
+                                                 "tls207_part01.zip/tls207_part01.csv") == 20
+
+
+@pytest.mark.parametrize("kwargs", [dict(skip_table_prefixes=["tls207_part01"]),
+                                    dict(restart_filename="tls207_part01")])
+def test_partial_archive_left_incomplete(tmpdir, kwargs):
+    db_url = f"sqlite:///{tmpdir}/patstat.db"
+    with PatstatLoader(db_url, Base) as loader:
+        loader.load_zipfile(_tls207_archive(3, 5), archive="part01.zip", **kwargs)
+        assert not loader.checkpoints.is_complete("part01.zip")
+        # A bad (e.g. truncated) zipfile isn't complete either
+        data = _tls207_archive(3, 5).getvalue()
+        truncated = BytesIO(data[:len(data) // 2])
+        loader.load_zipfile(truncated, archive="part02.zip")
+        assert not loader.checkpoints.is_complete("part02.zip")
+        # Retried in full, the skipped nested files are loaded
+        loader.load_zipfile(_tls207_archive(3, 5), archive="part01.zip")
+        assert loader.checkpoints.is_complete("part01.zip")
+        n = loader.engine.execute("SELECT COUNT(*) FROM tls207_pers_appln").scalar()
+    assert n == 3*5
+
+
+@pytest.mark.parametrize("ordered", [True, False])
+def test_zipfile_to_db_parallel(tmpdir, ordered):
+    db_url = f"sqlite:///{tmpdir}/patstat.db"
+    zipfile_to_db(_tls207_archive(4, 50), db_url, Base, chunksize=20,
+                  n_workers=2, ordered=ordered)
+    engine = create_engine(db_url)
+    n = engine.execute("SELECT COUNT(*) FROM tls207_pers_appln").scalar()
+    assert n == 4*50
+
+
+def test_zipfile_to_db_parallel_spawn_default(tmpdir, spawn_by_default):
+    # Workers are forked all the same, as the ORM can't be pickled
+    db_url = f"sqlite:///{tmpdir}/patstat.db"
+    zipfile_to_db(_tls207_archive(2, 10), db_url, Base, n_workers=2)
+    engine = create_engine(db_url)
+    n = engine.execute("SELECT COUNT(*) FROM tls207_pers_appln").scalar()
+    assert n == 2*10
+
+
+def test_zipfile_to_db_parallel_failure(tmpdir):
+    db_url = f"sqlite:///{tmpdir}/patstat.db"
+    archive = _tls207_archive(3, 10)
+    with ZipFile(archive, "a") as zf:
+        zf.writestr("tls207_part09.zip", b"not a zipfile")
+    archive.seek(0)
+    with PatstatLoader(db_url, Base) as loader:
+        with pytest.raises(RuntimeError) as err:
+            loader.load_zipfile(archive, n_workers=2, archive="part01.zip")
+        assert "tls207_part09.zip" in str(err.value)
+        # The other nested files were still loaded, but not the archive
+        assert not loader.checkpoints.is_complete("part01.zip")
+        n = loader.engine.execute("SELECT COUNT(*) FROM tls207_pers_appln").scalar()
+    assert n == 3*10
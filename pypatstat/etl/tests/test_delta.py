@@ -0,0 +1,167 @@
+import pytest
+import os
+import pandas as pd
+from datetime import date
+from io import BytesIO
+from zipfile import ZipFile
+from zipfile import ZIP_DEFLATED
+
+from data_loader import PatstatLoader
+from data_loader import chunk_to_batch
+from data_loader import read_chunks
+from delta import content_hashes
+from delta import ContentIndex
+from delta import DeltaLoader
+from orms.patstat_2019_05_13 import Base
+from orms.patstat_2019_05_13 import Tls206Person
+from orms.patstat_2019_05_13 import Tls209ApplnIpc
+from orms.patstat_2019_05_13 import Tls215CitnCateg
+from orms.patstat_2018_10_02 import Base as OldBase
+
+from sqlalchemy import inspect
+
+POSTGRES_URL = os.environ.get("PYPATSTAT_TEST_POSTGRES_URL")
+COLUMNS = [c.name for c in Tls209ApplnIpc.__table__.columns]
+OLD_ROWS = [(1, "A01", "A", date(2006, 1, 1), "I", "F", "EP"),
+            (2, "B02", None, date(9999, 12, 31), "N", None, None),
+            (3, "C03", "B", None, None, "L", "GB"),
+            (4, "D04", "C", date(2010, 1, 1), "I", "F", "US")]
+NEW_CSV = ("appln_id,ipc_class_symbol,ipc_class_level,ipc_version,"
+           "ipc_value,ipc_position,ipc_gener_auth\n"
+           "1,A01,A,2006-01-01,I,F,EP\n"  # Unchanged
+           "2,B02,,9999-12-31,N,,\n"  # Unchanged
+           "3,C03,B,2016-01-01,,L,GB\n"  # Updated
+           "5,E05,A,2016-01-01,I,F,EP\n")  # Inserted (and 4 is deleted)
+PERSON_ROWS = [(1, "A", "1 High St"), (2, "B", None)]  # A NULL VARCHAR
+PERSON_CSV = ("person_id,person_name,person_address\n"
+              "1,A,1 High St\n"  # Unchanged
+              "2,B,\n")  # Unchanged
+
+
+def _archive(text, prefix="tls209"):
+    inner = BytesIO()
+    with ZipFile(inner, "w", compression=ZIP_DEFLATED) as zf:
+        zf.writestr(f"{prefix}_part01.csv", text)
+    outer = BytesIO()
+    with ZipFile(outer, "w") as zf:
+        zf.writestr(f"{prefix}_part01.zip", inner.getvalue())
+    outer.seek(0)
+    return outer
+
+
+def _db_url(request, tmpdir):
+    if request.param == "sqlite":
+        return f"sqlite:///{tmpdir}/patstat.db"
+    if POSTGRES_URL is None:
+        pytest.skip("PYPATSTAT_TEST_POSTGRES_URL is not set")
+    return POSTGRES_URL
+
+
+@pytest.fixture(params=["sqlite", "postgresql"])
+def db_url(request, tmpdir):
+    db_url = _db_url(request, tmpdir)
+    with PatstatLoader(db_url, Base, resume=False) as loader:
+        batch = chunk_to_batch(pd.DataFrame(OLD_ROWS, columns=COLUMNS),
+                               Tls209ApplnIpc)
+        loader.write(Tls209ApplnIpc, batch)
+        people = pd.DataFrame(PERSON_ROWS, columns=["person_id", "person_name",
+                                                    "person_address"])
+        loader.write(Tls206Person, chunk_to_batch(people, Tls206Person))
+        yield db_url
+        Base.metadata.drop_all(loader.engine)
+
+
+def test_content_hashes():
+    chunk = next(read_chunks(BytesIO(NEW_CSV.encode()), _class=Tls209ApplnIpc))
+    hashes = content_hashes(chunk, Tls209ApplnIpc)
+    assert len(set(hashes)) == 4
+    # PKs aren't hashed, and CHAR padding is ignored
+    padded = chunk.assign(appln_id=chunk.appln_id + 10,
+                          ipc_gener_auth=chunk.ipc_gener_auth.cat.rename_categories(
+                              lambda code: f"{code}  "))
+    assert (content_hashes(padded, Tls209ApplnIpc) == hashes).all()
+
+
+def test_content_index_matches_csv(db_url):
+    with DeltaLoader(db_url, Base) as loader:
+        index = ContentIndex.from_db(loader.engine, Tls209ApplnIpc)
+    assert len(index) == 4
+    chunk = next(read_chunks(BytesIO(NEW_CSV.encode()), _class=Tls209ApplnIpc))
+    hashes = content_hashes(chunk, Tls209ApplnIpc)
+    # The rows read back from the database hash as they do from CSV
+    assert list(index.hashes[:2]) == list(hashes[:2])
+    assert index.hashes[2] != hashes[2]
+    # Including NULLs in VARCHAR columns
+    with DeltaLoader(db_url, Base) as loader:
+        index = ContentIndex.from_db(loader.engine, Tls206Person)
+    chunk = next(read_chunks(BytesIO(PERSON_CSV.encode()), _class=Tls206Person))
+    assert list(index.hashes) == list(content_hashes(chunk, Tls206Person))
+
+
+def test_delta_loader(db_url):
+    with DeltaLoader(db_url, Base) as loader:
+        loader.load_zipfile(_archive(NEW_CSV), chunksize=2)
+        assert loader.apply_deletes() == 1
+        assert loader.counts == {"inserted": 1, "updated": 1,
+                                 "unchanged": 2, "deleted": 1}
+        rows = loader.engine.execute("SELECT appln_id, ipc_version FROM "
+                                     "tls209_appln_ipc ORDER BY appln_id").fetchall()
+    assert [r[0] for r in rows] == [1, 2, 3, 5]
+    assert str(rows[2][1]) == "2016-01-01"
+
+    # Applying the same edition again changes nothing
+    with DeltaLoader(db_url, Base) as loader:
+        loader.load_zipfile(_archive(NEW_CSV))
+        assert loader.apply_deletes() == 0
+        assert loader.counts["unchanged"] == 4
+
+    # Rows with NULL strings are unchanged too, not replaced every time
+    with DeltaLoader(db_url, Base) as loader:
+        loader.load_zipfile(_archive(PERSON_CSV, "tls206"))
+        assert loader.counts == {"inserted": 0, "updated": 0,
+                                 "unchanged": 2, "deleted": 0}
+
+
+@pytest.fixture(params=["sqlite", "postgresql"])
+def old_db_url(request, tmpdir):
+    """A database of the previous edition's tls206 and tls215"""
+    db_url = _db_url(request, tmpdir)
+    with PatstatLoader(db_url, OldBase, resume=False) as loader:
+        tables = OldBase.metadata.tables
+        loader.engine.execute(tables["tls206_person"].insert(),
+                              [dict(person_id=1, person_name="A", psn_level=1)])
+        loader.engine.execute(tables["tls215_citn_categ"].insert(),
+                              [dict(pat_publn_id=100, citn_replenished=0,
+                                    citn_id=1, citn_categ="X")])
+        yield db_url
+        OldBase.metadata.drop_all(loader.engine)
+        Base.metadata.drop_all(loader.engine)
+
+
+def test_delta_loader_migrates_schema(old_db_url):
+    tls206 = ("person_id,person_name,person_name_orig_lg,psn_level\n"
+              "1,A,Á,1\n"  # Updated, with the new column filled in
+              "2,B,,1\n")  # Inserted
+    tls215 = ("pat_publn_id,citn_replenished,citn_id,citn_categ,relevant_claim\n"
+              "100,0,1,X,1\n100,0,1,X,2\n100,0,1,YX,0\n")
+    with DeltaLoader(old_db_url, Base) as loader:
+        loader.load_zipfile(_archive(tls206, "tls206"))
+        loader.load_zipfile(_archive(tls215, "tls215"))
+        assert loader.apply_deletes() == 0
+        # tls215's primary key changed, so it was rebuilt and reloaded
+        assert loader.counts == {"inserted": 1 + 3, "updated": 1,
+                                 "unchanged": 0, "deleted": 0}
+        inspector = inspect(loader.engine)
+        assert inspector.get_pk_constraint("tls215_citn_categ")["constrained_columns"] \
+            == [col.name for col in Tls215CitnCateg.__table__.primary_key.columns]
+        rows = loader.engine.execute("SELECT person_id, person_name_orig_lg FROM "
+                                     "tls206_person ORDER BY person_id").fetchall()
+    assert [tuple(row) for row in rows] == [(1, "Á"), (2, None)]
+
+
+def test_delta_loader_rejects_parallel(db_url):
+    with DeltaLoader(db_url, Base) as loader:
+        for kwargs in [dict(n_workers=2), dict(ordered=True),
+                       dict(archive="part01.zip")]:
+            with pytest.raises(ValueError, match="one at a time"):
+                loader.load_zipfile(_archive(NEW_CSV), **kwargs)
@@ -0,0 +1,31 @@
+import pandas as pd
+
+from dtypes import csv_dtypes
+from dtypes import parse_dates
+from orms.patstat_2019_05_13 import Tls201Appln
+from orms.patstat_2019_05_13 import Tls229ApplnNace2
+
+
+def test_csv_dtypes():
+    dtypes, date_columns = csv_dtypes(Tls201Appln)
+    assert dtypes["appln_id"] == "Int32"
+    assert dtypes["appln_filing_year"] == "Int16"
+    assert dtypes["appln_auth"] == "category"  # CHAR(2)
+    assert dtypes["granted"] == "category"  # CHAR(1)
+    assert dtypes["appln_nr"] is str  # VARCHAR(15)
+    assert date_columns == ["appln_filing_date", "earliest_filing_date",
+                            "earliest_publn_date"]
+
+
+def test_csv_dtypes_real():
+    dtypes, _ = csv_dtypes(Tls229ApplnNace2)
+    assert dtypes["weight"] == "float32"
+
+
+def test_parse_dates():
+    chunk = pd.DataFrame({"d": ["2001-02-03", "9999-12-31", None],
+                          "x": [1, 2, 3]})
+    chunk = parse_dates(chunk, ["d", "not_a_column"])
+    assert chunk["d"].dtype == "datetime64[s]"
+    assert chunk["d"].iloc[1] == pd.Timestamp("9999-12-31")
+    assert pd.isnull(chunk["d"].iloc[2])
@@ -0,0 +1,103 @@
+import pytest
+import os
+import pandas as pd
+
+from fast_load import keyless_metadata
+from data_loader import PatstatLoader
+from data_loader import chunk_to_batch
+from orms.patstat_2019_05_13 import Base
+from orms.patstat_2019_05_13 import Tls207PersAppln
+
+from sqlalchemy import Index
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.declarative import declarative_base
+
+POSTGRES_URL = os.environ.get("PYPATSTAT_TEST_POSTGRES_URL")
+TLS207_COLUMNS = ["person_id", "appln_id", "applt_seq_nr", "invt_seq_nr"]
+
+
+def _batch(rows):
+    return chunk_to_batch(pd.DataFrame(rows, columns=TLS207_COLUMNS),
+                          Tls207PersAppln)
+
+
+def test_keyless_metadata():
+    metadata = keyless_metadata(Base)
+    assert set(metadata.tables) == set(Base.metadata.tables)
+    for name, table in metadata.tables.items():
+        assert len(table.primary_key.columns) == 0
+        assert len(table.indexes) == 0
+    # The ORM's own tables are untouched
+    assert len(Tls207PersAppln.__table__.primary_key.columns) == 4
+
+
+def _has_key(engine, table_name):
+    inspector = inspect(engine)
+    return bool(inspector.get_pk_constraint(table_name)["constrained_columns"]) \
+        or any(idx["unique"] for idx in inspector.get_indexes(table_name))
+
+
+def _fast_load(db_url, rows):
+    with PatstatLoader(db_url, Base, fast_load=True) as loader:
+        try:
+            assert not _has_key(loader.engine, "tls207_pers_appln")
+            loader.write(Tls207PersAppln, _batch(rows))
+            loader.build_keys(n_workers=2)
+            assert _has_key(loader.engine, "tls207_pers_appln")
+            loader.build_keys()  # Nothing left to build
+            n = loader.engine.execute("SELECT COUNT(*) FROM tls207_pers_appln").scalar()
+        finally:
+            Base.metadata.drop_all(loader.engine)
+    return n
+
+
+def test_fast_load_sqlite(tmpdir):
+    assert _fast_load(f"sqlite:///{tmpdir}/patstat.db",
+                      [(1, 1, 1, 0), (1, 2, 1, 0)]) == 2
+
+
+def test_fast_load_duplicates_fail_at_build(tmpdir):
+    with pytest.raises(IntegrityError):
+        _fast_load(f"sqlite:///{tmpdir}/patstat.db",
+                   [(1, 1, 1, 0), (1, 1, 1, 0)])
+
+
+@pytest.mark.skipif(POSTGRES_URL is None, reason="No local PostgreSQL")
+def test_fast_load_postgres():
+    assert _fast_load(POSTGRES_URL, [(1, 1, 1, 0), (1, 2, 1, 0)]) == 2
+    with PatstatLoader(POSTGRES_URL, Base, fast_load=True) as loader:
+        try:
+            # Still set once the pooled connection has been rolled back
+            for _ in range(2):
+                assert loader.engine.execute("SHOW synchronous_commit").scalar() \
+                    == "off"
+        finally:
+            Base.metadata.drop_all(loader.engine)
+
+
+def _indexed_base():
+    """A throwaway ORM of tls207 with a secondary index, leaving the shipped
+    one untouched"""
+    Base = declarative_base()
+    attrs = {column.name: column.copy()
+             for column in Tls207PersAppln.__table__.columns}
+    attrs["__tablename__"] = "tls207_pers_appln"
+    attrs["__table_args__"] = (Index("tls207_pers_appln_ix_appln_id", "appln_id"),)
+    Base.classes = [type("Tls207PersAppln", (Base,), attrs)]
+    return Base
+
+
+def test_defer_indexes(tmpdir):
+    Base = _indexed_base()
+    _class, = Base.classes
+    with PatstatLoader(f"sqlite:///{tmpdir}/patstat.db", Base,
+                       defer_indexes=True) as loader:
+        inspector = inspect(loader.engine)
+        assert inspector.get_pk_constraint("tls207_pers_appln")["constrained_columns"]
+        assert inspector.get_indexes("tls207_pers_appln") == []
+        loader.write(_class, _batch([(1, 1, 1, 0), (1, 2, 1, 0)]))
+        loader.build_keys()
+        indexes = inspect(loader.engine).get_indexes("tls207_pers_appln")
+        assert [idx["name"] for idx in indexes] == ["tls207_pers_appln_ix_appln_id"]
+    assert len(Tls207PersAppln.__table__.indexes) == 0
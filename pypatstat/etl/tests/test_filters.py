@@ -0,0 +1,165 @@
+import pytest
+from io import BytesIO
+from unittest import mock
+from zipfile import ZipFile
+
+import numpy as np
+import pandas as pd
+
+from filters import IdSet
+from filters import RowFilter
+from filters import row_mask
+from filters import filter_key
+from data_loader import build_row_filter
+from data_loader import _download_patstat_to_db
+from benchmarks.fake_epo import FakeEpoServer
+from benchmarks.fake_epo import USERNAME
+from benchmarks.fake_epo import PWD
+from benchmarks.synthetic import nested_zipfile
+from orms.patstat_2019_05_13 import Base
+from orms.patstat_2019_05_13 import Tls201Appln
+from orms.patstat_2019_05_13 import Tls206Person
+from orms.patstat_2019_05_13 import Tls207PersAppln
+from orms.patstat_2019_05_13 import Tls212Citation
+from orms.patstat_2019_05_13 import Tls214NplPubln
+from orms.patstat_2019_05_13 import Tls228DocdbFamCitn
+from orms.patstat_2019_05_13 import Tls801Country
+
+from sqlalchemy import create_engine
+
+
+def test_row_mask():
+    chunk = pd.DataFrame({"appln_auth": pd.Series(["EP", "US", "CN", None],
+                                                  dtype="category"),
+                          "appln_filing_year": pd.array([2005, 1999, 2010, 2001],
+                                                        dtype="Int16"),
+                          "granted": ["Y", "Y", "N", "Y"]})
+    assert row_mask(chunk, {"appln_auth": ["EP", "US"]}).tolist() == \
+        [True, True, False, False]
+    assert row_mask(chunk, {"appln_filing_year": (2001, None)}).tolist() == \
+        [True, False, True, True]
+    assert row_mask(chunk, {"appln_filing_year": (None, 2001),
+                            "granted": "Y"}).tolist() == [False, True, False, True]
+    assert row_mask(chunk, {"granted": lambda col: col != "Y"}).tolist() == \
+        [False, False, True, False]
+
+
+def test_id_set():
+    ids = IdSet.from_parts([np.array([5, 3, 9]), np.array([3, 1])])
+    assert ids.ids.tolist() == [1, 3, 5, 9]
+    assert ids.nbytes == 16
+    values = pd.Series(pd.array([1, 2, 9, 10, None], dtype="Int32"))
+    assert ids.contains(values).tolist() == [True, False, True, False, False]
+    assert IdSet().contains(values).tolist() == [False] * 5
+
+
+def test_row_filter():
+    row_filter = RowFilter({"appln_auth": "EP"},
+                           {"appln_id": IdSet([1, 2]), "person_id": IdSet([7])})
+    assert filter_key(Tls207PersAppln) == "appln_id"
+    assert filter_key(Tls212Citation) == "pat_publn_id"
+    assert filter_key(Tls214NplPubln) == "npl_publn_id"
+    assert filter_key(Tls228DocdbFamCitn) == "docdb_family_id"
+    assert filter_key(Tls801Country) is None
+    appln = pd.DataFrame({"appln_id": [1, 3], "appln_auth": ["EP", "US"]})
+    assert row_filter.mask(Tls201Appln, appln).tolist() == [True, False]
+    persons = pd.DataFrame({"person_id": [6, 7]})
+    assert row_filter.mask(Tls206Person, persons).tolist() == [False, True]
+    # Not filtered: there are no publication IDs to filter by
+    assert row_filter.mask(Tls212Citation, pd.DataFrame({"pat_publn_id": [1]})) is None
+
+
+# Applications 1-6, of which EP and GB ones filed after 2000 are 2 and 5,
+# in families 51 and 53
+TABLES = {
+    "tls201": "appln_id,appln_auth,appln_filing_year,docdb_family_id\n"
+              "1,EP,1999,50\n2,EP,2005,51\n3,US,2010,51\n4,CN,2011,52\n"
+              "5,GB,2001,53\n6,EP,,50\n",
+    "tls207": "person_id,appln_id,applt_seq_nr,invt_seq_nr\n"
+              "10,1,1,0\n11,2,1,0\n12,2,0,1\n13,3,1,0\n14,5,1,0\n11,5,0,1\n",
+    "tls206": "person_id,person_name\n"
+              "10,A\n11,B\n12,C\n13,D\n14,E\n",
+    "tls211": "pat_publn_id,appln_id,publn_auth\n"
+              "100,1,EP\n101,2,EP\n102,3,US\n103,5,GB\n",
+    "tls212": "pat_publn_id,citn_replenished,citn_id,cited_pat_publn_id,"
+              "cited_npl_publn_id\n"
+              "100,0,1,0,1001\n101,0,1,100,0\n101,0,2,0,1000\n103,0,1,101,0\n",
+    "tls214": "npl_publn_id,npl_type\n1000,a\n1001,a\n1002,b\n",
+    "tls228": "docdb_family_id,cited_docdb_family_id\n"
+              "50,51\n51,50\n53,51\n52,53\n",
+    "tls801": "ctry_code,st3_name\nEP,European Patent Office\nGB,United Kingdom\n",
+}
+KEPT = {"tls201_appln": ("appln_id", [2, 5]),
+        "tls207_pers_appln": ("person_id", [11, 11, 12, 14]),
+        "tls206_person": ("person_id", [11, 12, 14]),
+        "tls211_pat_publn": ("pat_publn_id", [101, 103]),
+        "tls212_citation": ("pat_publn_id", [101, 101, 103]),
+        "tls214_npl_publn": ("npl_publn_id", [1000]),
+        "tls228_docdb_fam_citn": ("docdb_family_id", [51, 53]),
+        "tls801_country": ("ctry_code", ["EP", "GB"])}  # Not filtered
+
+
+def _archives():
+    """Two archives, with the dependent tables ahead of tls201"""
+    archives = {}
+    prefixes = [["tls207", "tls212", "tls214", "tls801"],
+                ["tls206", "tls211", "tls228", "tls201"]]
+    for i, _prefixes in enumerate(prefixes, 1):
+        bio = BytesIO()
+        with ZipFile(bio, "w") as zf:
+            for prefix in _prefixes:
+                df = pd.read_csv(BytesIO(TABLES[prefix].encode()), dtype=str)
+                zf.writestr(f"{prefix}_part01.zip",
+                            nested_zipfile(f"{prefix}_part01.csv", df))
+        archives[f"data_PATSTAT_Global_2019_05_13_0{i}.zip"] = bio.getvalue()
+    return archives
+
+
+def test_build_row_filter():
+    opened = []
+    def zipfiles():
+        opened.extend(BytesIO(data) for data in _archives().values())
+        return [(None, zipfile) for zipfile in opened[-2:]]
+    make_zipfiles = mock.MagicMock(side_effect=zipfiles)
+    predicates = {"appln_auth": ["EP", "GB"], "appln_filing_year": (2001, None)}
+    row_filter = build_row_filter(make_zipfiles, Base, predicates)
+    # Applications, then their publications, then the literature they cite
+    assert make_zipfiles.call_count == 3
+    assert {key: ids.ids.tolist() for key, ids in row_filter.id_sets.items()} == \
+        {"appln_id": [2, 5], "docdb_family_id": [51, 53],
+         "pat_publn_id": [101, 103], "person_id": [11, 12, 14],
+         "npl_publn_id": [0, 1000]}
+    assert all(zipfile.closed for zipfile in opened)
+
+    # Without persons or publications to load, one pass is enough
+    make_zipfiles.reset_mock()
+    row_filter = build_row_filter(make_zipfiles, Base, predicates,
+                                  skip_table_prefixes=["tls206", "tls21", "tls22",
+                                                       "tls906"])
+    assert make_zipfiles.call_count == 1
+    assert list(row_filter.id_sets) == ["appln_id"]
+    with pytest.raises(ValueError, match="no columns"):
+        build_row_filter(make_zipfiles, Base, {"appln_country": "EP"})
+
+
+@pytest.mark.parametrize("pipeline, n_workers", [(False, 1), (True, 1), (False, 2)])
+def test_download_filtered(tmpdir, pipeline, n_workers):
+    db_url = f"sqlite:///{tmpdir}/patstat.db"
+    predicates = {"appln_auth": ["EP", "GB"], "appln_filing_year": (2001, None)}
+    with FakeEpoServer(_archives()) as server:
+        with mock.patch.multiple("pypatstat.etl.utils", **server.urls()):
+            with pytest.raises(ValueError, match="cache_dir"):
+                _download_patstat_to_db(db_url, Base, appln_filters=predicates,
+                                        username=USERNAME, pwd=PWD)
+            metrics = _download_patstat_to_db(db_url, Base, chunksize=2,
+                                              pipeline=pipeline,
+                                              n_workers=n_workers,
+                                              cache_dir=f"{tmpdir}/cache",
+                                              appln_filters=predicates,
+                                              username=USERNAME, pwd=PWD)
+    engine = create_engine(db_url)
+    for tablename, (column, kept) in KEPT.items():
+        rows = engine.execute(f"SELECT {column} FROM {tablename}").fetchall()
+        assert sorted(row[0] for row in rows) == sorted(kept)
+    assert metrics.count("rows_dropped_filter") == 4 + 2 + 2 + 2 + 1 + 2 + 2
+    assert metrics.count("rows_parsed", table="tls207_pers_appln") == 6
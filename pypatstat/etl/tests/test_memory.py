@@ -0,0 +1,162 @@
+import pytest
+import threading
+import time
+from io import BytesIO
+from unittest import mock
+
+import pandas as pd
+
+from memory import MemoryBudget
+from memory import parse_size
+from memory import peak_rss
+from memory import in_memory_bytes
+from memory import BATCH_OVERHEAD
+from data_loader import PatstatLoader
+from data_loader import _download_patstat_to_db
+from benchmarks.fake_epo import FakeEpoServer
+from benchmarks.fake_epo import USERNAME
+from benchmarks.fake_epo import PWD
+from benchmarks.synthetic import fake_archives
+from orms.patstat_2019_05_13 import Base
+from orms.patstat_2019_05_13 import Tls207PersAppln
+
+from sqlalchemy import create_engine
+
+
+def test_parse_size():
+    assert parse_size("4GB") == 4 * 2**30
+    assert parse_size("512 mb") == 512 * 2**20
+    assert parse_size("1.5G") == 3 * 2**29
+    assert parse_size(1000) == 1000
+    with pytest.raises(ValueError):
+        parse_size("four gigs")
+
+
+@pytest.mark.parametrize("platform,expected", [("linux", 2**20), ("darwin", 2**10)])
+def test_peak_rss_units(platform, expected):
+    usage = mock.Mock(ru_maxrss=2**10)
+    with mock.patch("resource.getrusage", return_value=usage), \
+            mock.patch("sys.platform", platform):
+        assert peak_rss() == expected
+
+
+def test_acquire_waits_for_release():
+    memory = MemoryBudget(1000, shares={"chunks": 1})
+    memory.acquire("chunks", 800)
+    acquired = threading.Event()
+    def reader():
+        memory.acquire("chunks", 800)
+        acquired.set()
+    thread = threading.Thread(target=reader)
+    thread.start()
+    time.sleep(0.2)
+    assert not acquired.is_set()  # Backpressure
+    memory.release("chunks", 800)
+    thread.join(1)
+    assert acquired.is_set()
+    assert memory.peaks["chunks"].value == 800
+    # An oversized item still gets through on its own
+    memory.release_all("chunks")
+    memory.acquire("chunks", 5000)
+    assert memory.over("chunks")
+
+
+def test_max_rows():
+    memory = MemoryBudget(7 * 2**20, shares={"chunks": BATCH_OVERHEAD + 2})
+    assert memory.chunk_bytes == 7 * 2**20
+    assert memory.max_rows("tls201_appln", 10**6) == 10**6  # Not yet known
+    chunk = pd.DataFrame({"x": range(1000)})
+    memory.observe_chunk("tls201_appln", chunk, 2**20)
+    assert memory.max_rows("tls201_appln", 10**6) == 7000
+    assert memory.max_rows("tls201_appln", lambda: 500) == 500
+
+
+def test_spooled_file_spills():
+    memory = MemoryBudget(1000, shares={"download": 1})
+    f = memory.spooled_file(n_files=2)
+    f.write(b"x" * 400)
+    assert in_memory_bytes(f) == 400
+    f.write(b"x" * 200)
+    assert in_memory_bytes(f) == 0  # Spilled to disk
+    assert in_memory_bytes(BytesIO(b"xyz")) == 3
+
+
+def test_pk_indexes_within_budget(tmpdir):
+    db_url = f"sqlite:///{tmpdir}/patstat.db"
+    with PatstatLoader(db_url, Base, max_memory=1000,
+                       spill_dir=str(tmpdir)) as loader:
+        assert loader.memory.share("pk_index") == 200
+        rows = [dict(person_id=i, appln_id=i, applt_seq_nr=1, invt_seq_nr=0)
+                for i in range(100)]
+        loader.engine.execute(Tls207PersAppln.__table__.insert(), rows)
+        chunk = pd.DataFrame(rows[95:] + [dict(person_id=100, appln_id=100,
+                                               applt_seq_nr=1, invt_seq_nr=0)])
+        with mock.patch.object(loader.backend, "can_skip_duplicates",
+                               return_value=False):
+            assert loader.write_item("tls207", chunk, filter_pks=True) == 1
+        index = loader.pk_indexes["tls207_pers_appln"]
+        assert index.spill_file is not None  # 1200 bytes of PKs spilled
+        assert loader.memory.usage["pk_index"].value == 0
+        assert loader.memory.usage["chunks"].value == 0
+
+
+def test_pk_index_in_use_is_kept(tmpdir):
+    db_url = f"sqlite:///{tmpdir}/patstat.db"
+    with PatstatLoader(db_url, Base, max_memory=1000) as loader:
+        rows = [dict(person_id=i, appln_id=i, applt_seq_nr=1, invt_seq_nr=0)
+                for i in range(100)]
+        loader.engine.execute(Tls207PersAppln.__table__.insert(), rows)
+        chunk = pd.DataFrame(rows[95:] + [dict(person_id=100, appln_id=100,
+                                               applt_seq_nr=1, invt_seq_nr=0)])
+        # Loaded whole, and over budget, but can't be spilled (as with
+        # variable length string keys)
+        with mock.patch.object(loader.backend, "can_skip_duplicates",
+                               return_value=False), \
+                mock.patch.object(loader.memory, "room", return_value=None), \
+                mock.patch("pypatstat.etl.pk_index.PkIndex.spill",
+                           return_value=False):
+            assert loader.write_item("tls207", chunk, filter_pks=True) == 1
+            assert "tls207_pers_appln" in loader.pk_indexes
+            assert loader.memory.over("pk_index")
+
+
+@pytest.mark.parametrize("pipeline", [True, False])
+def test_download_within_budget(tmpdir, pipeline):
+    tables = ["tls201_appln", "tls207_pers_appln"]
+    archives, table_rows = fake_archives(2000, tables=tables, n_parts=2,
+                                         n_archives=2)
+    db_url = f"sqlite:///{tmpdir}/patstat.db"
+    max_memory = 2**17
+    with FakeEpoServer(archives) as server:
+        with mock.patch.multiple("pypatstat.etl.utils", **server.urls()):
+            metrics = _download_patstat_to_db(db_url, Base, chunksize=1000,
+                                              pipeline=pipeline,
+                                              max_memory=max_memory,
+                                              spill_dir=str(tmpdir),
+                                              username=USERNAME, pwd=PWD)
+    engine = create_engine(db_url)
+    for tablename, n_rows in table_rows.items():
+        assert engine.execute(f"SELECT COUNT(*) FROM {tablename}").scalar() == n_rows
+    # Archives are bigger than their part of the downloads' share
+    assert metrics.count("archives_spilled") == 2
+    # Chunks are capped to fit in their share, after the first of each table
+    assert metrics.gauges["memory_peak_chunks_bytes"] > 0
+    assert metrics.n_observed["insert", "tls201_appln"] > 4 * 4000 / 1000
+    assert metrics.gauges["memory_peak_rss_bytes"] > max_memory
+
+
+def test_pipelined_load_releases_chunks(tmpdir):
+    tables = ["tls201_appln", "tls207_pers_appln"]
+    archives, table_rows = fake_archives(2000, tables=tables, n_parts=2,
+                                         n_archives=2)
+    db_url = f"sqlite:///{tmpdir}/patstat.db"
+    def make_zipfiles(metrics):
+        return [(name, BytesIO(data)) for name, data in archives.items()]
+    with PatstatLoader(db_url, Base, max_memory=2**24) as loader:
+        # Don't empty the stage once loaded, so that a leak would show
+        with mock.patch.object(loader.memory, "release_all"):
+            n_rows = loader.load_zipfiles_pipelined(make_zipfiles,
+                                                    chunksize=500)
+        assert n_rows == sum(table_rows.values())
+        assert loader.memory.peaks["chunks"].value > 0
+        assert loader.memory.usage["chunks"].value == 0
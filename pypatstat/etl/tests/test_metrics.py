@@ -0,0 +1,157 @@
+import pytest
+import json
+from io import BytesIO
+from zipfile import ZipFile
+from zipfile import ZIP_DEFLATED
+
+from metrics import Metrics
+from metrics import MetricsReporter
+from metrics import timed
+from metrics import write_metrics
+from data_loader import PatstatLoader
+from orms.patstat_2019_05_13 import Base
+
+
+def test_counters_and_timers():
+    metrics = Metrics()
+    metrics.inc("rows_parsed", 10, table="tls201_appln")
+    metrics.inc("rows_parsed", 5, table="tls207_pers_appln")
+    metrics.inc("rows_parsed", 1, table="tls201_appln")
+    assert metrics.count("rows_parsed") == 16
+    assert metrics.count("rows_parsed", table="tls201_appln") == 11
+    assert metrics.count("rows_inserted") == 0
+    assert list(timed([1, 2, 3], metrics, "parse")) == [1, 2, 3]
+    assert ("parse", None) in metrics.timers
+
+
+def test_percentiles():
+    metrics = Metrics(max_samples=1000)
+    for i in range(1, 2001):
+        metrics.observe("insert", i / 1000, table="tls201_appln")
+    assert metrics.n_observed["insert", "tls201_appln"] == 2000
+    assert len(metrics.samples["insert", "tls201_appln"]) == 1000
+    assert metrics.timers["insert", "tls201_appln"] == pytest.approx(2001)
+    percentiles = metrics.percentiles("insert", table="tls201_appln")
+    # The reservoir is a uniform sample of all of the latencies
+    assert percentiles[50] == pytest.approx(1, abs=0.15)
+    assert percentiles[99] == pytest.approx(1.98, abs=0.05)
+    assert metrics.percentiles("insert") == {}
+
+
+def test_pop_and_merge():
+    worker, parent = Metrics(), Metrics()
+    worker.inc("rows_inserted", 7, table="tls201_appln")
+    worker.observe("insert", 0.5, table="tls201_appln")
+    parent.inc("rows_inserted", 3, table="tls201_appln")
+    parent.merge(worker.pop())
+    assert worker.count("rows_inserted") == 0
+    assert parent.count("rows_inserted") == 10
+    assert parent.n_observed["insert", "tls201_appln"] == 1
+    assert parent.percentiles("insert", table="tls201_appln")[50] == 0.5
+
+
+@pytest.mark.parametrize("n_worker", [10000, 100])
+def test_merge_is_uniform(n_worker):
+    worker, parent = Metrics(max_samples=1000), Metrics(max_samples=1000)
+    for _ in range(10000):
+        parent.observe("insert", 0)
+    for _ in range(n_worker):
+        worker.observe("insert", 1)
+    parent.merge(worker.pop())
+    samples = parent.samples["insert", None]
+    assert len(samples) == 1000
+    # Each stream is sampled in proportion to its observations
+    assert sum(samples) / len(samples) == \
+        pytest.approx(n_worker / (10000 + n_worker), abs=0.07)
+
+
+def test_progress():
+    metrics = Metrics()
+    assert metrics.progress() == (None, None)
+    metrics.set("archives_total", 4)
+    metrics.inc("archives_downloaded")
+    metrics.inc("bytes_downloaded", 100)
+    metrics.inc("bytes_loaded", 50)
+    metrics.start -= 10
+    fraction, eta = metrics.progress()
+    # 50 of an estimated 400 bytes loaded in 10s
+    assert fraction == 0.125
+    assert eta == pytest.approx(70, abs=1)
+    assert "12.5% done" in metrics.summary()
+
+
+def test_prometheus_format(tmpdir):
+    metrics = Metrics()
+    metrics.inc("rows_inserted", 7, table="tls201_appln")
+    metrics.observe("insert", 0.5, table="tls201_appln")
+    with metrics.timer("parse"):
+        pass
+    text = metrics.to_prometheus()
+    assert "# TYPE pypatstat_rows_inserted_total counter" in text
+    assert 'pypatstat_rows_inserted_total{table="tls201_appln"} 7' in text
+    assert "# TYPE pypatstat_parse_seconds_total counter" in text
+    assert "# TYPE pypatstat_insert_seconds summary" in text
+    assert 'pypatstat_insert_seconds{table="tls201_appln",quantile="0.5"} 0.5' in text
+    assert 'pypatstat_insert_seconds_count{table="tls201_appln"} 1' in text
+    # The insert latencies aren't also exported as a plain timer
+    assert "pypatstat_insert_seconds_total" not in text
+
+    path = f"{tmpdir}/metrics.prom"
+    write_metrics(metrics, path)
+    with open(path) as f:
+        assert f.read() == text
+    write_metrics(metrics, f"{tmpdir}/metrics.json")
+    with open(f"{tmpdir}/metrics.json") as f:
+        data = json.load(f)
+    assert data["counters"]["rows_inserted"]["tls201_appln"] == 7
+    assert data["latencies"]["insert"]["tls201_appln"]["count"] == 1
+
+
+def test_reporter_reports_on_exit(tmpdir):
+    metrics = Metrics()
+    path = f"{tmpdir}/metrics.json"
+    with MetricsReporter(metrics, path=path, interval=3600):
+        metrics.inc("rows_parsed", 3)
+    with open(path) as f:
+        assert json.load(f)["counters"]["rows_parsed"]["all"] == 3
+
+
+def _tls207_archive(n_files, n_rows):
+    """An archive of zipped tls207 CSVs, with a null PK row in each"""
+    outer = BytesIO()
+    with ZipFile(outer, "w") as zf:
+        for i in range(n_files):
+            text = "person_id,appln_id,applt_seq_nr,invt_seq_nr\n"
+            text += "".join(f"{i},{j},1,0\n" for j in range(n_rows))
+            text += "0,0,0,0\n"
+            inner = BytesIO()
+            with ZipFile(inner, "w", compression=ZIP_DEFLATED) as _zf:
+                _zf.writestr(f"tls207_part0{i}.csv", text)
+            zf.writestr(f"tls207_part0{i}.zip", inner.getvalue())
+    outer.seek(0)
+    return outer
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_loader_metrics(tmpdir, n_workers):
+    db_url = f"sqlite:///{tmpdir}/patstat.db"
+    table = "tls207_pers_appln"
+    with PatstatLoader(db_url, Base, resume=False) as loader:
+        loader.load_zipfile(_tls207_archive(3, 20), chunksize=7,
+                            n_workers=n_workers)
+        metrics = loader.metrics
+        assert metrics.count("rows_parsed", table=table) == 3*21
+        assert metrics.count("rows_dropped_null_pk", table=table) == 3
+        assert metrics.count("rows_inserted", table=table) == 3*20
+        assert metrics.count("rows_dropped_duplicate") == 0
+        assert metrics.n_observed["insert", table] == 3*3
+        assert metrics.count("bytes_decompressed", table=table) > 0
+        assert metrics.count("bytes_loaded") > 0
+        for stage in ("parse", "convert", "decompress"):
+            assert (stage, table) in metrics.timers
+
+        # Reloading the first file inserts nothing new
+        loader.load_zipfile(_tls207_archive(1, 20), chunksize=7,
+                            restart_filename="tls207_part00")
+        assert metrics.count("rows_inserted", table=table) == 3*20
+        assert metrics.count("rows_dropped_duplicate", table=table) == 20
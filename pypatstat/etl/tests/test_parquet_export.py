@@ -0,0 +1,98 @@
+from io import BytesIO
+import subprocess
+import sys
+from zipfile import ZipFile
+from zipfile import ZIP_DEFLATED
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from parquet_export import arrow_schema
+from parquet_export import partition_column
+from parquet_export import zipfile_to_parquet
+from orms.patstat_2019_05_13 import Base
+from orms.patstat_2019_05_13 import Tls201Appln
+from orms.patstat_2019_05_13 import Tls207PersAppln
+
+
+def _archive(nested):
+    """An archive of zipped CSVs, as PATSTAT ships them"""
+    outer = BytesIO()
+    with ZipFile(outer, "w") as zf:
+        for fname, text in nested.items():
+            inner = BytesIO()
+            with ZipFile(inner, "w", compression=ZIP_DEFLATED) as izf:
+                izf.writestr(fname.replace(".zip", ".csv"), text)
+            zf.writestr(fname, inner.getvalue())
+    outer.seek(0)
+    return outer
+
+
+def test_arrow_schema():
+    schema = arrow_schema(Tls201Appln)
+    assert schema.field("appln_id").type == pa.int32()
+    assert not schema.field("appln_id").nullable
+    assert schema.field("appln_filing_year").type == pa.int16()
+    assert schema.field("appln_filing_date").type == pa.date32()
+    assert schema.field("appln_auth").type == pa.dictionary(pa.int32(), pa.string())
+    assert schema.field("appln_nr").type == pa.string()
+    # Partitioned on an existing column, so no column is added
+    assert partition_column(Tls201Appln) == ("appln_filing_year",) * 2
+    assert len(schema) == len(Tls201Appln.__table__.columns)
+    # Partitioned on a bucket of the first integer PK
+    assert partition_column(Tls207PersAppln) == ("person_id_bucket", "person_id")
+    assert arrow_schema(Tls207PersAppln).field("person_id_bucket").type == pa.int32()
+
+
+def test_zipfile_to_parquet(tmpdir):
+    tls201 = ("appln_id,appln_auth,appln_nr,appln_filing_date,appln_filing_year\n"
+              "1,EP,123,2001-02-03,2001\n"
+              "2,US,456,9999-12-31,9999\n"
+              "3,EP,789,2001-05-06,2001\n")
+    tls207 = ("person_id,appln_id,applt_seq_nr,invt_seq_nr\n"
+              "1,1,1,0\n"
+              "20000000,2,1,0\n")
+    archive = _archive({"tls201_part01.zip": tls201,
+                        "tls207_part01.zip": tls207})
+    n_rows = zipfile_to_parquet(archive, str(tmpdir), Base, chunksize=2)
+    assert n_rows == 5
+
+    dataset = ds.dataset(f"{tmpdir}/tls201_appln", partitioning="hive")
+    assert sorted(p.split("/")[-2] for p in dataset.files) == \
+        ["appln_filing_year=2001", "appln_filing_year=9999"]
+    df = dataset.to_table().to_pandas().sort_values("appln_id")
+    assert df.appln_id.tolist() == [1, 2, 3]
+    assert str(df.appln_filing_date.iloc[1]) == "9999-12-31"
+    assert df.appln_auth.astype(str).tolist() == ["EP", "US", "EP"]
+
+    dataset = ds.dataset(f"{tmpdir}/tls207_pers_appln", partitioning="hive")
+    table = dataset.to_table()
+    assert table.schema.field("person_id").type == pa.int32()
+    assert sorted(table.column("person_id_bucket").to_pylist()) == [0, 2]
+
+
+def test_zipfile_to_parquet_rewrite(tmpdir):
+    text = ("appln_id,ipc_class_symbol\n"
+            "1,A01\n")
+    for _ in range(2):
+        zipfile_to_parquet(_archive({"tls209_part01.zip": text}),
+                           str(tmpdir), Base)
+    # Rewriting a nested file replaces its output
+    assert ds.dataset(f"{tmpdir}/tls209_appln_ipc").count_rows() == 1
+
+
+def test_zipfile_to_parquet_parallel(tmpdir):
+    nested = {f"tls207_part0{i}.zip":
+              "person_id,appln_id,applt_seq_nr,invt_seq_nr\n" +
+              "".join(f"{i},{j},1,0\n" for j in range(20))
+              for i in range(3)}
+    n_rows = zipfile_to_parquet(_archive(nested), str(tmpdir), Base,
+                                chunksize=7, n_workers=2)
+    assert n_rows == 60
+    assert ds.dataset(f"{tmpdir}/tls207_pers_appln").count_rows() == 60
+
+
+def test_pyarrow_only_needed_for_parquet():
+    code = ("import sys; sys.modules['pyarrow'] = None; import pypatstat; "
+            "assert 'pypatstat.etl.parquet_export' not in sys.modules")
+    subprocess.run([sys.executable, "-c", code], check=True)
@@ -0,0 +1,164 @@
+import pytest
+import multiprocessing
+import threading
+import time
+from io import BytesIO
+from unittest import mock
+
+from pipeline import prefetch
+from pipeline import prefetch_process
+from pipeline import RemoteTraceback
+from pipeline import prefetch_reader
+from pipeline import queue_depths
+from metrics import Metrics
+from data_loader import _download_patstat_to_db
+from benchmarks.fake_epo import FakeEpoServer
+from benchmarks.fake_epo import USERNAME
+from benchmarks.fake_epo import PWD
+from benchmarks.synthetic import fake_archives
+from orms.patstat_2019_05_13 import Base
+
+from sqlalchemy import create_engine
+
+
+def test_prefetch_backpressure():
+    produced = []
+    def produce():
+        for i in range(10):
+            produced.append(i)
+            yield i
+    items = prefetch(produce(), depth=2)
+    assert next(items) == 0
+    time.sleep(0.2)
+    # One item taken, two in the queue and one waiting to be put
+    assert len(produced) == 4
+    assert list(items) == list(range(1, 10))
+
+
+def test_prefetch_raises_in_consumer():
+    def produce():
+        yield 1
+        raise ValueError("Bad CSV")
+    items = prefetch(produce(), depth=1)
+    assert next(items) == 1
+    with pytest.raises(ValueError, match="Bad CSV"):
+        next(items)
+
+
+def test_prefetch_close_stops_producer():
+    closed = threading.Event()
+    def produce():
+        try:
+            for i in range(1000):
+                yield i
+        finally:
+            closed.set()
+    items = prefetch(produce(), depth=1)
+    assert next(items) == 0
+    items.close()
+    assert closed.is_set()
+    assert not any(t.name == "pypatstat-prefetch" for t in threading.enumerate())
+
+
+def test_prefetch_metrics():
+    metrics = Metrics()
+    def slow():
+        for i in range(3):
+            time.sleep(0.05)
+            yield i
+    assert list(prefetch(slow(), depth=1, name="parse", metrics=metrics)) == [0, 1, 2]
+    assert metrics.timers["parse_wait", None] > 0.1
+
+
+def _count_up(metrics, n, fail_at=None):
+    for i in range(n):
+        if i == fail_at:
+            raise ValueError(f"Failed at {i}")
+        metrics.inc("rows_parsed", table="tls201_appln")
+        yield i
+
+
+def test_prefetch_process():
+    metrics = Metrics()
+    items = prefetch_process(_count_up, args=(100,), depth=5, name="parse",
+                             metrics=metrics)
+    assert list(items) == list(range(100))
+    # The child's metrics are merged back
+    assert metrics.count("rows_parsed", table="tls201_appln") == 100
+    assert ("parse_wait", None) in metrics.timers
+
+
+def test_prefetch_process_raises_in_consumer():
+    items = prefetch_process(_count_up, args=(100, 10))
+    with pytest.raises(ValueError, match="Failed at 10") as err:
+        list(items)
+    assert isinstance(err.value.__cause__, RemoteTraceback)
+    assert "_count_up" in str(err.value.__cause__)
+
+
+def test_prefetch_process_close():
+    items = prefetch_process(_count_up, args=(10**9,), depth=2)
+    assert next(items) == 0
+    items.close()
+    assert not any(p.name == "pypatstat-prefetch"
+                   for p in multiprocessing.active_children())
+
+
+def test_prefetch_reader():
+    data = bytes(range(256)) * 10000
+    with prefetch_reader(BytesIO(data), 4, block_size=1000) as f:
+        assert f.read(10) == data[:10]
+        assert f.read() == data[10:]
+    f = BytesIO(data)
+    with prefetch_reader(f, 0) as reader:
+        assert reader is f
+
+
+def test_queue_depths():
+    depths = queue_depths({"parse": 10})
+    assert depths["parse"] == 10
+    assert depths["download"] == 1
+
+
+@pytest.mark.parametrize("pipeline", [True, False])
+@pytest.mark.parametrize("auto_chunksize", [True, False])
+def test_pipelined_download(tmpdir, pipeline, auto_chunksize):
+    tables = ["tls201_appln", "tls207_pers_appln"]
+    archives, table_rows = fake_archives(300, tables=tables, n_parts=3,
+                                         n_archives=3)
+    db_url = f"sqlite:///{tmpdir}/patstat.db"
+    with FakeEpoServer(archives) as server:
+        with mock.patch.multiple("pypatstat.etl.utils", **server.urls()):
+            metrics = _download_patstat_to_db(db_url, Base, chunksize=50,
+                                              pipeline=pipeline,
+                                              pipeline_depths={"parse": 2},
+                                              auto_chunksize=auto_chunksize,
+                                              username=USERNAME, pwd=PWD)
+    engine = create_engine(db_url)
+    for tablename, n_rows in table_rows.items():
+        assert engine.execute(f"SELECT COUNT(*) FROM {tablename}").scalar() == n_rows
+    assert metrics.count("archives_downloaded") == 3
+    assert metrics.count("rows_inserted") == sum(table_rows.values())
+    assert ("download_wait", None) in metrics.timers
+    # Every archive, and every CSV in them, was journaled as complete
+    n_complete = engine.execute("SELECT COUNT(*) FROM pypatstat_checkpoint "
+                                "WHERE complete").scalar()
+    assert n_complete == 3 + 2*3
+
+
+@pytest.mark.parametrize("auto_chunksize", [True, False])
+def test_pipelined_download_spawn_default(tmpdir, spawn_by_default,
+                                          auto_chunksize):
+    # The child, and the queue sharing chunk sizes with it, are forked all
+    # the same, as the ORM can't be pickled
+    archives, table_rows = fake_archives(100, tables=["tls207_pers_appln"],
+                                         n_parts=2, n_archives=1)
+    db_url = f"sqlite:///{tmpdir}/patstat.db"
+    with FakeEpoServer(archives) as server:
+        with mock.patch.multiple("pypatstat.etl.utils", **server.urls()):
+            _download_patstat_to_db(db_url, Base, chunksize=50, pipeline=True,
+                                    auto_chunksize=auto_chunksize,
+                                    username=USERNAME, pwd=PWD)
+    engine = create_engine(db_url)
+    n = engine.execute("SELECT COUNT(*) FROM tls207_pers_appln").scalar()
+    assert n == table_rows["tls207_pers_appln"]
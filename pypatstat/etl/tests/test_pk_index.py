@@ -0,0 +1,108 @@
+import pytest
+import numpy as np
+import pandas as pd
+
+from pk_index import PkIndex
+from pk_index import pk_dtype
+from pk_index import keys_after
+from pk_index import from_pk_array
+from pk_index import to_pk_array
+from data_loader import chunk_to_batch
+from orms.patstat_2019_05_13 import Base
+from orms.patstat_2019_05_13 import Tls207PersAppln
+from orms.patstat_2019_05_13 import Tls209ApplnIpc
+
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import mssql
+
+TLS207_COLUMNS = ["person_id", "appln_id", "applt_seq_nr", "invt_seq_nr"]
+
+
+def test_pk_dtype():
+    assert pk_dtype(Tls207PersAppln) == np.dtype([("person_id", "i4"),
+                                                  ("appln_id", "i4"),
+                                                  ("applt_seq_nr", "i2"),
+                                                  ("invt_seq_nr", "i2")])
+    assert pk_dtype(Tls207PersAppln).itemsize == 12
+    # VARCHAR codes take a byte per character
+    assert pk_dtype(Tls209ApplnIpc)["ipc_class_symbol"] == np.dtype("S15")
+
+
+def test_keys_after_has_no_row_values():
+    pkey_cols = list(Tls209ApplnIpc.__table__.primary_key.columns)
+    clause = keys_after(pkey_cols, (1, "A01"))
+    sql = str(clause.compile(dialect=mssql.dialect(),
+                             compile_kwargs={"literal_binds": True}))
+    assert sql == ("tls209_appln_ipc.appln_id > 1 OR "
+                   "tls209_appln_ipc.appln_id = 1 AND "
+                   "tls209_appln_ipc.ipc_class_symbol > 'A01'")
+
+
+@pytest.mark.parametrize("chunksize", [1, 7, 1000])
+def test_from_db_keyset_pagination(tmpdir, chunksize):
+    engine = create_engine(f"sqlite:///{tmpdir}/patstat.db")
+    Base.metadata.create_all(engine, tables=[Tls207PersAppln.__table__])
+    rows = [(i % 3, i % 5, i % 2, i) for i in range(50)]
+    engine.execute(Tls207PersAppln.__table__.insert(),
+                   [dict(zip(TLS207_COLUMNS, row)) for row in rows])
+    index = PkIndex.from_db(engine, Tls207PersAppln, chunksize=chunksize)
+    assert len(index) == 50
+    assert sorted(tuple(k) for k in index.keys) == sorted(rows)
+
+    chunk = pd.DataFrame(rows[5::5] + [(9, 9, 9, 9), (0, 0, 0, 1)],
+                         columns=TLS207_COLUMNS)
+    mask = index.contains(chunk_to_batch(chunk, Tls207PersAppln))
+    assert mask.tolist() == [True]*9 + [False, False]
+
+
+def test_from_db_spills(tmpdir):
+    engine = create_engine(f"sqlite:///{tmpdir}/patstat.db")
+    Base.metadata.create_all(engine, tables=[Tls207PersAppln.__table__])
+    rows = [(i % 3, i % 5, i % 2, i) for i in range(50)]
+    engine.execute(Tls207PersAppln.__table__.insert(),
+                   [dict(zip(TLS207_COLUMNS, row)) for row in rows])
+    index = PkIndex.from_db(engine, Tls207PersAppln, chunksize=7,
+                            max_bytes=100, spill_dir=str(tmpdir))
+    assert index.spill_file is not None
+    assert isinstance(index.keys, np.memmap)
+    assert index.nbytes == 0
+    assert [tuple(k) for k in index.keys] == sorted(rows)
+    chunk = pd.DataFrame([rows[3], (9, 9, 9, 9)], columns=TLS207_COLUMNS)
+    mask = index.contains(chunk_to_batch(chunk, Tls207PersAppln))
+    assert mask.tolist() == [True, False]
+
+
+def test_contains_strings():
+    keys = np.array([(1, "A01"), (1, "B02"), (2, "A01")],
+                    dtype=pk_dtype(Tls209ApplnIpc))
+    index = PkIndex(Tls209ApplnIpc, keys)
+    chunk = pd.DataFrame({"appln_id": [2, 1, 3, 1],
+                          "ipc_class_symbol": ["A01", "A01", "A01", "C03"]})
+    mask = index.contains(chunk_to_batch(chunk, Tls209ApplnIpc))
+    assert mask.tolist() == [True, True, False, False]
+    assert from_pk_array(index.keys[:1]) == [(1, "A01")]
+    # Truncated to 15 bytes, this would match a key in the index
+    chunk = pd.DataFrame({"appln_id": [1], "ipc_class_symbol": ["A01" + "é" * 7]})
+    keys = to_pk_array([[1], ["A01" + "é" * 6]], pk_dtype(Tls209ApplnIpc))
+    index = PkIndex(Tls209ApplnIpc, keys)
+    assert index.contains(chunk_to_batch(chunk, Tls209ApplnIpc)).tolist() == [False]
+
+
+def test_contains_empty():
+    index = PkIndex(Tls207PersAppln, np.empty(0, dtype=pk_dtype(Tls207PersAppln)))
+    chunk = pd.DataFrame([(1, 2, 3, 4)], columns=TLS207_COLUMNS)
+    assert index.contains(chunk_to_batch(chunk, Tls207PersAppln)).tolist() == [False]
+
+
+def test_spill(tmpdir):
+    rows = [(i, i % 5, 1, 0) for i in range(50)]
+    keys = np.array(rows, dtype=pk_dtype(Tls207PersAppln))
+    index = PkIndex(Tls207PersAppln, keys)
+    assert index.nbytes == 600
+    assert index.spill(str(tmpdir))
+    assert index.nbytes == 0
+    assert isinstance(index.keys, np.memmap)
+    assert not index.spill(str(tmpdir))  # Already spilled
+    chunk = pd.DataFrame([(3, 3, 1, 0), (3, 4, 1, 0)], columns=TLS207_COLUMNS)
+    mask = index.contains(chunk_to_batch(chunk, Tls207PersAppln))
+    assert mask.tolist() == [True, False]
@@ -0,0 +1,104 @@
+import pytest
+import glob
+import os
+import pstats
+from io import BytesIO
+from zipfile import ZipFile
+from zipfile import ZIP_DEFLATED
+
+from profiling import Profiler
+from profiling import StackSampler
+from data_loader import zipfile_to_db
+from orms.patstat_2019_05_13 import Base
+
+
+def _busy(n=20000):
+    return [str(i) * 3 for i in range(n)]
+
+
+def test_first_n_chunks_are_profiled(tmpdir):
+    profiler = Profiler(str(tmpdir), n_chunks=2)
+    chunks = []
+    for chunk in profiler.chunks(range(5), "tls201_appln"):
+        chunks.append(_busy())
+        assert (profiler.active == "tls201_appln") == (chunk < 2)
+    assert len(chunks) == 5
+    assert profiler.n_profiled["tls201_appln"] == 2
+    assert profiler.n_seen["tls201_appln"] == 5
+    # The allocations of the profiled chunks are traced
+    assert any("test_profiling.py" in line and size > 0
+               for line, size in profiler.allocated["tls201_appln"].items())
+
+    profiler.dump("tls201_appln")
+    stem = f"{tmpdir}/tls201_appln.{os.getpid()}"
+    stats = pstats.Stats(f"{stem}.prof")
+    assert any(name == "_busy" for _, _, name in stats.stats)
+    with open(f"{stem}.txt") as f:
+        summary = f.read()
+    assert "Profiled 2 of 5 chunks of tls201_appln" in summary
+    assert "Top allocators" in summary
+    assert "Hotspots (by cumulative time)" in summary
+
+
+def test_sampled_fraction(tmpdir):
+    profiler = Profiler(str(tmpdir), fraction=0)
+    assert not any(profiler.sampled("tls201_appln") for _ in range(100))
+    profiler.fraction = 1
+    assert all(profiler.sampled("tls201_appln") for _ in range(100))
+    # The final next(), which finds no chunk, isn't counted
+    profiler = Profiler(str(tmpdir), fraction=1)
+    assert list(profiler.chunks(range(3), "tls201_appln")) == [0, 1, 2]
+    assert profiler.n_seen["tls201_appln"] == profiler.n_profiled["tls201_appln"] == 3
+    assert profiler.active is None
+
+
+def test_disabled_profiler(tmpdir):
+    profiler = Profiler()
+    assert list(profiler.chunks(range(3), "tls201_appln")) == [0, 1, 2]
+    assert profiler.n_profiled["tls201_appln"] == 0
+    profiler.dump("tls201_appln")
+    with pytest.raises(ValueError):
+        Profiler(str(tmpdir), mode="perf")
+
+
+def test_stack_sampler(tmpdir):
+    sampler = StackSampler(interval=0.001)
+    sampler.enable()
+    for _ in range(20):
+        _busy()
+    sampler.disable()
+    assert sum(sampler.stacks.values()) > 0
+    assert "test_profiling.py:_busy" in sampler.hotspots()
+    sampler.dump_stats(f"{tmpdir}/stacks.folded")
+    with open(f"{tmpdir}/stacks.folded") as f:
+        stack, n = f.readline().rsplit(" ", 1)
+    assert ";" in stack and int(n) > 0
+
+
+def _tls207_archive(n_files, n_rows):
+    outer = BytesIO()
+    with ZipFile(outer, "w") as zf:
+        for i in range(n_files):
+            text = "person_id,appln_id,applt_seq_nr,invt_seq_nr\n"
+            text += "".join(f"{i},{j},1,0\n" for j in range(n_rows))
+            inner = BytesIO()
+            with ZipFile(inner, "w", compression=ZIP_DEFLATED) as _zf:
+                _zf.writestr(f"tls207_part0{i}.csv", text)
+            zf.writestr(f"tls207_part0{i}.zip", inner.getvalue())
+    outer.seek(0)
+    return outer
+
+
+@pytest.mark.parametrize("mode", ["cprofile", "sample"])
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_zipfile_to_db_profiled(tmpdir, mode, n_workers):
+    profile_dir = f"{tmpdir}/profiles"
+    zipfile_to_db(_tls207_archive(2, 50), f"sqlite:///{tmpdir}/patstat.db",
+                  Base, chunksize=10, n_workers=n_workers,
+                  profile_dir=profile_dir, profile_chunks=2, profile_mode=mode)
+    extension = "prof" if mode == "cprofile" else "folded"
+    assert glob.glob(f"{profile_dir}/tls207_pers_appln.*.{extension}")
+    summaries = glob.glob(f"{profile_dir}/tls207_pers_appln.*.txt")
+    assert summaries
+    with open(summaries[0]) as f:
+        assert "chunks of tls207_pers_appln" in f.read()
@@ -0,0 +1,90 @@
+import pytest
+import os
+import pandas as pd
+import pyarrow as pa
+from datetime import date
+
+from data_loader import PatstatLoader
+from data_loader import chunk_to_batch
+from retrieval import iter_table
+from retrieval import table_query
+from orms.patstat_2019_05_13 import Base
+from orms.patstat_2019_05_13 import Tls206Person
+from orms.patstat_2019_05_13 import Tls209ApplnIpc
+
+POSTGRES_URL = os.environ.get("PYPATSTAT_TEST_POSTGRES_URL")
+COLUMNS = [c.name for c in Tls209ApplnIpc.__table__.columns]
+ROWS = [(i, f"A0{i}", "A" if i % 2 else None,
+         date(2006, 1, 1) if i % 3 else None, "I", "F", "EP")
+        for i in range(1, 26)]
+
+
+@pytest.fixture(params=["sqlite", "postgresql"])
+def db_url(request, tmpdir):
+    if request.param == "sqlite":
+        db_url = f"sqlite:///{tmpdir}/patstat.db"
+    elif POSTGRES_URL is None:
+        pytest.skip("PYPATSTAT_TEST_POSTGRES_URL is not set")
+    else:
+        db_url = POSTGRES_URL
+    with PatstatLoader(db_url, Base) as loader:
+        batch = chunk_to_batch(pd.DataFrame(ROWS, columns=COLUMNS), Tls209ApplnIpc)
+        loader.write(Tls209ApplnIpc, batch)
+        yield db_url
+        Base.metadata.drop_all(loader.engine)
+
+
+def test_table_query():
+    query = table_query(Tls209ApplnIpc, columns=["appln_id"],
+                        where=[Tls209ApplnIpc.appln_id > 1,
+                               Tls209ApplnIpc.ipc_value == "I"])
+    sql = str(query)
+    assert sql.startswith("SELECT tls209_appln_ipc.appln_id \nFROM")
+    assert "appln_id >" in sql and "AND" in sql
+
+
+def test_iter_table(db_url):
+    batches = list(iter_table(db_url, Tls209ApplnIpc, batch_size=10))
+    assert [len(df) for df in batches] == [10, 10, 5]
+    df = pd.concat(batches).sort_values("appln_id")
+    assert list(df.columns) == COLUMNS
+    assert str(df.appln_id.dtype) == "Int32"
+    assert str(df.ipc_value.dtype) == "category"
+    assert df.appln_id.tolist() == list(range(1, 26))
+    assert df.ipc_class_level.isnull().tolist() == [i % 2 == 0 for i in range(1, 26)]
+    assert df.ipc_version.isnull().tolist() == [i % 3 == 0 for i in range(1, 26)]
+
+
+def test_iter_table_arrow(db_url):
+    batches = list(iter_table(db_url, Tls209ApplnIpc,
+                              columns=["appln_id", "ipc_version"],
+                              where=Tls209ApplnIpc.appln_id <= 4,
+                              arrow=True))
+    table = pa.Table.from_batches(batches)
+    assert table.schema.field("appln_id").type == pa.int32()
+    assert table.schema.field("ipc_version").type == pa.date32()
+    assert sorted(table.column("appln_id").to_pylist()) == [1, 2, 3, 4]
+    assert None in table.column("ipc_version").to_pylist()
+
+
+def test_iter_table_empty(db_url):
+    batches = list(iter_table(db_url, Tls209ApplnIpc,
+                              where=Tls209ApplnIpc.appln_id > 100))
+    assert batches == []
+
+
+def test_iter_table_null_strings(db_url):
+    people = pd.DataFrame({"person_id": [1, 2], "person_name": ["A", "B"],
+                           "person_address": ["1 High St", None]})
+    with PatstatLoader(db_url, Base, create_db=False) as loader:
+        loader.write(Tls206Person, chunk_to_batch(people, Tls206Person))
+    columns = ["person_id", "person_address"]
+    df = pd.concat(iter_table(db_url, Tls206Person, columns=columns))
+    df = df.sort_values("person_id")
+    assert df.person_address.tolist()[0] == "1 High St"
+    assert df.person_address.isnull().tolist() == [False, True]
+    table = pa.Table.from_batches(iter_table(db_url, Tls206Person,
+                                             columns=columns, arrow=True))
+    assert table.schema.field("person_address").type == pa.string()
+    assert sorted(table.column("person_address").to_pylist(),
+                  key=str) == ["1 High St", None]
@@ -0,0 +1,161 @@
+import pytest
+import gc
+from unittest import mock
+
+from schema_maker import parse_sql_indexes
+from schema_maker import get_sql_indexes
+from schema_maker import generate_model_text
+from schema_maker import generate_orm_head
+from schema_maker import generate_orm_text
+from schema_maker import parse_schema
+from schema_maker import save_schema
+from schema_maker import load_schema
+from schema_maker import schema_base
+from schema_maker import patstat_base
+from schema_maker import project_base
+
+from sqlalchemy import create_engine
+from sqlalchemy import inspect
+
+INDEX_SCRIPT = """/****** Object:  Index [IX_docdb_family_id] ******/
+CREATE NONCLUSTERED INDEX [IX_docdb_family_id] ON [dbo].[tls201_appln]
+(
+\t[docdb_family_id] ASC
+)WITH (PAD_INDEX = OFF, STATISTICS_NORECOMPUTE = OFF) ON [PRIMARY]
+GO
+CREATE UNIQUE NONCLUSTERED INDEX [tls201_appln_auth_nr] ON [dbo].[tls201_appln]
+(
+\t[appln_auth] ASC,
+\t[appln_nr] DESC
+)
+INCLUDE ([appln_kind]) WITH (PAD_INDEX = OFF) ON [PRIMARY]
+GO
+"""
+
+TABLE_SCRIPT = """/****** Object:  Table [dbo].[tls201_appln] ******/
+CREATE TABLE [dbo].[tls201_appln](
+	[appln_id] [int] NOT NULL DEFAULT ('0'),
+	[appln_auth] [char](2) NOT NULL DEFAULT (''),
+	[appln_nr] [varchar](15) NOT NULL DEFAULT (''),
+	[appln_abstract] [nvarchar](max) NULL,
+	[appln_filing_date] [date] NOT NULL DEFAULT ('9999-12-31'),
+	[docdb_family_id] [int] NOT NULL DEFAULT ('0'),
+ CONSTRAINT [PK_tls201_appln] PRIMARY KEY CLUSTERED
+(
+	[appln_id] ASC
+)WITH (PAD_INDEX = OFF) ON [PRIMARY]
+) ON [PRIMARY]
+"""
+SQL_DATA = {"CreateTableScripts": {"tls201_appln.sql": TABLE_SCRIPT},
+            "CreateIndexScripts": {"tls201_appln.sql": INDEX_SCRIPT}}
+
+FIELD_DATA = {"appln_id": ("int", None, "('0')"),
+              "appln_auth": ("char", "2", "('')"),
+              "appln_nr": ("varchar", "15", "('')"),
+              "docdb_family_id": ("int", None, "('0')")}
+
+
+def test_parse_sql_indexes():
+    indexes = parse_sql_indexes(INDEX_SCRIPT)
+    assert dict(indexes) == {
+        "tls201_appln": [
+            ("tls201_appln_ix_docdb_family_id", ["docdb_family_id"], False),
+            ("tls201_appln_auth_nr", ["appln_auth", "appln_nr"], True),
+        ]
+    }
+
+
+def test_get_sql_indexes_skips_table_scripts():
+    sql_data = {"CreateTableScripts": {"tls201_appln.sql": INDEX_SCRIPT},
+                "CreateIndexScripts": {"tls201_appln.sql": INDEX_SCRIPT}}
+    indexes = get_sql_indexes(sql_data)
+    assert len(indexes["tls201_appln"]) == 2
+    assert indexes["tls999_other"] == []
+
+
+def test_generated_indexes_are_built(tmpdir):
+    indexes = parse_sql_indexes(INDEX_SCRIPT)["tls201_appln"]
+    model_text, types = generate_model_text("tls201_appln", FIELD_DATA,
+                                            ["appln_id"], indexes=indexes)
+    orm_text = generate_orm_head(types, has_indexes=True) + model_text
+    namespace = {}
+    exec(orm_text, namespace)
+
+    engine = create_engine(f"sqlite:///{tmpdir}/patstat.db")
+    namespace["Base"].metadata.create_all(engine)
+    built = {idx["name"]: (idx["column_names"], idx["unique"])
+             for idx in inspect(engine).get_indexes("tls201_appln")}
+    assert built == {
+        "tls201_appln_ix_docdb_family_id": (["docdb_family_id"], 0),
+        "tls201_appln_auth_nr": (["appln_auth", "appln_nr"], 1),
+    }
+
+
+def test_no_indexes_no_table_args():
+    model_text, _ = generate_model_text("tls201_appln", FIELD_DATA, ["appln_id"])
+    assert "__table_args__" not in model_text
+
+
+def _columns(table):
+    return [(col.name, str(col.type), col.primary_key,
+             col.default.arg if col.default is not None else None)
+            for col in table.columns]
+
+
+def test_schema_base_matches_generated_orm():
+    schema = parse_schema(SQL_DATA)
+    assert schema["tls201_appln"]["pkeys"] == ["appln_id"]
+    namespace = {}
+    exec(generate_orm_text(schema), namespace)
+    generated = namespace["Base"].metadata.tables["tls201_appln"]
+    built = schema_base(schema).metadata.tables["tls201_appln"]
+    assert _columns(built) == _columns(generated)
+    assert ("appln_filing_date", "DATE", False, "9999-12-31") in _columns(built)
+    assert ("appln_abstract", "NVARCHAR(100000)", False, None) in _columns(built)
+    assert {idx.name for idx in built.indexes} == \
+        {idx.name for idx in generated.indexes}
+
+
+def test_cached_schema_needs_no_network(tmpdir):
+    schema = parse_schema(SQL_DATA)
+    assert load_schema("2020_01_01", str(tmpdir)) is None
+    save_schema(schema, "2020_01_01", str(tmpdir))
+    assert load_schema("2020_01_01", str(tmpdir)) == schema
+    with mock.patch("schema_maker.zipfile_urls") as mocked_urls:
+        db_suffix, Base = patstat_base(db_suffix="2020_01_01",
+                                       cache_dir=str(tmpdir))
+        assert mocked_urls.call_count == 0
+    assert db_suffix == "2020_01_01"
+    gc.collect()  # The classes outlive garbage collection
+    assert Base._decl_class_registry["Tls201Appln"].__tablename__ == "tls201_appln"
+
+
+def test_shipped_orm_needs_no_network(tmpdir):
+    db_suffix, Base = patstat_base(db_suffix="2019_05_13", cache_dir=str(tmpdir))
+    assert "tls201_appln" in Base.metadata.tables
+    with pytest.raises(ValueError):
+        patstat_base(db_suffix="2000_01_01", cache_dir=str(tmpdir))
+
+
+def test_project_base():
+    Base = schema_base(parse_schema(SQL_DATA))
+    projected = project_base(Base, {"tls201_appln": ["docdb_family_id"]})
+    table = projected.metadata.tables["tls201_appln"]
+    assert list(table.columns.keys()) == ["appln_id", "docdb_family_id"]
+    assert table.c.appln_id.primary_key
+    # Indexes on dropped columns are dropped too
+    assert {idx.name for idx in table.indexes} == {"tls201_appln_ix_docdb_family_id"}
+    assert len(Base.metadata.tables["tls201_appln"].columns) == 6  # Unchanged
+    with pytest.raises(ValueError, match="no columns"):
+        project_base(Base, {"tls201_appln": ["appln_abstr"]})
+    with pytest.raises(ValueError, match="No tables"):
+        project_base(Base, {"tls999_other": ["appln_id"]})
+
+
+def test_shipped_orm_projected(tmpdir):
+    columns = {"tls206_person": ["person_name", "person_ctry_code"]}
+    _, Base = patstat_base(db_suffix="2019_05_13", cache_dir=str(tmpdir),
+                           columns=columns)
+    assert list(Base.metadata.tables["tls206_person"].columns.keys()) == \
+        ["person_id", "person_name", "person_ctry_code"]
+    assert len(Base.metadata.tables["tls207_pers_appln"].columns) == 4
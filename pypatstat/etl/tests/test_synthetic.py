@@ -0,0 +1,43 @@
+from io import BytesIO
+from zipfile import ZipFile
+
+from benchmarks.synthetic import fake_archives
+from benchmarks.synthetic import fake_table
+from benchmarks.bench_pipeline import PeakRss
+from data_loader import zipfile_to_db
+from orms.patstat_2019_05_13 import Base
+from orms.patstat_2019_05_13 import Tls201Appln
+
+from sqlalchemy import create_engine
+
+
+def test_fake_table():
+    df = fake_table(Tls201Appln, 1000, start_id=11)
+    assert df.appln_id.tolist() == list(range(11, 1011))
+    assert set(df.appln_auth.dropna()) <= {"EP", "US", "CN", "JP", "KR",
+                                           "DE", "WO", "GB", "FR", "CA"}
+    assert df.appln_filing_year.dropna().between(1900, 2019).all()
+    assert (df.appln_nr.dropna().str.len() <= 15).all()
+    assert 0 < df.granted.isnull().sum() < 200
+
+
+def test_fake_archives_load(tmpdir):
+    tables = ["tls201_appln", "tls209_appln_ipc"]
+    archives, table_rows = fake_archives(200, tables=tables, n_parts=3,
+                                         n_archives=2)
+    assert len(archives) == 2
+    with ZipFile(BytesIO(list(archives.values())[0])) as zf:
+        assert zf.namelist() == ["tls201_part01.zip", "tls201_part03.zip",
+                                 "tls209_part01.zip", "tls209_part03.zip"]
+    db_url = f"sqlite:///{tmpdir}/patstat.db"
+    for archive in archives.values():
+        zipfile_to_db(BytesIO(archive), db_url, Base, chunksize=100)
+    engine = create_engine(db_url)
+    for tablename, n_rows in table_rows.items():
+        assert engine.execute(f"SELECT COUNT(*) FROM {tablename}").scalar() == n_rows
+
+
+def test_peak_rss():
+    with PeakRss() as rss:
+        data = bytearray(50 * 2**20)
+    assert rss.peak > len(data)
@@ -4,8 +4,26 @@ from unittest import mock
 from utils import login
 from utils import zipfiles_on_pages
 from utils import files_in_zipfile
+from utils import download_to_cache
+from utils import cache_path
+from utils import _zipfiles_on_pages
+from utils import stream_zip_members
+from utils import _zipfile_from_url
+from utils import DownloadStopped
+from benchmarks.fake_epo import FakeEpoServer
+from benchmarks.fake_epo import PWD
 
 from requests import Session
+from requests.exceptions import ConnectionError
+from requests.exceptions import HTTPError
+from requests.exceptions import Timeout
+from zipfile import ZipFile
+from zipfile import BadZipFile
+from zipfile import ZIP_DEFLATED
+from zipfile import ZIP_STORED
+from io import BytesIO
+import threading
+import time
 
 USERNAME = "username@something.com"
 
@@ -56,3 +74,211 @@ def test_files_in_zipfile(mocked_zf):
         assert filename == f'dummy{i}.txt'
     assert i == n_zips-1
 
+
+
+def _zip_bytes(n_files=3):
+    bio = BytesIO()
+    with ZipFile(bio, "w") as zf:
+        for i in range(n_files):
+            zf.writestr(f"dummy{i}.txt", f"some text {i} "*1000)
+    return bio.getvalue()
+
+
+def test_download_to_cache_resumes(tmpdir):
+    data = _zip_bytes()
+    url = "download/something.zip"
+    split = len(data)//3
+    # A previous download died part way through
+    with open(f"{cache_path(str(tmpdir), url)}.part", "wb") as f:
+        f.write(data[:split])
+
+    mocked_session = mock.MagicMock()
+    response = mocked_session.get.return_value
+    response.status_code = 206
+    response.iter_content.return_value = [data[split:]]
+
+    path = download_to_cache(mocked_session, url, str(tmpdir))
+    _, kwargs = mocked_session.get.call_args
+    assert kwargs["headers"] == {"Range": f"bytes={split}-"}
+    with open(path, "rb") as f:
+        assert f.read() == data
+
+
+@mock.patch("utils.time.sleep")
+def test_download_to_cache_retries_request(mocked_sleep, tmpdir):
+    data = _zip_bytes()
+    response = mock.MagicMock(status_code=200)
+    response.iter_content.return_value = [data]
+    server_error = mock.MagicMock(status_code=503)
+    server_error.raise_for_status.side_effect = HTTPError(response=server_error)
+    mocked_session = mock.MagicMock()
+    # Failing to open the request is retried as if dropped mid-stream
+    mocked_session.get.side_effect = [ConnectionError("Refused"),
+                                      Timeout("Timed out"), server_error,
+                                      response]
+    path = download_to_cache(mocked_session, "download/something.zip",
+                             str(tmpdir), max_retries=3)
+    assert mocked_session.get.call_count == 4
+    with open(path, "rb") as f:
+        assert f.read() == data
+    mocked_session.get.side_effect = ConnectionError("Refused")
+    with pytest.raises(ConnectionError):
+        download_to_cache(mocked_session, "download/other.zip", str(tmpdir),
+                          max_retries=2)
+    assert mocked_session.get.call_count == 4 + 3
+
+
+def test_download_to_cache_bad_crc(tmpdir):
+    data = bytearray(_zip_bytes())
+    data[100] ^= 0xFF  # Corrupt the first member
+    mocked_session = mock.MagicMock()
+    response = mocked_session.get.return_value
+    response.status_code = 200
+    response.iter_content.return_value = [bytes(data)]
+    with pytest.raises(BadZipFile):
+        download_to_cache(mocked_session, "download/bad.zip", str(tmpdir))
+    assert len(tmpdir.listdir()) == 0
+
+
+def test_download_to_cache_reuses(tmpdir):
+    url = "download/something.zip"
+    with open(cache_path(str(tmpdir), url), "wb") as f:
+        f.write(_zip_bytes())
+    mocked_session = mock.MagicMock()
+    download_to_cache(mocked_session, url, str(tmpdir))
+    assert mocked_session.get.call_count == 0
+
+
+def test_concurrent_zipfiles_on_pages_relogin(tmpdir):
+    zipfiles = {f"part_{i}.zip": _zip_bytes(i+1) for i in range(7)}
+    with FakeEpoServer(zipfiles) as server:
+        with mock.patch.multiple("utils", **server.urls()):
+            found = {}
+            for url, f in _zipfiles_on_pages(n_download_workers=3,
+                                             cache_dir=str(tmpdir),
+                                             username=USERNAME, pwd=PWD):
+                found[url] = f.read()
+                f.close()
+                if len(found) == 1:
+                    server.sessions.clear()  # Expire the session
+    assert found == {f"download/{k}": v for k, v in zipfiles.items()}
+    assert server.n_logins > 1
+
+
+def test_concurrent_zipfiles_on_pages_bounded():
+    held, peak = [0], [0]
+    def download(s, url, **kwargs):
+        held[0] += 1
+        peak[0] = max(peak[0], held[0])
+        return url
+    urls = [f"download/part_{i}.zip" for i in range(7)]
+    with mock.patch("utils.PatstatSession"), \
+            mock.patch("utils.zipfile_urls", return_value=urls), \
+            mock.patch("utils._zipfile_from_url", side_effect=download):
+        found = []
+        for url, f in _zipfiles_on_pages(n_download_workers=3):
+            found.append(f)
+            held[0] -= 1  # Released before the next one is requested
+    assert sorted(found) == urls
+    assert peak[0] <= 3
+
+
+def test_concurrent_zipfiles_on_pages_closed_early():
+    started, stopped = [], []
+    def download(s, url, stop=None, **kwargs):
+        started.append(url)
+        if url.endswith("part_0.zip"):
+            return BytesIO()
+        # A multi-GB archive, still in flight when the consumer stops
+        assert stop.wait(10)
+        stopped.append(url)
+        raise DownloadStopped(url)
+    urls = [f"download/part_{i}.zip" for i in range(7)]
+    with mock.patch("utils.PatstatSession"), \
+            mock.patch("utils.zipfile_urls", return_value=urls), \
+            mock.patch("utils._zipfile_from_url", side_effect=download):
+        zipfiles = _zipfiles_on_pages(n_download_workers=3)
+        url, f = next(zipfiles)
+        while len(started) < 3:  # Let the others get under way
+            time.sleep(0.01)
+        start = time.time()
+        zipfiles.close()
+        assert time.time() - start < 1
+        time.sleep(0.2)
+    assert url == "download/part_0.zip"
+    assert sorted(started) == urls[:3]  # Those yet to start never do
+    assert sorted(stopped) == urls[1:3]
+
+
+def test_zipfile_from_url_stops(tmpdir):
+    stop = threading.Event()
+    mocked_session = mock.MagicMock()
+    response = mocked_session.get.return_value
+    response.status_code = 200
+    def chunks(chunk_size):
+        yield b"x" * 10
+        stop.set()  # The consumer stops
+        yield b"x" * 10
+    response.iter_content.side_effect = chunks
+    url = "download/something.zip"
+    with pytest.raises(DownloadStopped):
+        _zipfile_from_url(mocked_session, url, cache_dir=str(tmpdir),
+                          stop=stop)
+    assert response.close.called
+    with open(f"{cache_path(str(tmpdir), url)}.part", "rb") as f:
+        assert f.read() == b"x" * 10  # Left to resume
+
+
+class _ForwardOnly:
+    """A non-seekable stream, like a zip member nested in another zipfile"""
+    def __init__(self, data):
+        self.bio = BytesIO(data)
+
+    def write(self, data):
+        return self.bio.write(data)
+
+    def flush(self):
+        pass
+
+    def read(self, n=-1):
+        return self.bio.read(n)
+
+
+@pytest.mark.parametrize("compression", [ZIP_DEFLATED, ZIP_STORED])
+@pytest.mark.parametrize("force_zip64", [True, False])
+def test_stream_zip_members(compression, force_zip64):
+    contents = {f"tls20{i}_part01.csv": (f"a,b\n{i},text\n"*(5000*i)).encode()
+                for i in range(4)}
+    bio = BytesIO()
+    with ZipFile(bio, "w", compression=compression) as zf:
+        for name, data in contents.items():
+            with zf.open(name, "w", force_zip64=force_zip64) as f:
+                f.write(data)
+    found = {name: f.read() for name, f
+             in stream_zip_members(_ForwardOnly(bio.getvalue()),
+                                   skip_table_prefixes=["tls202"])}
+    del contents["tls202_part01.csv"]
+    assert found == contents
+
+
+def test_stream_zip_members_data_descriptor():
+    # Writing to an unseekable stream results in data descriptors
+    stream = _ForwardOnly(b"")
+    with ZipFile(stream, "w", compression=ZIP_DEFLATED) as zf:
+        for i in range(3):
+            zf.writestr(f"dummy{i}.txt", f"some text {i} "*10000)
+    stream.bio.seek(0)
+    for i, (name, f) in enumerate(stream_zip_members(stream)):
+        assert name == f"dummy{i}.txt"
+        assert f.read() == (f"some text {i} "*10000).encode()
+    assert i == 2
+
+
+def test_stream_zip_members_bad_crc():
+    bio = BytesIO()
+    with ZipFile(bio, "w", compression=ZIP_STORED) as zf:
+        zf.writestr("dummy.txt", "some text")
+    data = bio.getvalue().replace(b"some text", b"some tent")
+    with pytest.raises(BadZipFile):
+        for name, f in stream_zip_members(BytesIO(data)):
+            f.read()
@@ -1,17 +1,56 @@
 from zipfile import ZipFile
 from zipfile import BadZipFile
 from io import BytesIO
+from io import BufferedReader
+from io import RawIOBase
 from requests import session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError
+from requests.exceptions import ChunkedEncodingError
+from requests.exceptions import HTTPError
+from requests.exceptions import Timeout
 from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import wait
+from contextlib import closing
 import logging
+import multiprocessing
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+LOCAL_HEADER_SIG = b"PK\x03\x04"
+DATA_DESCRIPTOR_SIG = b"PK\x07\x08"
+LOCAL_HEADER_FMT = "<HHHHHIIIHH"
+STREAM_BLOCK_SIZE = 2**16
 
 TOP_URL="https://publication.epo.org/raw-data"
 AUTH_URL=f"{TOP_URL}/authentication"
 RAW_DATA_URL=f"{TOP_URL}/product?productId=86"
 
-def login(username, pwd):
+def fork_context():
+    """The multiprocessing context of the load's worker processes. They are
+    forked, whatever the platform's default start method, as they inherit
+    the ORM Base (which can't be pickled) and the loader's shared state.
+    Fork is only available on POSIX systems (and unsafe on macOS for some
+    system libraries)."""
+    if "fork" not in multiprocessing.get_all_start_methods():
+        raise ValueError("Loading with worker processes needs them to be "
+                         "forked, which is only possible on POSIX systems")
+    return multiprocessing.get_context("fork")
+
+
+def login(username, pwd, pool_size=None):
     """Log into your PATSTAT account and setup a session"""
     s = session()    
+    if pool_size is not None:
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        s.mount("http://", adapter)
+        s.mount("https://", adapter)
     r = s.post(AUTH_URL, data=dict(action=1, submit="Log in",
                                    login=username, pwd=pwd))
     if username not in r.text:
@@ -20,23 +59,125 @@ def login(username, pwd):
     return s
 
 
-def _zipfiles_on_pages(download_suffix='', **credentials):
-    """Retrieve a list of all zipfiles"""
-    s = login(**credentials)
-    r = s.get(RAW_DATA_URL, stream=True)
+class PatstatSession:
+    """A single PATSTAT session, shared between download threads, which
+    logs back in only when the website reports that the session has expired.
+
+    Args:
+        username, pwd (str): PATSTAT username and password.
+        pool_size (int): Number of pooled connections to keep open.
+    """
+    def __init__(self, username, pwd, pool_size=None):
+        self.credentials = dict(username=username, pwd=pwd,
+                                pool_size=pool_size)
+        self._lock = threading.Lock()
+        self.session = login(**self.credentials)
+
+    def relogin(self, expired_session):
+        """Log in again, unless another thread has already done so"""
+        with self._lock:
+            if self.session is expired_session:
+                logging.info("PATSTAT session expired, logging in again")
+                self.session = login(**self.credentials)
+        return self.session
+
+    def get(self, url, **kwargs):
+        s = self.session
+        r = s.get(url, **kwargs)
+        if session_expired(r):
+            r.close()
+            r = self.relogin(s).get(url, **kwargs)
+        return r
+
+
+def session_expired(r):
+    """Has this response been bounced to the PATSTAT login page?"""
+    return r.status_code in (401, 403) or r.url.startswith(AUTH_URL)
+
+
+def zipfile_urls(s, download_suffix='', skip_urls=[]):
+    """Yield the relative URLs of all zipfiles on the raw data page, except
+    for those containing any of `skip_urls`"""
+    r = s.get(RAW_DATA_URL)
     soup = BeautifulSoup(r.text, "lxml")
     for anchor in soup.find_all("a", href=True):
         url = anchor["href"]
         if not (url.endswith(".zip") and url.startswith("download")):
             continue        
-        if not url.endswith(download_suffix):
+        if not url.endswith(download_suffix) or \
+           any(skip_url in url for skip_url in skip_urls):
             logging.info(f'Skipping {url}')
             continue
-        s = login(**credentials)
-        yield (url, _zipfile_from_url(s, url))
+        yield url
+
 
+class DownloadStopped(Exception):
+    """Raised within a download once its consumer has stopped waiting for it"""
 
-def zipfiles_on_pages(s):
+
+def _zipfiles_on_pages(download_suffix='', cache_dir=None,
+                       n_download_workers=1, skip_urls=[], metrics=None,
+                       make_buffer=BytesIO, **credentials):
+    """Retrieve all zipfiles, downloading up to `n_download_workers` at a time
+    over a single shared session. Zipfiles are yielded as they complete, the
+    next download starting once the consumer is done with the last one.
+    Note that, without a `cache_dir`, up to `n_download_workers` zipfiles
+    (including the one being consumed) will be held in `make_buffer()`
+    buffers (in memory, by default) at once. If the consumer stops early,
+    downloads yet to start are cancelled and those in flight are stopped.
+    The number of zipfiles to retrieve is recorded in `metrics`, if
+    specified."""
+    s = PatstatSession(pool_size=n_download_workers, **credentials)
+    urls = list(zipfile_urls(s, download_suffix=download_suffix,
+                             skip_urls=skip_urls))
+    if metrics is not None:
+        metrics.set("archives_total", len(urls))
+    if n_download_workers <= 1:
+        for url in urls:
+            yield (url, _zipfile_from_url(s, url, cache_dir=cache_dir,
+                                          make_buffer=make_buffer))
+        return
+    urls = iter(urls)
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(n_download_workers)
+    pending = {}
+    def submit_next():
+        url = next(urls, None)
+        if url is not None:
+            future = executor.submit(_zipfile_from_url, s, url,
+                                     cache_dir=cache_dir,
+                                     make_buffer=make_buffer, stop=stop)
+            pending[future] = url
+    try:
+        for _ in range(n_download_workers):
+            submit_next()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                url = pending.pop(future)
+                yield (url, future.result())
+                submit_next()  # Only now is the yielded zipfile released
+    finally:
+        # Don't wait for the rest of the downloads if the consumer has stopped
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        for future in pending:
+            future.add_done_callback(_close_result)
+
+
+def _close_result(future):
+    """Close the zipfile of a download which will never be consumed"""
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def _check_stopped(stop, url):
+    """Raise :obj:`DownloadStopped` if the download's consumer has stopped"""
+    if stop is not None and stop.is_set():
+        raise DownloadStopped(f"Stopped downloading {url}")
+
+
+def zipfiles_on_pages(s, cache_dir=None):
     """Retrieve a list of all zipfiles"""
     r = s.get(RAW_DATA_URL)
     soup = BeautifulSoup(r.text, "lxml")
@@ -44,18 +185,122 @@ def zipfiles_on_pages(s):
         url = anchor["href"]
         if not (url.endswith(".zip") and url.startswith("download")):
             continue
-        yield (url, _zipfile_from_url(s, url))
+        yield (url, _zipfile_from_url(s, url, cache_dir=cache_dir))
+
 
+def _zipfile_from_url(s, url, chunk_size=2**25,  # Around 30MB
+                      cache_dir=None, make_buffer=BytesIO, stop=None):
+    """Retrieve a zipfile, either into memory or via the on-disk cache.
 
-def _zipfile_from_url(s, url, chunk_size=2**25):  # Around 30MB
-    """Retrieve a zipfile"""
+    Args:
+        s (:obj:`requests.Session`): A session logged into the PATSTAT website.
+        url (str): Relative URL of the zipfile.
+        chunk_size (int): Number of bytes to stream per request chunk.
+        cache_dir (str): If specified, download to (or reuse the archive
+                         already in) this directory, rather than to memory.
+        make_buffer: Function returning the buffer to download to otherwise,
+                     e.g. a :obj:`SpooledTemporaryFile` which spills to disk.
+        stop (:obj:`threading.Event`): If specified, stop downloading (raising
+                                       :obj:`DownloadStopped`) once it's set.
+    Returns:
+        file_handle: An open binary file-like object of the zipfile.
+    """
+    if cache_dir is not None:
+        path = download_to_cache(s, url, cache_dir, chunk_size=chunk_size,
+                                 stop=stop)
+        return open(path, "rb")
     r = s.get(f"{TOP_URL}/{url}", stream=True)
-    file_handle = BytesIO()
-    for chunk in r.iter_content(chunk_size):
-        file_handle.write(chunk)
+    file_handle = make_buffer()
+    with closing(r):
+        try:
+            for chunk in r.iter_content(chunk_size):
+                _check_stopped(stop, url)
+                file_handle.write(chunk)
+        except DownloadStopped:
+            file_handle.close()
+            raise
     return file_handle
 
-        
+
+
+def cache_path(cache_dir, url):
+    """Local path of the cached copy of the zipfile at this URL"""
+    return os.path.join(cache_dir, re.sub(r"[^\w.-]", "_", url))
+
+
+def is_valid_zipfile(path):
+    """Check that every member of the zipfile matches its stored CRC"""
+    try:
+        with ZipFile(path) as zf:
+            return zf.testzip() is None
+    except (BadZipFile, OSError):
+        return False
+
+
+def download_to_cache(s, url, cache_dir, chunk_size=2**25, max_retries=10,
+                      stop=None):
+    """Download a zipfile into the cache directory, resuming any partial
+    download with HTTP Range requests. Completed archives are verified against
+    their CRCs before being moved into place, and are reused on later calls.
+
+    Args:
+        s (:obj:`requests.Session`): A session logged into the PATSTAT website.
+        url (str): Relative URL of the zipfile.
+        cache_dir (str): Directory in which to cache downloaded zipfiles.
+        chunk_size (int): Number of bytes to stream per request chunk.
+        max_retries (int): Number of times to retry (or resume) after a failed
+                           connection, timeout or server error.
+        stop (:obj:`threading.Event`): If specified, stop downloading (raising
+                                       :obj:`DownloadStopped`) once it's set,
+                                       leaving the partial download to resume.
+    Returns:
+        path (str): Path to the verified, cached zipfile.
+    """
+    path = cache_path(cache_dir, url)
+    if os.path.exists(path):
+        logging.info(f"Using cached {path}")
+        return path
+    os.makedirs(cache_dir, exist_ok=True)
+    part_path = f"{path}.part"
+    for itry in range(max_retries + 1):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset > 0 else {}
+        try:
+            r = s.get(f"{TOP_URL}/{url}", stream=True, headers=headers)
+            if r.status_code == 416:  # Nothing left to fetch
+                r.close()
+                break
+            with closing(r):
+                r.raise_for_status()
+                # Append if the server honoured the Range request, else restart
+                mode = "ab" if r.status_code == 206 else "wb"
+                if offset > 0:
+                    logging.info(f"Resuming {url} from byte {offset} ({mode})")
+                with open(part_path, mode) as f:
+                    for chunk in r.iter_content(chunk_size):
+                        _check_stopped(stop, url)
+                        f.write(chunk)
+        except HTTPError as err:
+            if err.response is None or err.response.status_code < 500:
+                raise  # Retrying won't help
+            logging.warning(f"Server error while downloading {url}: {err}")
+            time.sleep(5)
+            continue
+        except (ConnectionError, ChunkedEncodingError, Timeout):
+            logging.warning(f"Connection dropped while downloading {url}")
+            time.sleep(5)
+            continue
+        break
+    else:
+        raise ConnectionError(f"Unable to download {url} after "
+                              f"{max_retries} retries")
+    if not is_valid_zipfile(part_path):
+        os.remove(part_path)
+        raise BadZipFile(f"Downloaded {url} failed its CRC check")
+    os.replace(part_path, path)
+    return path
+
+
 def files_in_zipfile(bio, skip_table_prefixes=[], yield_zipfile_too=False):
     """Yield individual files from the zipfile"""
     try:
@@ -75,3 +320,160 @@ def files_in_zipfile(bio, skip_table_prefixes=[], yield_zipfile_too=False):
                 yield (zipinfo.filename, f)
     zf.close()
     bio.close()
+
+
+class _PushbackStream:
+    """Wrap a readable stream so that over-read bytes can be returned to it"""
+    def __init__(self, f):
+        self.f = f
+        self.buffer = b""
+
+    def read(self, n):
+        if self.buffer:
+            data, self.buffer = self.buffer[:n], self.buffer[n:]
+            if len(data) < n:
+                data += self.f.read(n - len(data))
+            return data
+        return self.f.read(n)
+
+    def read_exactly(self, n):
+        data = self.read(n)
+        while len(data) < n:
+            more = self.read(n - len(data))
+            if not more:
+                raise BadZipFile("Unexpected end of zipped stream")
+            data += more
+        return data
+
+    def unread(self, data):
+        self.buffer = data + self.buffer
+
+
+class _ZipMemberStream(RawIOBase):
+    """Decompress a single zip member from a forward-only stream,
+    checking its CRC once the end of the member is reached"""
+    def __init__(self, stream, method, compress_size, crc, descriptor, zip64):
+        self.stream = stream
+        self.method = method
+        self.remaining = compress_size  # None if unknown until the end
+        self.crc = crc
+        self.descriptor = descriptor
+        self.zip64 = zip64
+        self.running_crc = 0
+        self.n_decompressed = 0
+        self.decompress_seconds = 0
+        self.pending = b""
+        self.eof = False
+        if method == 8:
+            self.decompressor = zlib.decompressobj(-15)
+        elif method != 0 or descriptor:
+            raise BadZipFile(f"Unsupported streamed compression method {method}")
+
+    def readable(self):
+        return True
+
+    def _next_block(self):
+        """Decompress the next block of data, or flag the end of the member"""
+        if self.method == 0:
+            data = self.stream.read(min(STREAM_BLOCK_SIZE, self.remaining))
+            if self.remaining > 0 and not data:
+                raise BadZipFile("Unexpected end of zipped stream")
+            self.remaining -= len(data)
+            if self.remaining == 0:
+                self._finish()
+            return data
+        if self.decompressor.unconsumed_tail:
+            raw = self.decompressor.unconsumed_tail
+        else:
+            n = STREAM_BLOCK_SIZE
+            if self.remaining is not None:
+                n = min(n, self.remaining)
+            raw = self.stream.read(n)
+            if self.remaining is not None:
+                self.remaining -= len(raw)
+            if not raw:
+                raise BadZipFile("Unexpected end of zipped stream")
+        data = self.decompressor.decompress(raw, STREAM_BLOCK_SIZE)
+        if self.decompressor.eof:
+            self.stream.unread(self.decompressor.unused_data)
+            self._finish()
+        return data
+
+    def _finish(self):
+        if self.descriptor:
+            sig = self.stream.read_exactly(4)
+            if sig != DATA_DESCRIPTOR_SIG:
+                self.stream.unread(sig)
+            fields = self.stream.read_exactly(20 if self.zip64 else 12)
+            self.crc = struct.unpack("<I", fields[:4])[0]
+        self.eof = True
+
+    def readinto(self, b):
+        while not self.pending and not self.eof:
+            start = time.time()
+            self.pending = self._next_block()
+            self.decompress_seconds += time.time() - start
+            self.running_crc = zlib.crc32(self.pending, self.running_crc)
+            self.n_decompressed += len(self.pending)
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        if n == 0 and self.running_crc != self.crc:
+            raise BadZipFile("Bad CRC-32 for streamed zip member")
+        return n
+
+    def drain(self):
+        """Read to the end of this member, so that the next can be read"""
+        while self.readinto(bytearray(STREAM_BLOCK_SIZE)):
+            pass
+
+
+def _zip64_sizes(extra, csize, usize):
+    """Extract the sizes from the ZIP64 extra field, if they are in it"""
+    while len(extra) >= 4:
+        header_id, size = struct.unpack("<HH", extra[:4])
+        if header_id == 1:
+            data = extra[4:4+size]
+            if usize == 0xFFFFFFFF:
+                usize, data = struct.unpack("<Q", data[:8])[0], data[8:]
+            if csize == 0xFFFFFFFF:
+                csize = struct.unpack("<Q", data[:8])[0]
+            return csize, usize, True
+        extra = extra[4+size:]
+    return csize, usize, False
+
+
+def stream_zip_members(f, skip_table_prefixes=[]):
+    """Yield individual files from a zipfile which can only be read forwards,
+    such as a zipfile nested inside another zipfile, by reading local file
+    headers rather than the central directory. Only a bounded amount of
+    data is held in memory, however large each member is.
+
+    Args:
+        f: A readable binary file-like object of the zipfile.
+        skip_table_prefixes (list): Skip file names with these prefixes.
+    Yields:
+        (filename, file) (tuple): File name and a buffered, readable stream.
+    """
+    stream = _PushbackStream(f)
+    while True:
+        sig = stream.read(4)
+        if sig != LOCAL_HEADER_SIG:  # Central directory, or end of the stream
+            if len(sig) > 0 and not sig.startswith(b"PK"):
+                raise BadZipFile("Zipped stream is not a zipfile")
+            return
+        header = struct.unpack(LOCAL_HEADER_FMT, stream.read_exactly(26))
+        _, flags, method, _, _, crc, csize, usize, fname_len, extra_len = header
+        filename = stream.read_exactly(fname_len).decode("utf-8" if flags & 0x800
+                                                         else "cp437")
+        extra = stream.read_exactly(extra_len)
+        csize, usize, zip64 = _zip64_sizes(extra, csize, usize)
+        descriptor = bool(flags & 0x08)
+        member = _ZipMemberStream(stream, method,
+                                  None if descriptor else csize,
+                                  crc, descriptor, zip64)
+        if any(filename.startswith(fn) for fn in skip_table_prefixes):
+            logging.info(f"\t\tSkipping {filename}")
+        else:
+            yield (filename, BufferedReader(member, STREAM_BLOCK_SIZE))
+        member.drain()